@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+# Copyright (C) 2019 Emanuel Goncalves
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+from crispy.Utils import Utils
+from crispy.Pipeline import IncrementalPipeline
+from crispy.CRISPRData import CRISPRDataSet, DATASETS
+
+
+LOG = logging.getLogger("Crispy")
+
+STAGES = ["counts", "qc_filter"] + IncrementalPipeline.STAGES + ["qc"]
+
+OUTPUTS = ["foldchange", "correction", "scale", "qc", "hyperparameters"]
+
+# Default mapping of library columns to the Crispy columns (e.g. Yusa_v1.1 library)
+LIBRARY_COLUMNS = {"chr": "Chr", "start": "Start", "end": "End"}
+
+GENE_COLUMNS = ["Approved_Symbol", "Gene"]
+
+
+def read_config(path):
+    """
+    Read pipeline configuration from a YAML (.yaml/.yml, requires PyYAML) or JSON file, e.g.:
+
+        output: cohort/
+        dataset: Yusa_v1.1
+        samples: [HT29_c903R1, HT29_c904R1]
+        min_reads: 15000000
+        min_count: 30
+        copy_number: {file: segments.csv.gz, sample_col: model_id}
+        sample_map: {file: samplesheet.csv, index_col: name, column: model_id}
+        library_columns: {chr: Chr, start: Start, end: End}
+        gene_col: Gene
+        correction: {gp_approx: binned, n_sgrna: 10}
+        outputs: [foldchange, scale, qc]
+
+    dataset is a data-set name (see DATASETS) or description (see DataSetManifest), and extra
+    data-sets can be registered with datasets (see DataSetRegistry.register_file). store opens
+    the read counts from a count store (see CountStore). sample_map maps read counts samples to
+    copy-number samples, if they are named differently. library_columns maps the library columns
+    to the Crispy columns (see prepare_library). Relative paths are resolved against the
+    directory of the configuration file.
+
+    :param path: str
+
+    :return: dict
+    """
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            import yaml
+
+            config = yaml.safe_load(f)
+
+        else:
+            config = json.load(f)
+
+    config_dir = os.path.dirname(os.path.abspath(path))
+
+    def resolve(file):
+        return file if file is None else os.path.join(config_dir, file)
+
+    config["output"] = resolve(config.get("output", "crispy_output"))
+
+    for k in ["datasets", "store"]:
+        config[k] = resolve(config.get(k))
+
+    for k in ["copy_number", "sample_map"]:
+        if isinstance(config.get(k), str):
+            config[k] = dict(file=config[k])
+
+        if config.get(k) is not None:
+            config[k]["file"] = resolve(config[k]["file"])
+
+    return config
+
+
+def load_counts(config):
+    """
+    Stage counts: read counts and controls of the data-set
+
+    :return: crispy.CRISPRData.CRISPRDataSet
+    """
+    if config.get("datasets") is not None:
+        DATASETS.register_file(config["datasets"])
+
+    return CRISPRDataSet(
+        config["dataset"], samples=config.get("samples"), store=config.get("store")
+    )
+
+
+def qc_filter(dataset, min_reads=0):
+    """
+    Stage qc_filter: discard samples with less than min_reads total read counts
+
+    :param dataset: crispy.CRISPRData.CRISPRDataSet
+
+    :return: (pandas.DataFrame, list or dict)
+        Read counts and controls of the samples passing QC
+    """
+    plasmids = dataset.plasmids
+    controls = (
+        {c for cs in plasmids.values() for c in cs}
+        if type(plasmids) is dict
+        else set(plasmids)
+    )
+
+    reads = dataset.counts.sum()
+    failed = [s for s in reads.index[reads < min_reads] if s not in controls]
+
+    if len(failed) > 0:
+        LOG.warning(f"#(samples)={len(failed)} with less than {min_reads} reads")
+
+    counts = dataset.counts.drop(columns=failed)
+
+    if type(plasmids) is dict:
+        plasmids = {s: plasmids[s] for s in counts if s in plasmids}
+
+    return counts, plasmids
+
+
+def load_segments(config, samples):
+    """
+    Copy-number segments of each sample, mapped with sample_map if defined
+
+    :return: dict
+    """
+    if config.get("copy_number") is None:
+        LOG.warning("Copy-number segments not provided, correction skipped")
+        return dict()
+
+    spec = dict(config["copy_number"])
+    file, sample_col = spec.pop("file"), spec.pop("sample_col", "model_id")
+
+    segments = dict(list(pd.read_csv(file, **spec).groupby(sample_col)))
+
+    if config.get("sample_map") is not None:
+        spec = dict(config["sample_map"])
+        file, column = spec.pop("file"), spec.pop("column", sample_col)
+
+        smap = pd.read_csv(file, **spec)[column].to_dict()
+
+    else:
+        smap = dict()
+
+    return {s: segments[smap.get(s, s)] for s in samples if smap.get(s, s) in segments}
+
+
+def qc_metrics(genes_fc, reads=None, essential=None, non_essential=None):
+    """
+    Stage qc: per sample separation of essential and non-essential genes fold-changes, i.e. ROC
+    AUC, medians and null-normalised mean difference (NNMD, mean difference over the standard
+    deviation of the non-essential genes)
+
+    :param genes_fc: pandas.DataFrame
+        Gene (rows) fold-changes of the samples (columns)
+
+    :param reads: pandas.Series, optional
+        Total read counts of the samples
+
+    :return: pandas.DataFrame
+    """
+    from sklearn.metrics import roc_auc_score
+
+    if essential is None:
+        essential = Utils.get_essential_genes(return_series=False)
+
+    if non_essential is None:
+        non_essential = Utils.get_non_essential_genes(return_series=False)
+
+    ess_fc = genes_fc[genes_fc.index.isin(essential)]
+    ness_fc = genes_fc[genes_fc.index.isin(non_essential)]
+
+    metrics = pd.DataFrame(
+        dict(
+            genes=genes_fc.count(),
+            ess_median=ess_fc.median(),
+            ness_median=ness_fc.median(),
+            nnmd=(ess_fc.mean() - ness_fc.mean()) / ness_fc.std(),
+        )
+    )
+
+    y_true = np.r_[np.ones(len(ess_fc)), np.zeros(len(ness_fc))]
+
+    for s in genes_fc:
+        values = np.r_[ess_fc[s].values, ness_fc[s].values]
+        mask = ~np.isnan(values)
+
+        metrics.loc[s, "auc"] = (
+            roc_auc_score(y_true[mask], -values[mask])
+            if len(np.unique(y_true[mask])) == 2
+            else np.nan
+        )
+
+    if reads is not None:
+        metrics.insert(0, "reads", reads.reindex(metrics.index))
+
+    return metrics
+
+
+def prepare_library(config, library, correction=True):
+    """
+    Library with the columns renamed with library_columns (defaults to LIBRARY_COLUMNS, library
+    columns already named as the Crispy columns are kept) and its gene column, gene_col or the
+    first of GENE_COLUMNS in the library. Columns are checked before any stage is run.
+
+    :param library: pandas.DataFrame
+
+    :param correction: bool
+        Check the Crispy CRISPR_LIB_COLUMNS, required by the correction stage
+
+    :return: (pandas.DataFrame, str)
+        Library and gene column
+    """
+    from crispy.CopyNumberCorrection import CRISPR_LIB_COLUMNS
+
+    columns = config.get("library_columns", LIBRARY_COLUMNS)
+    columns = {k: v for k, v in columns.items() if k in library and v not in library}
+
+    library = library.rename(columns=columns)
+
+    gene_col = config.get("gene_col")
+
+    if gene_col is None:
+        gene_col = next((c for c in GENE_COLUMNS if c in library), GENE_COLUMNS[0])
+
+    assert gene_col in library, (
+        f"Library gene column {gene_col} missing, set gene_col to one of: "
+        f"{list(library.columns)}"
+    )
+
+    missing = [c for c in CRISPR_LIB_COLUMNS if c not in library]
+    assert not correction or len(missing) == 0, (
+        f"Library columns {missing} required by the correction missing, map them with "
+        f"library_columns, library columns: {list(library.columns)}"
+    )
+
+    return library, gene_col
+
+
+def build_pipeline(config, dataset):
+    """
+    Stage qc_filter and IncrementalPipeline of the samples passing QC
+
+    :param dataset: crispy.CRISPRData.CRISPRDataSet
+
+    :return: crispy.Pipeline.IncrementalPipeline
+    """
+    counts, plasmids = qc_filter(dataset, config.get("min_reads", 0))
+
+    segments = load_segments(config, list(counts))
+
+    library, gene_col = prepare_library(
+        config, dataset.lib, correction=len(segments) > 0
+    )
+
+    return IncrementalPipeline(
+        os.path.join(config["output"], "shards"),
+        counts,
+        plasmids,
+        library,
+        segments_by_sample=segments,
+        gene_col=gene_col,
+        min_count=config.get("min_count", 30),
+        correct_kws=config.get("correction"),
+    )
+
+
+def run(config, n_jobs=1, until=None, batch_size=None):
+    """
+    Run the pipeline stages (see STAGES), computing only the samples without an up-to-date shard
+    (see IncrementalPipeline), so an interrupted run resumes from the last written shards.
+
+    :param config: dict
+        Pipeline configuration, see read_config
+
+    :param n_jobs: int
+        Number of worker processes of the correction stage, -1 uses all CPUs
+
+    :param until: str, optional
+        Last stage to run, all if None
+
+    :param batch_size: int, optional
+        Samples corrected between shard checkpoints, see IncrementalPipeline.run
+
+    :return: pandas.DataFrame
+        Time (seconds), processed and cached samples of each stage
+    """
+    last = STAGES.index(STAGES[-1] if until is None else until)
+    timings = pd.DataFrame(
+        index=STAGES[: last + 1], columns=["seconds", "processed", "cached"]
+    )
+
+    def timed(stage, fun, *args, **kwargs):
+        start = time.time()
+        res = fun(*args, **kwargs)
+        timings.loc[stage, "seconds"] = round(time.time() - start, 2)
+        return res
+
+    # - Read counts and QC filter
+    dataset = timed("counts", load_counts, config)
+    timings.loc["counts", "processed"] = dataset.counts.shape[1]
+
+    if last < STAGES.index("qc_filter"):
+        return timings
+
+    pipeline = timed("qc_filter", build_pipeline, config, dataset)
+    timings.loc["qc_filter", "processed"] = pipeline.counts.shape[1]
+
+    # - Incremental stages
+
+    for stage in IncrementalPipeline.STAGES:
+        if stage not in timings.index:
+            break
+
+        samples = pipeline.keys()[stage].dropna().index
+        processed = timed(
+            stage, pipeline.run, [stage], n_jobs=n_jobs, batch_size=batch_size
+        )[stage]
+
+        timings.loc[stage, "processed"] = len(processed)
+        timings.loc[stage, "cached"] = len(samples) - len(processed)
+
+    # - QC metrics and outputs
+    outputs = config.get("outputs", OUTPUTS)
+
+    if "qc" in timings.index:
+        genes = pipeline.matrix("genes")
+
+        if genes.shape[1] == 0:
+            LOG.warning("QC metrics skipped, no samples with gene fold-changes")
+
+        else:
+            metrics = timed("qc", qc_metrics, genes, reads=pipeline.counts.sum())
+            timings.loc["qc", "processed"] = metrics.shape[0]
+
+            if "qc" in outputs:
+                metrics.to_csv(os.path.join(config["output"], "qc.csv"))
+
+    for stage in IncrementalPipeline.STAGES:
+        if stage in outputs and stage in timings.index:
+            matrix = pipeline.matrix(stage)
+
+            if matrix.shape[1] == 0:
+                LOG.warning(f"Output {stage} skipped, no samples processed")
+                continue
+
+            matrix.to_csv(
+                os.path.join(config["output"], f"{stage}.csv.gz"), compression="gzip"
+            )
+
+    if (
+        "hyperparameters" in outputs
+        and "correction" in timings.index
+        and len(pipeline.kernels()) > 0
+    ):
+        pipeline.hyperparameters().to_csv(
+            os.path.join(config["output"], "hyperparameters.csv")
+        )
+
+    return timings
+
+
+def status(config):
+    """
+    Up-to-date shards of each sample and stage, see IncrementalPipeline.status
+
+    :return: pandas.DataFrame
+    """
+    return build_pipeline(config, load_counts(config)).status()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="crispy",
+        description="Process CRISPR-Cas9 screens: read counts QC, normalisation, fold-changes, "
+        "copy-number correction (Crispy), gene aggregation, scaling and QC metrics.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p_run = subparsers.add_parser(
+        "run", help="Run pipeline, processing only new or changed samples"
+    )
+    p_run.add_argument("config", help="Pipeline configuration (YAML or JSON)")
+    p_run.add_argument(
+        "-j", "--jobs", type=int, default=1, help="Worker processes (-1 all CPUs)"
+    )
+    p_run.add_argument(
+        "--until", choices=STAGES, default=STAGES[-1], help="Last stage to run"
+    )
+    p_run.add_argument(
+        "--batch-size",
+        type=int,
+        default=None,
+        help="Samples corrected between checkpoints (default 4 x jobs)",
+    )
+    p_run.add_argument("-o", "--output", default=None, help="Output directory")
+
+    p_status = subparsers.add_parser("status", help="Show up-to-date samples")
+    p_status.add_argument("config", help="Pipeline configuration (YAML or JSON)")
+    p_status.add_argument("-o", "--output", default=None, help="Output directory")
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    config = read_config(args.config)
+
+    if args.output is not None:
+        config["output"] = args.output
+
+    os.makedirs(config["output"], exist_ok=True)
+
+    if args.command == "status":
+        print(status(config).to_string())
+        return 0
+
+    start = time.time()
+
+    timings = run(
+        config,
+        n_jobs=args.jobs,
+        until=args.until,
+        batch_size=args.batch_size,
+    )
+
+    LOG.info(
+        f"Pipeline finished in {time.time() - start:.1f}s\n"
+        + timings.to_string(na_rep="-")
+    )
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
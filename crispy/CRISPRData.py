@@ -2,13 +2,15 @@
 # Copyright (C) 2019 Emanuel Goncalves
 
 import os
+import json
 import logging
 import numpy as np
 import pandas as pd
 import pkg_resources
-import scipy.stats as st
 from pandas import DataFrame
-from crispy.Utils import Utils
+from crispy.Utils import Utils, GeneSetScaler
+from crispy.Intervals import IntervalIndex
+from crispy.CountStore import CountStore
 
 
 LOG = logging.getLogger("Crispy")
@@ -17,176 +19,324 @@ DATA_DIR = pkg_resources.resource_filename("crispy", "data/crispr_rawcounts/")
 LIBS_DIR = pkg_resources.resource_filename("crispy", "data/crispr_libs/")
 MANIFESTS_DIR = pkg_resources.resource_filename("crispy", "data/crispr_manifests/")
 
-DATASETS = {
-    "Yusa_v1": dict(
-        name="Yusa v1",
-        read_counts="Yusa_v1_Score_readcount.csv.gz",
-        library="Yusa_v1.csv.gz",
-        plasmids=["ERS717283.plasmid"],
-        exclude_samples=set(
-            pd.read_csv(f"{MANIFESTS_DIR}/project_score_all_qc_failed_samples.csv")["sample"]
+
+class DataSetManifest(dict):
+    """
+    Data-set description, i.e. read counts file, CRISPR library, plasmids and optionally the sgRNAs
+    and samples to exclude. Plasmids and exclusions can be defined by a manifest file, e.g.
+    dict(file="sample_map.csv.gz", index_col="sample", column="controls"), or by a callable, and
+    are only parsed on first access and then memoized.
+
+    Manifest files are parsed with pd.read_excel (.xls/.xlsx) or pd.read_csv, with any extra key
+    passed as reader argument. Plasmids are read from column, split by split (default ";"), and
+    exclusions are the values of column or of the index if column is not defined. Relative paths
+    are resolved against manifests_dir.
+
+    """
+
+    LAZY_FIELDS = ["plasmids", "exclude_guides", "exclude_samples"]
+
+    def __init__(self, *args, manifests_dir=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.manifests_dir = MANIFESTS_DIR if manifests_dir is None else manifests_dir
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+
+        if callable(value):
+            value = value()
+            super().__setitem__(key, value)
+
+        elif self.is_manifest(key, value):
+            value = self.read_manifest(key, value)
+            super().__setitem__(key, value)
+
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def is_manifest(self, key, value):
+        return (
+            key in self.LAZY_FIELDS
+            and isinstance(value, dict)
+            and isinstance(value.get("file"), str)
+        )
+
+    def read_manifest(self, key, spec):
+        """
+        Parse manifest file of a lazy field
+
+        :param key: str
+            One of LAZY_FIELDS
+
+        :param spec: dict
+            Manifest definition, see DataSetManifest
+
+        :return: dict (plasmids) or set (exclusions)
+        """
+        spec = dict(spec)
+
+        path = os.path.join(self.manifests_dir, spec.pop("file"))
+        column = spec.pop("column", None)
+        split = spec.pop("split", ";")
+
+        LOG.info(f"Reading {key} manifest {path}")
+
+        if path.endswith((".xls", ".xlsx")):
+            df = pd.read_excel(path, **spec)
+
+        else:
+            df = pd.read_csv(path, **spec)
+
+        if key == "plasmids":
+            assert column is not None, "Plasmids manifest requires a column"
+            return df[column].apply(lambda v: v.split(split)).to_dict()
+
+        return set(df.index if column is None else df[column])
+
+
+class DataSetRegistry(dict):
+    """
+    Registry of CRISPR data-sets, mapping data-set names to DataSetManifest. New data-sets can be
+    registered from a YAML or JSON file with a mapping of data-set names to their description, e.g.:
+
+        Avana_DepMap20Q3:
+            name: Avana DepMap20Q3
+            read_counts: /data/Avana_DepMap20Q3_readcount.csv.gz
+            library: Avana_v1.csv.gz
+            plasmids: {file: Avana_DepMap20Q3_sample_map.csv.gz, index_col: replicate_ID, column: controls}
+            exclude_guides: {file: Avana_DepMap20Q3_dropped_guides.csv, index_col: 0}
+
+    Relative read counts files are resolved against the data directory (see CRISPRDataSet ddir),
+    and relative manifest files against the directory of the registry file.
+
+    """
+
+    REQUIRED_FIELDS = ["read_counts", "library", "plasmids"]
+
+    def register(self, key, manifest=None, manifests_dir=None, **kwargs):
+        """
+        Add (or replace) a data-set
+
+        :param key: str
+            Data-set name, e.g. as used in CRISPRDataSet(key)
+
+        :param manifest: dict, optional
+            Data-set description, fields can also be provided as keyword arguments
+
+        :param manifests_dir: str, optional
+            Directory of relative manifest files, defaults to MANIFESTS_DIR
+
+        :return: DataSetManifest
+        """
+        manifest = DataSetManifest(
+            {} if manifest is None else manifest, manifests_dir=manifests_dir, **kwargs
+        )
+
+        missing = [f for f in self.REQUIRED_FIELDS if f not in manifest]
+        assert len(missing) == 0, f"Data-set {key} missing fields: {missing}"
+
+        for f in ["exclude_guides", "exclude_samples"]:
+            if isinstance(dict.get(manifest, f), list):
+                dict.__setitem__(manifest, f, set(manifest[f]))
+
+        self[key] = manifest
+
+        return manifest
+
+    def register_file(self, path):
+        """
+        Register data-sets described in a YAML (.yaml/.yml, requires PyYAML) or JSON file
+
+        :param path: str
+
+        :return: list of registered data-set names
+        """
+        with open(path) as f:
+            if path.endswith((".yaml", ".yml")):
+                import yaml
+
+                datasets = yaml.safe_load(f)
+
+            else:
+                datasets = json.load(f)
+
+        manifests_dir = os.path.dirname(os.path.abspath(path))
+
+        for key, manifest in datasets.items():
+            self.register(
+                key,
+                manifest,
+                manifests_dir=manifest.pop("manifests_dir", manifests_dir),
+            )
+
+        LOG.info(f"#(data-sets)={len(datasets)} registered from {path}")
+
+        return list(datasets)
+
+
+DATASETS = DataSetRegistry(
+    {
+        "Yusa_v1": DataSetManifest(
+            name="Yusa v1",
+            read_counts="Yusa_v1_Score_readcount.csv.gz",
+            library="Yusa_v1.csv.gz",
+            plasmids=["ERS717283.plasmid"],
+            exclude_samples=dict(
+                file="project_score_all_qc_failed_samples.csv", column="sample"
+            ),
         ),
-    ),
-    "Yusa_v1.1": dict(
-        name="Yusa v1.1",
-        read_counts="Yusa_v1.1_Score_readcount.csv.gz",
-        library="Yusa_v1.1.csv.gz",
-        plasmids=["CRISPR_C6596666.sample"],
-        exclude_samples=set(
-            pd.read_csv(
-                f"{MANIFESTS_DIR}/project_score_exclude_samples.csv", header=None
-            )[0]
+        "Yusa_v1.1": DataSetManifest(
+            name="Yusa v1.1",
+            read_counts="Yusa_v1.1_Score_readcount.csv.gz",
+            library="Yusa_v1.1.csv.gz",
+            plasmids=["CRISPR_C6596666.sample"],
+            exclude_samples=dict(
+                file="project_score_exclude_samples.csv", header=None, column=0
+            ),
         ),
-    ),
-    "GeCKOv2": dict(
-        name="GeCKO v2",
-        read_counts="GeCKO2_Achilles_v3.3.8_readcounts.csv.gz",
-        library="GeCKO_v2.csv.gz",
-        plasmids=["pDNA_pXPR003_120K_20140624"],
-        exclude_guides=set(
-            pd.read_csv(
-                f"{MANIFESTS_DIR}/GeCKO2_Achilles_v3.3.8_dropped_guides.csv.gz"
-            )["sgRNA"]
+        "GeCKOv2": DataSetManifest(
+            name="GeCKO v2",
+            read_counts="GeCKO2_Achilles_v3.3.8_readcounts.csv.gz",
+            library="GeCKO_v2.csv.gz",
+            plasmids=["pDNA_pXPR003_120K_20140624"],
+            exclude_guides=dict(
+                file="GeCKO2_Achilles_v3.3.8_dropped_guides.csv.gz", column="sgRNA"
+            ),
         ),
-    ),
-    "Avana_DepMap19Q2": dict(
-        name="Avana DepMap19Q2",
-        read_counts="Avana_DepMap19Q2_readcount.csv.gz",
-        library="Avana_v1.csv.gz",
-        plasmids=pd.read_csv(
-            f"{MANIFESTS_DIR}/Avana_DepMap19Q2_sample_map.csv.gz", index_col="sample"
-        )["controls"].apply(lambda v: v.split(";")).to_dict(),
-        exclude_guides=set(
-            pd.read_csv(f"{MANIFESTS_DIR}/Avana_DepMap19Q2_dropped_guides.csv.gz")[
-                "guide"
-            ]
+        "Avana_DepMap19Q2": DataSetManifest(
+            name="Avana DepMap19Q2",
+            read_counts="Avana_DepMap19Q2_readcount.csv.gz",
+            library="Avana_v1.csv.gz",
+            plasmids=dict(
+                file="Avana_DepMap19Q2_sample_map.csv.gz",
+                index_col="sample",
+                column="controls",
+            ),
+            exclude_guides=dict(
+                file="Avana_DepMap19Q2_dropped_guides.csv.gz", column="guide"
+            ),
+        ),
+        "Avana_DepMap19Q3": DataSetManifest(
+            name="Avana DepMap19Q3",
+            read_counts="Avana_DepMap19Q3_readcount.csv.gz",
+            library="Avana_v1.csv.gz",
+            plasmids=dict(
+                file="Avana_DepMap19Q3_sample_map.csv.gz",
+                index_col="replicate_ID",
+                column="controls",
+            ),
+            exclude_guides=dict(
+                file="Avana_DepMap19Q3_dropped_guides.csv", index_col=0
+            ),
+        ),
+        "Avana_DepMap20Q1": DataSetManifest(
+            name="Avana DepMap20Q1",
+            read_counts="Avana_DepMap20Q1_readcount.csv.gz",
+            library="Avana_v1.csv.gz",
+            plasmids=dict(
+                file="Avana_DepMap20Q1_sample_map.csv.gz",
+                index_col="replicate_ID",
+                column="controls",
+            ),
+            exclude_guides=dict(
+                file="Avana_DepMap20Q1_dropped_guides.csv", index_col=0
+            ),
+        ),
+        "Avana_DepMap20Q2": DataSetManifest(
+            name="Avana DepMap20Q2",
+            read_counts="Avana_DepMap20Q2_readcount.csv.gz",
+            library="Avana_v1.csv.gz",
+            plasmids=dict(
+                file="Avana_DepMap20Q2_sample_map.csv.gz",
+                index_col="replicate_ID",
+                column="controls",
+            ),
+            exclude_guides=dict(
+                file="Avana_DepMap20Q2_dropped_guides.csv", index_col=0
+            ),
+        ),
+        "Sabatini_Lander_AML": DataSetManifest(
+            name="Sabatini Lander AML",
+            read_counts="Sabatini_Lander_v2_AML_readcounts.csv.gz",
+            library="Sabatini_Lander_v3.csv.gz",
+            plasmids={
+                "P31/FUJ-final": ["P31/FUJ-initial"],
+                "NB4 (replicate A)-final": ["NB4-initial"],
+                "NB4 (replicate B)-final": ["NB4-initial"],
+                "OCI-AML2-final": ["OCI-AML2-initial"],
+                "OCI-AML3-final": ["OCI-AML3-initial"],
+                "SKM-1-final": ["SKM-1-initial"],
+                "EOL-1-final": ["EOL-1-initial"],
+                "HEL-final": ["HEL-initial"],
+                "Molm-13-final": ["Molm-13-initial"],
+                "MonoMac1-final": ["MonoMac1-initial"],
+                "MV4;11-final": ["MV4;11-initial"],
+                "PL-21-final": ["PL-21-initial"],
+                "OCI-AML5-final": ["OCI-AML5-initial"],
+            },
+        ),
+        "Brunello_A375": DataSetManifest(
+            name="Brunello A375",
+            read_counts="Brunello_A375_readcount.csv.gz",
+            library="Brunello_v1.csv.gz",
+            plasmids={
+                "orig_tracr_A375_RepA": ["orig_tracr_A375_pDNA"],
+                "orig_tracr_A375_RepB": ["orig_tracr_A375_pDNA"],
+                "mod_tracr_A375_RepA": ["mod_tracr_A375_pDNA"],
+                "mod_tracr_A375_RepB": ["mod_tracr_A375_pDNA"],
+                "mod_tracr_A375_RepC": ["mod_tracr_A375_pDNA"],
+            },
         ),
-    ),
-    "Avana_DepMap19Q3": dict(
-        name="Avana DepMap19Q3",
-        read_counts="Avana_DepMap19Q3_readcount.csv.gz",
-        library="Avana_v1.csv.gz",
-        plasmids=pd.read_csv(
-            f"{MANIFESTS_DIR}/Avana_DepMap19Q3_sample_map.csv.gz",
-            index_col="replicate_ID",
-        )["controls"]
-        .apply(lambda v: v.split(";"))
-        .to_dict(),
-        exclude_guides=set(
-            pd.read_csv(
-                f"{MANIFESTS_DIR}/Avana_DepMap19Q3_dropped_guides.csv", index_col=0
-            ).index
+        "HT29_Dabraf": DataSetManifest(
+            name="HT-29 Dabrafenib CRISPR",
+            read_counts="Yusa_v1.1_HT29_dabraf.csv.gz",
+            library="Yusa_v1.1.csv.gz",
+            plasmids=["Plasmid_v1.1"],
+            exclude_guides={
+                "DHRSX_CCDS35195.1_ex1_X:2161152-2161175:+_3-1",
+                "DHRSX_CCDS35195.1_ex6_Y:2368915-2368938:+_3-3",
+                "DHRSX_CCDS35195.1_ex4_X:2326777-2326800:+_3-2",
+                "sgPOLR2K_1",
+            },
         ),
-    ),
-    "Avana_DepMap20Q1": dict(
-        name="Avana DepMap20Q1",
-        read_counts="Avana_DepMap20Q1_readcount.csv.gz",
-        library="Avana_v1.csv.gz",
-        plasmids=pd.read_csv(
-            f"{MANIFESTS_DIR}/Avana_DepMap20Q1_sample_map.csv.gz",
-            index_col="replicate_ID",
-        )["controls"]
-        .apply(lambda v: v.split(";"))
-        .to_dict(),
-        exclude_guides=set(
-            pd.read_csv(
-                f"{MANIFESTS_DIR}/Avana_DepMap20Q1_dropped_guides.csv", index_col=0
-            ).index
+        "Organoids": DataSetManifest(
+            name="Organoids",
+            read_counts="Yusa_v1.1_organoids.csv.gz",
+            library="Yusa_v1.1.csv.gz",
+            plasmids=["Plasmid_v1.1"],
+            exclude_guides={
+                "DHRSX_CCDS35195.1_ex1_X:2161152-2161175:+_3-1",
+                "DHRSX_CCDS35195.1_ex6_Y:2368915-2368938:+_3-3",
+                "DHRSX_CCDS35195.1_ex4_X:2326777-2326800:+_3-2",
+                "sgPOLR2K_1",
+            },
         ),
-    ),
-    "Avana_DepMap20Q2": dict(
-        name="Avana DepMap20Q2",
-        read_counts="Avana_DepMap20Q2_readcount.csv.gz",
-        library="Avana_v1.csv.gz",
-        plasmids=pd.read_csv(
-            f"{MANIFESTS_DIR}/Avana_DepMap20Q2_sample_map.csv.gz",
-            index_col="replicate_ID",
-        )["controls"]
-        .apply(lambda v: v.split(";"))
-        .to_dict(),
-        exclude_guides=set(
-            pd.read_csv(
-                f"{MANIFESTS_DIR}/Avana_DepMap20Q2_dropped_guides.csv", index_col=0
-            ).index
+        "KM12_coverage": DataSetManifest(
+            name="KM12 coverage",
+            read_counts="KM12_coverage.csv.gz",
+            library="Yusa_v1.1.csv.gz",
+            plasmids=dict(
+                file="KM12_coverage_samplesheet.xlsx",
+                index_col="sample",
+                column="plasmid",
+            ),
+            exclude_guides={
+                "DHRSX_CCDS35195.1_ex1_X:2161152-2161175:+_3-1",
+                "DHRSX_CCDS35195.1_ex6_Y:2368915-2368938:+_3-3",
+                "DHRSX_CCDS35195.1_ex4_X:2326777-2326800:+_3-2",
+                "sgPOLR2K_1",
+            },
         ),
-    ),
-    "Sabatini_Lander_AML": dict(
-        name="Sabatini Lander AML",
-        read_counts="Sabatini_Lander_v2_AML_readcounts.csv.gz",
-        library="Sabatini_Lander_v3.csv.gz",
-        plasmids={
-            "P31/FUJ-final": ["P31/FUJ-initial"],
-            "NB4 (replicate A)-final": ["NB4-initial"],
-            "NB4 (replicate B)-final": ["NB4-initial"],
-            "OCI-AML2-final": ["OCI-AML2-initial"],
-            "OCI-AML3-final": ["OCI-AML3-initial"],
-            "SKM-1-final": ["SKM-1-initial"],
-            "EOL-1-final": ["EOL-1-initial"],
-            "HEL-final": ["HEL-initial"],
-            "Molm-13-final": ["Molm-13-initial"],
-            "MonoMac1-final": ["MonoMac1-initial"],
-            "MV4;11-final": ["MV4;11-initial"],
-            "PL-21-final": ["PL-21-initial"],
-            "OCI-AML5-final": ["OCI-AML5-initial"],
-        },
-    ),
-    "Brunello_A375": dict(
-        name="Brunello A375",
-        read_counts="Brunello_A375_readcount.csv.gz",
-        library="Brunello_v1.csv.gz",
-        plasmids={
-            "orig_tracr_A375_RepA": ["orig_tracr_A375_pDNA"],
-            "orig_tracr_A375_RepB": ["orig_tracr_A375_pDNA"],
-            "mod_tracr_A375_RepA": ["mod_tracr_A375_pDNA"],
-            "mod_tracr_A375_RepB": ["mod_tracr_A375_pDNA"],
-            "mod_tracr_A375_RepC": ["mod_tracr_A375_pDNA"],
-        },
-    ),
-    "HT29_Dabraf": dict(
-        name="HT-29 Dabrafenib CRISPR",
-        read_counts="Yusa_v1.1_HT29_dabraf.csv.gz",
-        library="Yusa_v1.1.csv.gz",
-        plasmids=["Plasmid_v1.1"],
-        exclude_guides={
-            "DHRSX_CCDS35195.1_ex1_X:2161152-2161175:+_3-1",
-            "DHRSX_CCDS35195.1_ex6_Y:2368915-2368938:+_3-3",
-            "DHRSX_CCDS35195.1_ex4_X:2326777-2326800:+_3-2",
-            "sgPOLR2K_1",
-        },
-    ),
-    "Organoids": dict(
-        name="Organoids",
-        read_counts="Yusa_v1.1_organoids.csv.gz",
-        library="Yusa_v1.1.csv.gz",
-        plasmids=["Plasmid_v1.1"],
-        exclude_guides={
-            "DHRSX_CCDS35195.1_ex1_X:2161152-2161175:+_3-1",
-            "DHRSX_CCDS35195.1_ex6_Y:2368915-2368938:+_3-3",
-            "DHRSX_CCDS35195.1_ex4_X:2326777-2326800:+_3-2",
-            "sgPOLR2K_1",
-        },
-    ),
-    "KM12_coverage": dict(
-        name="KM12 coverage",
-        read_counts="KM12_coverage.csv.gz",
-        library="Yusa_v1.1.csv.gz",
-        plasmids=pd.read_excel(
-            f"{MANIFESTS_DIR}/KM12_coverage_samplesheet.xlsx", index_col="sample"
-        )["plasmid"].apply(lambda v: v.split(";")).to_dict(),
-        exclude_guides={
-            "DHRSX_CCDS35195.1_ex1_X:2161152-2161175:+_3-1",
-            "DHRSX_CCDS35195.1_ex6_Y:2368915-2368938:+_3-3",
-            "DHRSX_CCDS35195.1_ex4_X:2326777-2326800:+_3-2",
-            "sgPOLR2K_1",
-        },
-    ),
-}
+    }
+)
 
 
 class Library:
     @staticmethod
     def load_library(lib_file, set_index=True, remove_dup=False, sep=","):
-        lib_path = f"{LIBS_DIR}/{lib_file}"
+        lib_path = os.path.join(LIBS_DIR, lib_file)
 
         assert os.path.exists(lib_path), f"CRISPR library {lib_file} not supported"
 
@@ -201,6 +351,48 @@ class Library:
 
         return clib
 
+    @staticmethod
+    def load_guide_index(
+        lib_file, cache_dir=None, chr_col="Chr", start_col="Start", end_col="End"
+    ):
+        """
+        sgRNAs genomic coordinates index of a CRISPR library (see crispy.Intervals.IntervalIndex),
+        e.g. to be shared by Crispy across samples. The index is stored as a .npz file in cache_dir
+        keyed by the hash of the library file, and only rebuilt if the library changes.
+
+        :param lib_file: str
+            CRISPR library file, e.g. "MinLibCas9.csv.gz"
+
+        :param cache_dir: str, optional
+            Defaults to Utils.CACHE_DIR
+
+        :return: crispy.Intervals.IntervalIndex
+        """
+        lib_path = f"{LIBS_DIR}/{lib_file}"
+
+        assert os.path.exists(lib_path), f"CRISPR library {lib_file} not supported"
+
+        cache_dir = f"{Utils.CACHE_DIR}/guide_index" if cache_dir is None else cache_dir
+
+        lib_key = Utils.file_hash(lib_path)[:16]
+        index_file = (
+            f"{cache_dir}/{lib_file}.{chr_col}_{start_col}_{end_col}.{lib_key}.npz"
+        )
+
+        if os.path.exists(index_file):
+            return IntervalIndex.load(index_file)
+
+        LOG.info(f"Building sgRNAs index {lib_file}")
+
+        index = IntervalIndex.from_frame(
+            Library.load_library(lib_file), chr_col, start_col, end_col
+        )
+
+        os.makedirs(cache_dir, exist_ok=True)
+        index.save(index_file)
+
+        return index
+
     @staticmethod
     def load_library_sgrnas(verbose=0):
         lib_files = os.listdir(LIBS_DIR)
@@ -226,6 +418,115 @@ class Library:
         return sgrnas
 
 
+class GuideGeneMap:
+    """
+    Sparse sgRNA x gene map of a CRISPR library (scipy.sparse CSR matrix), to aggregate sgRNA
+    level data (e.g. fold-changes) into gene level for all samples at once, as a replacement of
+    fc.groupby(lib["Gene"]).mean(). sgRNAs targeting multiple genes (i.e. with multiple rows in
+    the library) contribute to each of their genes, and missing values are ignored.
+
+    """
+
+    AGG_FUNCTIONS = ["mean", "median", "sum"]
+
+    def __init__(self, library, gene_col="Gene"):
+        """
+        :param library: pandas.DataFrame
+            CRISPR library indexed by sgRNA ID, e.g. Library.load_library
+
+        :param gene_col: str
+            Gene column, e.g. "Gene" or "Approved_Symbol"
+        """
+        from scipy.sparse import csr_matrix
+
+        pairs = library[gene_col].dropna()
+        pairs = pairs[~pd.Series(list(zip(pairs.index, pairs))).duplicated().values]
+
+        self.guides = pd.Index(pairs.index.unique())
+        self.genes = pd.Index(np.unique(pairs.values.astype(str)))
+
+        self.matrix = csr_matrix(
+            (
+                np.ones(len(pairs)),
+                (
+                    self.guides.get_indexer(pairs.index),
+                    self.genes.get_indexer(pairs.values.astype(str)),
+                ),
+            ),
+            shape=(len(self.guides), len(self.genes)),
+        )
+
+    @classmethod
+    def from_library_file(cls, lib_file, gene_col="Gene"):
+        """
+        :param lib_file: str
+            CRISPR library file, e.g. "Yusa_v1.1.csv.gz"
+
+        :return: GuideGeneMap
+        """
+        return cls(Library.load_library(lib_file), gene_col=gene_col)
+
+    def aggregate(self, data, agg="mean"):
+        """
+        Aggregate sgRNA level data into genes. sgRNAs not in the library are ignored, and genes
+        without sgRNAs in data are dropped (as in DataFrame.groupby).
+
+        :param data: pandas.DataFrame or pandas.Series
+            sgRNAs (rows) values of the samples (columns)
+
+        :param agg: str
+            Aggregation function, one of AGG_FUNCTIONS. Mean and sum are computed with a sparse
+            product, median by sorting the values of each gene
+
+        :return: pandas.DataFrame or pandas.Series
+            Genes (rows) values of the samples (columns)
+        """
+        assert (
+            agg in self.AGG_FUNCTIONS
+        ), f"Aggregation {agg} not supported: {self.AGG_FUNCTIONS}"
+
+        if isinstance(data, pd.Series):
+            return self.aggregate(data.to_frame(), agg=agg).iloc[:, 0]
+
+        # Genes x data sgRNAs map, sgRNAs not in the library map to no genes
+        rows = self.guides.get_indexer(data.index)
+        found = rows != -1
+
+        matrix = self.matrix[np.where(found, rows, 0)].multiply(found[:, None])
+        matrix = matrix.T.tocsr()
+        matrix.eliminate_zeros()
+
+        values = np.ascontiguousarray(data.values, dtype=np.float64)
+        nans = np.isnan(values)
+
+        n_guides = np.diff(matrix.indptr)
+        genes = n_guides > 0
+
+        if agg == "median":
+            # Values of each gene (multi-gene sgRNAs repeated), grouped by gene position
+            res = (
+                pd.DataFrame(values[matrix.indices])
+                .groupby(np.repeat(np.arange(matrix.shape[0]), n_guides))
+                .median()
+                .values
+            )
+
+        elif not nans.any():
+            res = (matrix @ values)[genes]
+
+            if agg == "mean":
+                res /= n_guides[genes, None]
+
+        else:
+            res = (matrix @ np.where(nans, 0, values))[genes]
+
+            if agg == "mean":
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    res /= (matrix @ (~nans).astype(np.float64))[genes]
+
+        return pd.DataFrame(res, index=self.genes[genes], columns=data.columns)
+
+
 class ReadCounts(DataFrame):
     PSEUDO_COUNT = 1
 
@@ -236,6 +537,133 @@ class ReadCounts(DataFrame):
     def _constructor(self):
         return ReadCounts
 
+    @classmethod
+    def read_csv(
+        cls,
+        path,
+        samples=None,
+        exclude_samples=None,
+        exclude_guides=None,
+        dtype=np.uint32,
+        chunksize=10000,
+        sep=",",
+    ):
+        """
+        Streaming loader of a read counts matrix (sgRNAs in rows, samples in columns). Only the
+        selected samples are parsed, excluded sgRNAs are dropped chunk by chunk and counts are
+        stored with dtype, so the full matrix is never materialised as float64 (unless integer
+        counts are not supported, see dtype).
+
+        :param path: str
+            Read counts file, e.g. csv.gz, with the sgRNA IDs in the first column
+
+        :param samples: list, optional
+            Samples (columns) to load, all if None
+
+        :param exclude_samples: list or set, optional
+
+        :param exclude_guides: list or set, optional
+
+        :param dtype: numpy.dtype
+            Counts dtype. With an integer dtype, if the counts have missing, non-integer or out
+            of range values, all counts are stored as float64 instead (with a warning naming the
+            file and the first such sample)
+
+        :param chunksize: int
+            Number of rows parsed at a time
+
+        :return: ReadCounts
+        """
+        header = pd.read_csv(path, sep=sep, index_col=0, nrows=0).columns
+
+        if samples is None:
+            samples = list(header)
+
+        else:
+            missing = set(samples).difference(header)
+            assert len(missing) == 0, f"Samples not in read counts: {missing}"
+
+        if exclude_samples is not None:
+            exclude_samples = set(exclude_samples)
+            samples = [s for s in samples if s not in exclude_samples]
+
+        exclude_guides = set() if exclude_guides is None else set(exclude_guides)
+
+        usecols = [0] + [header.get_loc(s) + 1 for s in samples]
+
+        # Integer counts are parsed as float64 chunk by chunk and downcast if possible
+        integer = np.issubdtype(np.dtype(dtype), np.integer)
+
+        reader = pd.read_csv(
+            path,
+            sep=sep,
+            index_col=0,
+            usecols=usecols,
+            dtype=dict.fromkeys(samples, np.float64 if integer else dtype),
+            chunksize=chunksize,
+        )
+
+        chunks, as_float = [], False
+
+        for chunk in reader:
+            chunk = chunk.loc[~chunk.index.isin(exclude_guides), samples]
+
+            if integer and not as_float:
+                values, info = chunk.values, np.iinfo(dtype)
+
+                invalid = (
+                    np.isnan(values)
+                    | (values != np.round(values))
+                    | (values < info.min)
+                    | (values > info.max)
+                )
+
+                if invalid.any():
+                    LOG.warning(
+                        f"{path}: missing, non-integer or out of range counts in "
+                        f"{samples[np.flatnonzero(invalid.any(0))[0]]}, counts stored as "
+                        f"float64 instead of {np.dtype(dtype)}"
+                    )
+                    as_float = True
+
+                else:
+                    chunk = chunk.astype(dtype)
+
+            chunks.append(chunk)
+
+        counts = pd.concat(chunks)
+
+        if as_float:
+            counts = counts.astype(np.float64)
+
+        return cls(data=counts)
+
+    @classmethod
+    def from_store(cls, path, samples=None):
+        """
+        Open read counts stored with to_store (see crispy.CountStore.CountStore), memory-mapped and
+        without copying the counts (only the selected samples are read if samples is defined)
+
+        :param path: str
+            Count store directory
+
+        :param samples: list, optional
+
+        :return: ReadCounts
+        """
+        return cls(data=CountStore(path).open(samples))
+
+    def to_store(self, path, dtype=np.uint32):
+        """
+        Write read counts to a count store (see crispy.CountStore.CountStore)
+
+        :param path: str
+            Count store directory
+
+        :return: crispy.CountStore.CountStore
+        """
+        return CountStore.create(path, self, dtype=dtype)
+
     def norm_rpm(self, scale=1e6):
         factors = self.sum() / scale
         return self.divide(factors)
@@ -245,68 +673,212 @@ class ReadCounts(DataFrame):
         return self.divide(factors)
 
     def norm_gmean(self):
+        import scipy.stats as st
+
         sgrna_gmean = st.gmean(self, axis=1)
         factors = self.divide(sgrna_gmean, axis=0).median()
         return self.divide(factors)
 
-    def foldchange(self, controls):
+    def foldchange(self, controls, dtype=None):
+        """
+        Log2 fold-changes of the samples against the mean of their controls (e.g. plasmids), with a
+        pseudo-count added to the read counts.
+
+        :param controls: list or dict
+            Controls shared by all samples (list, controls are dropped from the output), or
+            controls of each sample (dict, output restricted to its samples). With a dict, the
+            mean of each distinct set of controls is computed only once.
+
+        :param dtype: numpy.dtype, optional
+            Compute fold-changes in place in a single array of dtype (e.g. numpy.float32),
+            defaults to float64
+
+        :return: pandas.DataFrame
+        """
         if type(controls) == dict:
-            fc = self.add(self.PSEUDO_COUNT)
-            fc = pd.DataFrame(
-                {
-                    c: fc[c].divide(fc[controls[c]].mean(1), axis=0)
-                    for c in controls
-                    if c in fc
-                }
-            )
-            fc = fc.apply(np.log2)
+            samples = [c for c in controls if c in self]
+
+            # Mean of each distinct set of controls (pseudo-counts included)
+            groups = {}
+            codes = [
+                groups.setdefault(tuple(controls[c]), len(groups)) for c in samples
+            ]
+
+            means = np.zeros((self.shape[0], len(groups)))
+
+            for g, i in groups.items():
+                means[:, i] = self[list(g)].add(self.PSEUDO_COUNT).mean(1).values
+
+            constructor = pd.DataFrame
 
         else:
-            fc = (
-                self.add(self.PSEUDO_COUNT)
-                .divide(self[controls].mean(1), axis=0)
-                .drop(controls, axis=1)
-                .apply(np.log2)
-            )
+            exclude = set(controls)
+            samples = [c for c in self if c not in exclude]
 
-        return fc
+            means = self[controls].mean(1).values[:, None]
+            codes = np.zeros(len(samples), dtype=int)
 
-    def remove_low_counts(self, controls, counts_threshold=30):
-        return self[self[controls].mean(1) >= counts_threshold]
+            constructor = self._constructor
 
-    def scale(self, essential=None, non_essential=None, metric=np.median):
-        if essential is None:
-            essential = Utils.get_essential_genes(return_series=False)
+        fc = self.values[:, self.columns.get_indexer(samples)].astype(
+            np.float64 if dtype is None else dtype, copy=False
+        )
 
-        if non_essential is None:
-            non_essential = Utils.get_non_essential_genes(return_series=False)
+        # Gather the controls mean of each sample, broadcast if all share the same controls
+        means = means.astype(fc.dtype, copy=False)
 
-        assert (
-            len(essential.intersection(self.index)) != 0
-        ), "DataFrame has no index overlapping with essential list"
+        fc += self.PSEUDO_COUNT
+        fc /= means if means.shape[1] == 1 else means[:, codes]
+        np.log2(fc, out=fc)
+
+        return constructor(fc, index=self.index, columns=samples)
+
+    NORM_METHODS = [None, "rpm", "mean"]
+
+    def to_foldchange(self, controls, norm="rpm", min_count=30, dtype=np.float32):
+        """
+        Fused equivalent of remove_low_counts(controls, min_count), norm_rpm() (or norm_mean())
+        and foldchange(controls). sgRNAs are filtered, normalised and divided by the controls mean
+        in one pass over the samples, writing only into the output array, instead of allocating a
+        data-frame at each step.
+
+        :param controls: list or dict
+            Controls shared by all samples or of each sample, see foldchange. Low counts are
+            filtered by the mean of all the controls
 
+        :param norm: str, optional
+            Normalisation, one of NORM_METHODS. None skips normalisation
+
+        :param min_count: float, optional
+            Minimum mean read count of the controls, None skips the filter
+
+        :param dtype: numpy.dtype
+            Fold-changes dtype
+
+        :return: pandas.DataFrame
+        """
         assert (
-            len(non_essential.intersection(self.index)) != 0
-        ), "DataFrame has no index overlapping with non essential list"
+            norm in self.NORM_METHODS
+        ), f"Normalisation {norm} not supported: {self.NORM_METHODS}"
 
-        essential_metric = metric(self.reindex(essential).dropna(), axis=0)
-        non_essential_metric = metric(self.reindex(non_essential).dropna(), axis=0)
+        values = self.values
 
-        return self.subtract(non_essential_metric).divide(
-            non_essential_metric - essential_metric
-        )
+        # Samples and controls positions
+        if type(controls) == dict:
+            samples = [c for c in controls if c in self]
+            groups = {}
+            codes = [
+                groups.setdefault(tuple(controls[c]), len(groups)) for c in samples
+            ]
+            pseudo_count = self.PSEUDO_COUNT
+            constructor = pd.DataFrame
+
+        else:
+            exclude = set(controls)
+            samples = [c for c in self if c not in exclude]
+            groups = {tuple(controls): 0}
+            codes = [0] * len(samples)
+            pseudo_count = 0
+            constructor = self._constructor
+
+        groups = [self.columns.get_indexer(list(g)) for g in groups]
+        samples_idx = self.columns.get_indexer(samples)
+
+        # Remove low counts
+        if min_count is not None:
+            controls_idx = np.unique(np.concatenate(groups))
+            mask = values[:, controls_idx].mean(1) >= min_count
+
+        else:
+            mask = np.ones(values.shape[0], dtype=bool)
+
+        # Normalisation factors
+        if norm is None:
+            factors = np.ones(values.shape[1])
+
+        else:
+            sums = values.sum(axis=0, where=mask[:, None], dtype=np.float64)
+            factors = sums / 1e6 if norm == "rpm" else sums.mean() / sums
+
+        # Controls mean of normalised counts
+        means = np.zeros((mask.sum(), len(groups)))
+
+        for k, g in enumerate(groups):
+            means[:, k] = (values[np.ix_(mask, g)] / factors[g]).mean(1) + pseudo_count
+
+        # Fold-changes, computed sample by sample in the (column-major) output array
+        fc = np.empty((mask.sum(), len(samples)), dtype=dtype, order="F")
+
+        for j, (i, g) in enumerate(zip(samples_idx, codes)):
+            np.divide(values[mask, i], factors[i], out=fc[:, j], casting="unsafe")
+            fc[:, j] += self.PSEUDO_COUNT
+            fc[:, j] /= means[:, g]
+            np.log2(fc[:, j], out=fc[:, j])
+
+        return constructor(fc, index=self.index[mask], columns=samples)
+
+    def remove_low_counts(self, controls, counts_threshold=30):
+        return self[self[controls].mean(1) >= counts_threshold]
+
+    def scale(self, essential=None, non_essential=None, metric=np.median):
+        """
+        Scale fold-changes by the essential (-1) and non-essential (0) genes medians, see
+        GeneSetScaler to reuse the gene set positions across calls.
+
+        :return: ReadCounts
+        """
+        return GeneSetScaler(
+            self.index, essential=essential, non_essential=non_essential, metric=metric
+        ).transform(self)
 
 
 class CRISPRDataSet:
-    def __init__(self, dataset, ddir=None, exclude_samples=None, exclude_guides=None):
+    def __init__(
+        self,
+        dataset,
+        ddir=None,
+        exclude_samples=None,
+        exclude_guides=None,
+        samples=None,
+        dtype=np.uint32,
+        store=None,
+    ):
+        """
+        :param dataset: str or dict
+            Data-set name (see DATASETS) or description (see DataSetManifest)
+
+        :param ddir: str, optional
+            Read counts directory, defaults to DATA_DIR
+
+        :param exclude_samples: list, optional
+            Samples to exclude, defaults to the data-set exclude_samples
+
+        :param exclude_guides: list, optional
+            sgRNAs to exclude, defaults to the data-set exclude_guides
+
+        :param samples: list, optional
+            Samples to load, together with their plasmids, all if None
+
+        :param dtype: numpy.dtype
+            Read counts dtype, float64 if the counts are not integers (see ReadCounts.read_csv)
+
+        :param store: str, optional
+            Count store directory of the data-set (see ReadCounts.to_store), opened memory-mapped
+            instead of parsing the read counts file
+
+        """
         # Load data-set dict
-        if type(dataset) is dict:
-            self.dataset_dict = dataset
+        if isinstance(dataset, dict):
+            self.dataset_dict = (
+                dataset
+                if isinstance(dataset, DataSetManifest)
+                else DataSetManifest(dataset)
+            )
 
         else:
             assert (
                 dataset in DATASETS
-            ), f"CRISPR data-set {dataset} not supported: {DATASETS}"
+            ), f"CRISPR data-set {dataset} not supported: {list(DATASETS)}"
 
             self.dataset_dict = DATASETS[dataset]
 
@@ -317,40 +889,68 @@ class CRISPRDataSet:
 
         self.lib = Library.load_library(self.dataset_dict["library"])
 
-        data = pd.read_csv(
-            f"{self.ddir}/{self.dataset_dict['read_counts']}", index_col=0
-        )
+        # Samples and sgRNAs exclusions
+        if exclude_samples is None:
+            exclude_samples = self.dataset_dict.get("exclude_samples")
 
-        # Drop excluded samples
         if exclude_samples is not None:
-            data = data.drop(exclude_samples, axis=1, errors="ignore")
             LOG.info(f"#(samples)={len(exclude_samples)} excluded")
 
-        elif "exclude_samples" in self.dataset_dict:
-            data = data.drop(
-                self.dataset_dict["exclude_samples"], axis=1, errors="ignore"
-            )
-            LOG.info(f"#(samples)={len(self.dataset_dict['exclude_samples'])} excluded")
+        if exclude_guides is None:
+            exclude_guides = self.dataset_dict.get("exclude_guides")
 
-        # Drop excluded guides
         if exclude_guides is not None:
-            data = data.drop(exclude_guides, axis=0, errors="ignore")
             self.lib = self.lib.drop(exclude_guides, axis=0, errors="ignore")
             LOG.info(f"#(guides)={len(exclude_guides)} excluded")
 
-        elif "exclude_guides" in self.dataset_dict:
-            data = data.drop(
-                self.dataset_dict["exclude_guides"], axis=0, errors="ignore"
-            )
-            self.lib = self.lib.drop(
-                self.dataset_dict["exclude_guides"], axis=0, errors="ignore"
+        # Samples subset and their plasmids
+        if samples is not None:
+            if type(self.plasmids) is dict:
+                controls = {c for s in samples for c in self.plasmids.get(s, [])}
+
+            else:
+                controls = set(self.plasmids)
+
+            samples = list(samples) + [c for c in controls if c not in samples]
+
+        if store is not None:
+            self.counts = self.open_store(
+                store, samples, exclude_samples, exclude_guides
             )
-            LOG.info(f"#(guides)={len(self.dataset_dict['exclude_guides'])} excluded")
 
-        self.counts = ReadCounts(data=data)
+        else:
+            self.counts = ReadCounts.read_csv(
+                os.path.join(self.ddir, self.dataset_dict["read_counts"]),
+                samples=samples,
+                exclude_samples=exclude_samples,
+                exclude_guides=exclude_guides,
+                dtype=dtype,
+            )
 
         LOG.info(f"#(sgRNAs)={self.lib.shape[0]}")
         LOG.info(f"#(samples)={self.counts.shape[1]}")
 
+    @staticmethod
+    def open_store(store, samples=None, exclude_samples=None, exclude_guides=None):
+        """
+        Open read counts from a count store applying samples selection and exclusions. Without
+        sgRNAs exclusions the counts are not copied from the memory-mapped store.
+
+        :return: ReadCounts
+        """
+        if samples is None:
+            samples = list(CountStore(store).samples)
+
+        if exclude_samples is not None:
+            exclude_samples = set(exclude_samples)
+            samples = [s for s in samples if s not in exclude_samples]
+
+        counts = ReadCounts.from_store(store, samples=samples)
+
+        if exclude_guides is not None and counts.index.isin(exclude_guides).any():
+            counts = counts[~counts.index.isin(exclude_guides)]
+
+        return counts
+
     def get_plasmids_counts(self):
         return self.counts[self.plasmids]
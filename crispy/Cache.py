@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# Copyright (C) 2019 Emanuel Goncalves
+
+import os
+import glob
+import time
+import pickle
+import logging
+import hashlib
+import functools
+import importlib
+import pandas as pd
+from crispy.Utils import Utils
+
+LOG = logging.getLogger("Crispy")
+
+
+class TableCache:
+    """
+    Transparent on-disk cache of tables parsed from text/Excel files (e.g. pd.read_csv). Parsed
+    data-frames are stored in a columnar binary format (Parquet, if pyarrow or fastparquet are
+    installed) keyed by the source file path, version and the reader arguments. Tables Parquet
+    can not store exactly (e.g. non-string column labels, mixed type columns), checked when the
+    entry is written, are stored with pickle instead.
+
+    The source file version is its modification time and size or, with content_hash, a hash of
+    its content. Without content_hash, files modified less than RACY_SECONDS before being read
+    are not cached, since a rewrite with the same size within the file system timestamp
+    resolution would not be detected. Changing the source file invalidates its entries, and
+    entries can also be removed explicitly with invalidate or clear. Entries that can not be read
+    (e.g. truncated) are removed and the source file parsed again, cache errors are logged and
+    never raised.
+
+    """
+
+    FORMATS = ["parquet", "pkl"]
+
+    RACY_SECONDS = 2
+
+    def __init__(self, cache_dir=None, enabled=None, content_hash=None):
+        """
+        :param cache_dir: str, optional
+            Defaults to Utils.CACHE_DIR/tables
+
+        :param enabled: bool, optional
+            Defaults to True unless the environment variable CRISPY_TABLE_CACHE is "0"
+
+        :param content_hash: bool, optional
+            Key entries by the source file content hash instead of modification time and size.
+            Defaults to True if the environment variable CRISPY_TABLE_CACHE_HASH is "1"
+
+        """
+        self.cache_dir = (
+            os.path.join(Utils.CACHE_DIR, "tables") if cache_dir is None else cache_dir
+        )
+
+        self.enabled = (
+            os.environ.get("CRISPY_TABLE_CACHE", "1") != "0"
+            if enabled is None
+            else enabled
+        )
+
+        self.content_hash = (
+            os.environ.get("CRISPY_TABLE_CACHE_HASH", "0") == "1"
+            if content_hash is None
+            else content_hash
+        )
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def parquet_engine():
+        """
+        Installed Parquet engine, None if neither pyarrow nor fastparquet can be imported
+
+        :return: str
+        """
+        for engine in ["pyarrow", "fastparquet"]:
+            try:
+                importlib.import_module(engine)
+                return engine
+
+            except ImportError:
+                continue
+
+        return None
+
+    @staticmethod
+    def path_key(path):
+        return hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+
+    @staticmethod
+    def stat_key(path):
+        stat = os.stat(path)
+        return hashlib.sha1(f"{stat.st_mtime_ns}:{stat.st_size}".encode()).hexdigest()[
+            :8
+        ]
+
+    @staticmethod
+    def content_key(path, block_size=2 ** 20):
+        h = hashlib.sha1()
+
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                h.update(block)
+
+        return h.hexdigest()[:16]
+
+    def version_key(self, path):
+        return self.content_key(path) if self.content_hash else self.stat_key(path)
+
+    def entry_file(self, reader, path, kwargs, fmt="parquet", version=None):
+        """
+        Cache entry of a file read with reader and kwargs
+
+        :return: str
+        """
+        args_key = hashlib.sha1(
+            repr((reader.__name__, sorted(kwargs.items()))).encode()
+        ).hexdigest()[:16]
+
+        version = self.version_key(path) if version is None else version
+
+        return os.path.join(
+            self.cache_dir, f"{self.path_key(path)}.{version}.{args_key}.{fmt}"
+        )
+
+    def read_entry(self, entry, fmt=None):
+        fmt = entry.rsplit(".", 1)[-1] if fmt is None else fmt
+
+        if fmt == "parquet":
+            return pd.read_parquet(entry, engine=self.parquet_engine())
+
+        with open(entry, "rb") as f:
+            return pickle.load(f)
+
+    def write_entry(self, entry, df):
+        """
+        Write df to entry (Parquet) if stored exactly, otherwise to its pickle entry
+
+        :return: str
+            Entry written
+        """
+        tmp = f"{entry}.{os.getpid()}.tmp"
+
+        if self.parquet_engine() is not None:
+            try:
+                df.to_parquet(tmp, engine=self.parquet_engine())
+
+                if self.read_entry(tmp, "parquet").equals(df):
+                    os.replace(tmp, entry)
+                    return entry
+
+            except Exception as e:
+                LOG.debug(f"Table cache Parquet entry not written: {e}")
+
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        entry = f"{os.path.splitext(entry)[0]}.pkl"
+
+        try:
+            with open(tmp, "wb") as f:
+                pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+            os.replace(tmp, entry)
+
+        finally:
+            self.remove_entry(tmp)
+
+        return entry
+
+    @staticmethod
+    def remove_entry(entry):
+        try:
+            os.remove(entry)
+
+        except FileNotFoundError:
+            pass
+
+    def read(self, reader, path, **kwargs):
+        """
+        Read table with reader (e.g. pd.read_csv) using the cached copy if up-to-date
+
+        :param reader: callable
+            Parser called as reader(path, **kwargs)
+
+        :param path: str
+            Source file
+
+        :return: pandas.DataFrame
+        """
+        if not self.enabled:
+            return reader(path, **kwargs)
+
+        version = self.version_key(path)
+
+        for fmt in self.FORMATS:
+            entry = self.entry_file(reader, path, kwargs, fmt, version)
+
+            if os.path.exists(entry):
+                try:
+                    return self.read_entry(entry)
+
+                except Exception as e:
+                    LOG.warning(f"Table cache entry {entry} not read, removed: {e}")
+                    self.remove_entry(entry)
+
+        df = reader(path, **kwargs)
+
+        racy = time.time() - os.stat(path).st_mtime < self.RACY_SECONDS
+
+        if racy and not self.content_hash:
+            LOG.debug(f"Table cache not written for recently modified {path}")
+            return df
+
+        try:
+            # Remove entries of previous versions of the source file
+            self.invalidate(path, stale_only=True, version=version)
+
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+            self.write_entry(self.entry_file(reader, path, kwargs, version=version), df)
+
+        except Exception as e:
+            LOG.warning(f"Table cache not written for {path}: {e}")
+
+        return df
+
+    def read_csv(self, path, **kwargs):
+        return self.read(pd.read_csv, path, **kwargs)
+
+    def read_excel(self, path, **kwargs):
+        return self.read(pd.read_excel, path, **kwargs)
+
+    def invalidate(self, path, stale_only=False, version=None):
+        """
+        Remove cache entries of a source file
+
+        :param path: str
+
+        :param stale_only: bool
+            Remove only entries of previous versions (see version_key) of the file
+
+        :param version: str, optional
+            Current version of the file, computed if None
+        """
+        if stale_only:
+            version = self.version_key(path) if version is None else version
+            current = f"{self.path_key(path)}.{version}."
+
+        else:
+            current = None
+
+        for entry in glob.glob(
+            os.path.join(self.cache_dir, f"{self.path_key(path)}.*")
+        ):
+            if current is None or not os.path.basename(entry).startswith(current):
+                os.remove(entry)
+
+    def clear(self):
+        """
+        Remove all cache entries
+        """
+        for fmt in self.FORMATS:
+            for entry in glob.glob(os.path.join(self.cache_dir, f"*.{fmt}")):
+                os.remove(entry)
+
+
+TABLE_CACHE = TableCache()
@@ -1,15 +1,21 @@
 #!/usr/bin/env python
 # Copyright (C) 2019 Emanuel Goncalves
 
+import os
+import logging
 import numpy as np
 import pandas as pd
 import crispy as cy
-import matplotlib.pyplot as plt
-from pybedtools import BedTool
+import multiprocessing as mp
+from crispy.Intervals import IntervalIndex
 from sklearn.gaussian_process import GaussianProcessRegressor
 from sklearn.gaussian_process.kernels import WhiteKernel, ConstantKernel, RBF
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
 
 
+LOG = logging.getLogger("Crispy")
+
 PSEUDO_COUNT = 0.5
 
 LOW_COUNT_THRES = 30
@@ -30,9 +36,32 @@ BED_COLUMNS = [
     "sgRNA_ID",
 ]
 
+BED_COMPACT_DTYPES = dict(
+    Start=np.int32,
+    End=np.int32,
+    copy_number=np.float32,
+    sgRNA_Start=np.int32,
+    sgRNA_End=np.int32,
+    fold_change=np.float32,
+    sgRNA_ID=np.int32,
+)
+
+INTERSECT_ENGINES = ["numpy", "bedtools"]
+
+COHORT_MODES = [None, "fixed", "warm"]
+
 
 class Crispy:
-    def __init__(self, sgrna_fc, library, copy_number, exclude_heterochromosomes=False):
+    def __init__(
+        self,
+        sgrna_fc,
+        library,
+        copy_number,
+        exclude_heterochromosomes=False,
+        intersect_engine="numpy",
+        guide_index=None,
+        compact=False,
+    ):
         f"""
         Initialise a Crispy processing pipeline object
 
@@ -42,7 +71,24 @@ class Crispy:
         :param library: pandas.DataFrame
             CRISPR library, must have these columns {CRISPR_LIB_COLUMNS}
 
+        :param intersect_engine: str
+            Engine used to intersect sgRNAs with copy-number segments, one of {INTERSECT_ENGINES}.
+            "numpy" uses a native sorted interval index, "bedtools" requires pybedtools.
+
+        :param guide_index: crispy.Intervals.IntervalIndex, optional
+            Pre-computed index of the library sgRNAs (see build_guide_index), shared across samples
+            screened with the same library (e.g. Library.load_guide_index). Built on first use if
+            not provided.
+
+        :param compact: bool
+            Build the sgRNAs and segments BED data-frame with compact dtypes (see compact_bed), with
+            sgRNA_ID as integer codes of the guide index IDs (see sgrna_ids)
+
         """
+        assert (
+            intersect_engine in INTERSECT_ENGINES
+        ), f"Intersect engine {intersect_engine} not supported: {INTERSECT_ENGINES}"
+
         self.library = library
         self.library.index.name = "index"
 
@@ -50,12 +96,21 @@ class Crispy:
         self.copy_number = copy_number
         self.gpr = None
         self.exclude_heterochromosomes = exclude_heterochromosomes
+        self.intersect_engine = intersect_engine
+        self.guide_index = guide_index
+        self.compact = compact
 
     def correct(
         self,
         x_features=None,
         y_feature="fold_change",
         n_sgrna=10,
+        gp_approx=None,
+        n_bins=100,
+        kernel=None,
+        optimizer="fmin_l_bfgs_b",
+        n_restarts_optimizer=3,
+        return_std=False,
     ):
         """
         Main pipeline function to process data from raw counts to corrected fold-changes.
@@ -69,6 +124,26 @@ class Crispy:
         :param n_sgrna: int
             Minimum number of guides per segment
 
+        :param gp_approx: str, optional
+            Gaussian Process approximation, see CrispyGaussian.APPROX_MODES. None fits the exact GP
+
+        :param n_bins: int
+            Number of bins of the "binned" GP approximation
+
+        :param kernel: sklearn.gaussian_process.kernels.Kernel, optional
+            Gaussian Process kernel, e.g. a cohort kernel (see CrispyGaussian.cohort_kernel).
+            Defaults to CrispyGaussian.get_default_kernel
+
+        :param optimizer: str, optional
+            Kernel hyperparameters optimizer. If None the kernel hyperparameters are kept fixed and
+            only the GP posterior is computed
+
+        :param n_restarts_optimizer: int
+            Number of restarts of the optimizer, 0 warm-starts only from the kernel hyperparameters
+
+        :param return_std: bool
+            Add the GP predictive standard deviation of each sgRNA (gp_std column)
+
         :param round_dec: int
             Number of decimal places for floating numbers. If equals to None no rounding is performed
 
@@ -90,21 +165,197 @@ class Crispy:
         bed_df = bed_df.dropna(subset=x_features + [y_feature])
 
         # - Fit Gaussian Process on segment fold-changes
-        self.gpr = CrispyGaussian(bed_df, n_sgrna=n_sgrna)
+        self.gpr = CrispyGaussian(
+            bed_df,
+            kernel=kernel,
+            n_sgrna=n_sgrna,
+            optimizer=optimizer,
+            n_restarts_optimizer=n_restarts_optimizer,
+            approx=gp_approx,
+            n_bins=n_bins,
+        )
         self.gpr = self.gpr.fit(x=x_features, y=y_feature)
 
-        bed_df["gp_mean"] = self.gpr.predict(bed_df[x_features])
+        if return_std:
+            bed_df["gp_mean"], bed_df["gp_std"] = self.gpr.predict_guides(
+                bed_df[x_features], return_std=True
+            )
+
+        else:
+            bed_df["gp_mean"] = self.gpr.predict_guides(bed_df[x_features])
 
         # - Correct fold-change by subtracting the estimated mean
         bed_df["corrected"] = bed_df.eval("fold_change - gp_mean")
 
         # - Add gene
-        bed_df["gene"] = (
-            self.library.reindex(bed_df["sgRNA_ID"])["Approved_Symbol"].values
-        )
+        if "Approved_Symbol" in self.library:
+            bed_df["gene"] = (
+                self.library.reindex(self.sgrna_ids(bed_df))["Approved_Symbol"].values
+            )
 
         return bed_df
 
+    @classmethod
+    def correct_matrix(
+        cls,
+        fc_df,
+        segments_by_sample,
+        library,
+        n_jobs=1,
+        sample_col="model_id",
+        value="corrected",
+        exclude_heterochromosomes=False,
+        guide_index=None,
+        cohort=None,
+        cohort_samples=10,
+        random_state=None,
+        compact=False,
+        **correct_kws,
+    ):
+        """
+        Correct copy-number effects of multiple samples screened with the same CRISPR library. The
+        library interval index is built once and shared with the worker processes (inherited by
+        fork where available), and one CrispyGaussian is fitted per sample.
+
+        :param fc_df: pandas.DataFrame
+            sgRNAs (rows) fold-changes of the samples (columns)
+
+        :param segments_by_sample: dict or pandas.DataFrame
+            Copy-number segments per sample, must have these columns COPY_NUMBER_COLUMNS. If
+            DataFrame, samples are defined by sample_col
+
+        :param library: pandas.DataFrame
+            CRISPR library, must have these columns CRISPR_LIB_COLUMNS
+
+        :param n_jobs: int
+            Number of worker processes, -1 uses all CPUs
+
+        :param sample_col: str
+            Sample column if segments_by_sample is a DataFrame
+
+        :param value: str
+            Column of the correct output to stack, e.g. "corrected" or "gp_mean"
+
+        :param guide_index: crispy.Intervals.IntervalIndex, optional
+            Pre-computed library index (e.g. Library.load_guide_index), built if not provided
+
+        :param compact: bool
+            Use compact BED data-frames (see Crispy compact), reducing the memory of each worker.
+            Fold-changes are then stored as float32
+
+        :param cohort: str, optional
+            Cohort mode, one of COHORT_MODES. If not None, the GP kernel hyperparameters are first
+            fitted on cohort_samples and summarised with CrispyGaussian.cohort_kernel. The cohort
+            kernel is then used on every sample either "fixed" (no hyperparameters optimisation,
+            only the GP posterior is computed) or "warm" (optimisation started from the cohort
+            hyperparameters without random restarts)
+
+        :param cohort_samples: int or list
+            Samples used to fit the cohort kernel, or number of randomly picked samples
+
+        :param random_state: int, optional
+            Random state used to pick the cohort samples
+
+        :param correct_kws: dict
+            Arguments passed to Crispy.correct, e.g. x_features, y_feature, n_sgrna
+
+        :return: pandas.DataFrame
+            sgRNAs (rows) corrected values of the samples (columns). sgRNAs overlapping multiple
+            segments are averaged. Fitted kernels are stored in attrs["kernels"] and the cohort
+            kernel, if any, in attrs["cohort_kernel"]
+        """
+        assert cohort in COHORT_MODES, f"Cohort mode {cohort} not supported: {COHORT_MODES}"
+
+        if isinstance(segments_by_sample, pd.DataFrame):
+            segments_by_sample = dict(list(segments_by_sample.groupby(sample_col)))
+
+        samples = [s for s in fc_df if s in segments_by_sample]
+
+        if len(samples) != fc_df.shape[1]:
+            LOG.warning(
+                f"#(samples)={fc_df.shape[1] - len(samples)} without copy-number segments"
+            )
+
+        state = dict(
+            fc_df=fc_df,
+            segments_by_sample=segments_by_sample,
+            library=library,
+            guide_index=cls.build_guide_index(library)
+            if guide_index is None
+            else guide_index,
+            value=value,
+            exclude_heterochromosomes=exclude_heterochromosomes,
+            compact=compact,
+            correct_kws=correct_kws,
+        )
+
+        n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+
+        if n_jobs == 1:
+            _init_correct_matrix_worker(state)
+            executor = None
+
+        else:
+            ctx = mp.get_context("fork" if "fork" in mp.get_all_start_methods() else None)
+
+            executor = ProcessPoolExecutor(
+                max_workers=n_jobs,
+                mp_context=ctx,
+                initializer=_init_correct_matrix_worker,
+                initargs=(state,),
+            )
+
+        def run(run_samples, run_kws):
+            run_map = map if executor is None else executor.map
+            return list(run_map(_correct_matrix_sample, run_samples, repeat(run_kws)))
+
+        try:
+            # Cohort kernel hyperparameters
+            cohort_kernel = None
+
+            if cohort is not None:
+                if type(cohort_samples) is int:
+                    cohort_samples = list(
+                        pd.Series(samples).sample(
+                            n=min(cohort_samples, len(samples)),
+                            random_state=random_state,
+                        )
+                    )
+
+                LOG.info(f"Crispy cohort kernel: #(samples)={len(cohort_samples)}")
+
+                cohort_kernel = CrispyGaussian.cohort_kernel(
+                    [k for _, _, k in run(cohort_samples, dict())]
+                )
+                LOG.info(f"Crispy cohort kernel: {cohort_kernel}")
+
+                if cohort == "fixed":
+                    cohort_kws = dict(kernel=cohort_kernel, optimizer=None)
+
+                else:
+                    cohort_kws = dict(kernel=cohort_kernel, n_restarts_optimizer=0)
+
+            else:
+                cohort_kws = dict()
+
+            res = run(samples, cohort_kws)
+
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+            _CORRECT_MATRIX_STATE.clear()
+
+        kernels = {s: k for s, _, k in res}
+
+        res = pd.DataFrame({s: v for s, v, _ in res}, columns=samples)
+        res = res.reindex(fc_df.index)
+
+        res.attrs["kernels"] = kernels
+        res.attrs["cohort_kernel"] = cohort_kernel
+
+        return res
+
     def calculate_ploidy(self, df):
         """
         Estimate ploidy and chromosomes number of copies from copy-number segments. Mean copy-number is
@@ -115,7 +366,7 @@ class Crispy:
         :return: (pandas.Series, float)
             Chromosome copies, ploidy
         """
-        if type(df) == BedTool:
+        if not isinstance(df, pd.DataFrame):
             df = df.to_dataframe().rename(
                 columns={"name": "copy_number", "chrom": "chr"}
             )
@@ -177,17 +428,18 @@ class Crispy:
             of the CRISPR library
 
         """
-        # Build copy-number and sgRNAs data frames
+        # Build copy-number data frame
         df_cn = self.get_df_copy_number()
-        df_sg = self.get_df_library()
-
-        # Build beds
-        bed_cn = BedTool(df_cn.to_string(index=False, header=False), from_string=True).sort()
-        bed_sg = BedTool(df_sg.to_string(index=False, header=False), from_string=True).sort()
 
         # Intersect copy-number segments with sgRNAs
-        bed_df = bed_cn.intersect(bed_sg, wa=True, wb=True).to_dataframe(names=BED_COLUMNS)
-        bed_df["sgRNA_ID"] = [f"{i:.0f}".split(".")[0] if type(i) is not str else i for i in bed_df["sgRNA_ID"]]
+        if self.intersect_engine == "bedtools":
+            bed_df = self.intersect_bedtools(df_cn, self.get_df_library())
+
+        else:
+            bed_df = self.intersect_numpy(df_cn)
+
+        if self.compact:
+            bed_df = self.compact_bed(bed_df)
 
         # Calculate chromosome copies and cell ploidy
         chrm, ploidy = self.calculate_ploidy(df_cn)
@@ -204,6 +456,175 @@ class Crispy:
 
         return bed_df
 
+    @staticmethod
+    def build_guide_index(library):
+        """
+        Build sorted interval index of the sgRNAs genomic coordinates of a CRISPR library
+
+        :param library: pandas.DataFrame
+            CRISPR library, must have these columns CRISPR_LIB_COLUMNS
+
+        :return: crispy.Intervals.IntervalIndex
+        """
+        return IntervalIndex.from_frame(library, *CRISPR_LIB_COLUMNS)
+
+    def get_guide_index(self):
+        """
+        Library sgRNAs interval index, built on first call if not provided
+
+        :return: crispy.Intervals.IntervalIndex
+        """
+        if self.guide_index is None:
+            self.guide_index = self.build_guide_index(self.library)
+
+        return self.guide_index
+
+    def sgrna_ids(self, bed_df):
+        """
+        sgRNA IDs of the BED data-frame rows, decoding the integer codes of compact data-frames
+
+        :param bed_df: pandas.DataFrame
+
+        :return: numpy.ndarray
+        """
+        if self.compact:
+            return self.get_guide_index().ids[bed_df["sgRNA_ID"].values]
+
+        return bed_df["sgRNA_ID"].values
+
+    def compact_bed(self, bed_df):
+        """
+        Compact representation of the BED data-frame: categorical chromosomes (shared by Chr and
+        sgRNA_Chr), int32 coordinates, float32 copy-number and fold-changes, and sgRNA_ID as int32
+        codes of the guide index IDs. The guide index is shared across samples screened with the
+        same library, hence the IDs are stored once.
+
+        :param bed_df: pandas.DataFrame
+            BED data-frame with columns BED_COLUMNS
+
+        :return: pandas.DataFrame
+        """
+        if not pd.api.types.is_integer_dtype(bed_df["sgRNA_ID"]):
+            # IDs compared as str, e.g. bedtools output IDs of a library with integer index
+            sg_ids = pd.Index(self.get_guide_index().ids).astype(str)
+            codes = sg_ids.get_indexer(bed_df["sgRNA_ID"].astype(str))
+
+            missing = bed_df["sgRNA_ID"][codes == -1]
+            assert (
+                len(missing) == 0
+            ), f"#(sgRNAs)={len(missing)} not in the guide index, e.g. {list(missing[:5])}"
+
+            bed_df = bed_df.assign(sgRNA_ID=codes)
+
+        max_coord = bed_df[["End", "sgRNA_End"]].max().max()
+        assert max_coord < np.iinfo(np.int32).max, "Coordinates exceed int32"
+
+        chr_dtype = pd.CategoricalDtype(
+            np.union1d(bed_df["Chr"].astype(str), bed_df["sgRNA_Chr"].astype(str))
+        )
+
+        return bed_df.astype(
+            dict(**BED_COMPACT_DTYPES, Chr=chr_dtype, sgRNA_Chr=chr_dtype)
+        )
+
+    @staticmethod
+    def memory_report(bed_df):
+        """
+        Memory usage of the columns of a data-frame, e.g. BED data-frames
+
+        :param bed_df: pandas.DataFrame
+
+        :return: pandas.DataFrame
+            Columns dtype and bytes, including the index and a Total row
+        """
+        usage = bed_df.memory_usage(deep=True)
+
+        report = pd.DataFrame(
+            dict(
+                dtype=pd.concat(
+                    [pd.Series({"Index": bed_df.index.dtype}), bed_df.dtypes]
+                ).astype(str),
+                bytes=usage,
+            )
+        )
+        report.loc["Total"] = ["", usage.sum()]
+
+        return report
+
+    def intersect_numpy(self, df_cn):
+        """
+        Intersect copy-number segments with sgRNAs fold-changes using the library interval index
+
+        :param df_cn: pandas.DataFrame
+            Copy-number segments, as returned by get_df_copy_number
+
+        :return: pandas.DataFrame
+            Overlapping pairs of segments and sgRNAs with columns BED_COLUMNS
+        """
+        sg_index = self.get_guide_index()
+
+        # Sort segments as bedtools sort (chromosome name and start position)
+        df_cn = df_cn.assign(Chr=df_cn["Chr"].astype(str))
+        df_cn = df_cn.sort_values(["Chr", "Start", "End"], kind="mergesort")
+
+        # Segment and sgRNA overlapping pairs
+        cn_idx, sg_pos = sg_index.query_positions(
+            df_cn["Chr"], df_cn["Start"], df_cn["End"]
+        )
+
+        # Keep sgRNAs with measured fold-change
+        sg_codes = sg_index.rows[sg_pos]
+        fc_idx = self.sgrna_fc.index.get_indexer(sg_index.ids[sg_codes])
+
+        cn_idx, sg_pos, sg_codes, fc_idx = [
+            v[fc_idx != -1] for v in [cn_idx, sg_pos, sg_codes, fc_idx]
+        ]
+
+        df_cn = df_cn.iloc[cn_idx]
+
+        bed_df = pd.DataFrame(
+            dict(
+                Chr=df_cn["Chr"].values,
+                Start=df_cn["Start"].values.astype(np.int64),
+                End=df_cn["End"].values.astype(np.int64),
+                copy_number=df_cn["copy_number"].values,
+                sgRNA_Chr=sg_index.chromosome_at(sg_pos),
+                sgRNA_Start=sg_index.starts[sg_pos],
+                sgRNA_End=sg_index.ends[sg_pos],
+                fold_change=self.sgrna_fc.values[fc_idx],
+                sgRNA_ID=sg_codes if self.compact else sg_index.ids[sg_codes],
+            )
+        )[BED_COLUMNS]
+
+        return bed_df
+
+    @staticmethod
+    def intersect_bedtools(df_cn, df_sg):
+        """
+        Intersect copy-number segments with sgRNAs using bedtools (requires pybedtools)
+
+        :param df_cn: pandas.DataFrame
+            Copy-number segments, as returned by get_df_copy_number
+
+        :param df_sg: pandas.DataFrame
+            sgRNAs fold-changes, as returned by get_df_library
+
+        :return: pandas.DataFrame
+            Overlapping pairs of segments and sgRNAs with columns BED_COLUMNS
+        """
+        from pybedtools import BedTool
+
+        # Build beds
+        bed_cn = BedTool(df_cn.to_string(index=False, header=False), from_string=True).sort()
+        bed_sg = BedTool(df_sg.to_string(index=False, header=False), from_string=True).sort()
+
+        # Intersect copy-number segments with sgRNAs
+        bed_df = bed_cn.intersect(bed_sg, wa=True, wb=True).to_dataframe(
+            names=BED_COLUMNS, dtype=dict(sgRNA_ID=str)
+        )
+
+        return bed_df
+
 
 class CrispyGaussian(GaussianProcessRegressor):
     SEGMENT_COLUMNS = ["Chr", "Start", "End"]
@@ -219,6 +640,8 @@ class CrispyGaussian(GaussianProcessRegressor):
         sgRNA_ID="count",
     )
 
+    APPROX_MODES = [None, "binned"]
+
     def __init__(
         self,
         bed_df,
@@ -230,10 +653,32 @@ class CrispyGaussian(GaussianProcessRegressor):
         normalize_y=False,
         copy_x_train=False,
         random_state=None,
+        approx=None,
+        n_bins=100,
     ):
+        """
+        Gaussian Process Regression of the segments fold-changes
 
-        self.bed_seg = bed_df.groupby(self.SEGMENT_COLUMNS).agg(self.SEGMENT_AGG_FUN)
+        :param approx: str, optional
+            Approximation used to fit the GP, one of APPROX_MODES. None fits the exact GP on all
+            segments, O(n^3) on the number of segments. "binned" averages the segments within
+            n_bins quantile bins of the (single) feature and fits the GP on the bins, bounding
+            the cost of fit by the number of bins (see bin_segments)
+
+        :param n_bins: int
+            Number of bins of the "binned" approximation
+
+        """
+        assert (
+            approx in self.APPROX_MODES
+        ), f"GP approximation {approx} not supported: {self.APPROX_MODES}"
+
+        self.bed_seg = bed_df.groupby(self.SEGMENT_COLUMNS, observed=True).agg(
+            self.SEGMENT_AGG_FUN
+        )
         self.n_sgrna = n_sgrna
+        self.approx = approx
+        self.n_bins = n_bins
 
         super().__init__(
             alpha=alpha,
@@ -258,6 +703,21 @@ class CrispyGaussian(GaussianProcessRegressor):
         """
         return ConstantKernel() * RBF() + WhiteKernel()
 
+    @staticmethod
+    def cohort_kernel(kernels):
+        """
+        Summarise kernels fitted on multiple samples (e.g. a representative set of a cohort) into
+        a single kernel with the median of the (log-transformed) hyperparameters. The cohort kernel
+        can be used to warm-start, or skip, the hyperparameters optimisation of other samples.
+
+        :param kernels: list
+            Fitted kernels (e.g. CrispyGaussian.kernel_) with the same structure
+
+        :return: sklearn.gaussian_process.kernels.Kernel
+        """
+        thetas = np.array([k.theta for k in kernels])
+        return kernels[0].clone_with_theta(np.median(thetas, axis=0))
+
     def fit(self, x, y, train_idx=None):
         if train_idx is not None:
             x = self.bed_seg.iloc[train_idx].query(f"sgRNA_ID >= {self.n_sgrna}")[x]
@@ -267,14 +727,75 @@ class CrispyGaussian(GaussianProcessRegressor):
             x = self.bed_seg.query(f"sgRNA_ID >= {self.n_sgrna}")[x]
             y = self.bed_seg.query(f"sgRNA_ID >= {self.n_sgrna}")[y]
 
+        if self.approx == "binned":
+            x, y = self.bin_segments(x, y, self.n_bins)
+
         return super().fit(x, y)
 
+    @staticmethod
+    def bin_segments(x, y, n_bins=100):
+        """
+        Average segments feature and fold-change within quantile bins of the feature. The GP mean
+        fitted on the bins closely follows the exact fit, since the copy-number ratio is a 1-D
+        feature with a smooth effect (RMSE of the predicted mean around 0.01, see
+        test/test_gp_approximation.py, and 100x or faster fit for thousands of segments). The
+        predictive standard deviation is narrower as bins average out noise.
+
+        :param x: pandas.DataFrame
+            Segments feature, single column
+
+        :param y: pandas.Series
+            Segments fold-change
+
+        :param n_bins: int
+            Maximum number of bins
+
+        :return: (pandas.DataFrame, pandas.Series)
+        """
+        assert x.shape[1] == 1, "Binned approximation only supports a single feature"
+
+        if len(x) <= n_bins:
+            return x, y
+
+        x_values = x.iloc[:, 0].values
+
+        edges = np.unique(np.quantile(x_values, np.linspace(0, 1, n_bins + 1)))
+        bins = np.searchsorted(edges, x_values, side="right") - 1
+        bins = np.clip(bins, 0, max(len(edges) - 2, 0))
+
+        return x.groupby(bins).mean(), y.groupby(bins).mean()
+
     def predict(self, x=None, return_std=False, return_cov=False):
         if x is None:
             x = self.bed_seg[["ratio"]]
 
         return super().predict(x, return_std=return_std, return_cov=return_cov)
 
+    def predict_guides(self, x, return_std=False):
+        """
+        Predict sgRNAs (rows of the BED data-frame) evaluating the GP only once per unique row of
+        features, i.e. once per segment since features (e.g. ratio) are constant within segments,
+        and broadcasting the predictions back to the sgRNAs.
+
+        :param x: pandas.DataFrame
+            sgRNAs features
+
+        :param return_std: bool
+            Return also the predictive standard deviation
+
+        :return: numpy.ndarray or (numpy.ndarray, numpy.ndarray)
+        """
+        x_unique, codes = np.unique(x.values, axis=0, return_inverse=True)
+        x_unique = pd.DataFrame(x_unique, columns=x.columns)
+
+        codes = codes.ravel()
+
+        if return_std:
+            mean, std = self.predict(x_unique, return_std=True)
+            return mean[codes], std[codes]
+
+        return self.predict(x_unique)[codes]
+
     def score(self, x=None, y=None, sample_weight=None):
         if x is None:
             x = self.bed_seg[["ratio"]]
@@ -295,6 +816,7 @@ class CrispyGaussian(GaussianProcessRegressor):
         :param ax: matplotlib.plot
         :return: matplotlib.plot
         """
+        import matplotlib.pyplot as plt
 
         if ax is None:
             ax = plt.gca()
@@ -361,3 +883,35 @@ class CrispyGaussian(GaussianProcessRegressor):
         plt.legend(frameon=False)
 
         return ax
+
+
+# Per-process state of Crispy.correct_matrix workers
+_CORRECT_MATRIX_STATE = dict()
+
+
+def _init_correct_matrix_worker(state):
+    _CORRECT_MATRIX_STATE.update(state)
+
+
+def _correct_matrix_sample(sample, correct_kws):
+    state = _CORRECT_MATRIX_STATE
+
+    LOG.info(f"Crispy correction: {sample}")
+
+    crispy = Crispy(
+        sgrna_fc=state["fc_df"][sample],
+        library=state["library"],
+        copy_number=state["segments_by_sample"][sample],
+        exclude_heterochromosomes=state["exclude_heterochromosomes"],
+        guide_index=state["guide_index"],
+        compact=state["compact"],
+    )
+
+    bed_df = crispy.correct(**{**state["correct_kws"], **correct_kws})
+
+    values = bed_df.groupby("sgRNA_ID")[state["value"]].mean()
+
+    if crispy.compact:
+        values.index = crispy.get_guide_index().ids[values.index]
+
+    return sample, values, crispy.gpr.kernel_
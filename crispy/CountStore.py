@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# Copyright (C) 2019 Emanuel Goncalves
+
+import os
+import struct
+import logging
+import numpy as np
+import pandas as pd
+
+LOG = logging.getLogger("Crispy")
+
+
+class CountStore:
+    """
+    On-disk binary store of a read counts matrix (sgRNAs x samples), to open screens without
+    parsing the read counts text files. The store is a directory with:
+
+        counts.npy      sgRNAs x samples matrix in Fortran (sample-major) order
+        guides.txt      sgRNA IDs, one per line
+        samples.txt     sample names, one per line
+
+    counts.npy is memory-mapped on open, hence samples are read from disk only when used, and
+    since each sample is contiguous new samples are appended at the end of the file, updating only
+    the shape in the (fixed size) .npy header.
+
+    """
+
+    COUNTS_FILE = "counts.npy"
+    GUIDES_FILE = "guides.txt"
+    SAMPLES_FILE = "samples.txt"
+
+    # Total .npy header size, with room for the shape to grow as samples are appended
+    HEADER_SIZE = 128
+
+    def __init__(self, path):
+        """
+        :param path: str
+            Store directory, see create to build a new store
+        """
+        assert os.path.exists(
+            os.path.join(path, self.COUNTS_FILE)
+        ), f"Count store not found: {path}"
+
+        self.path = path
+
+        self.guides = pd.Index(self.read_lines(self.GUIDES_FILE))
+        self.samples = pd.Index(self.read_lines(self.SAMPLES_FILE)[: self.shape[1]])
+
+    @property
+    def counts_file(self):
+        return os.path.join(self.path, self.COUNTS_FILE)
+
+    @property
+    def shape(self):
+        return np.load(self.counts_file, mmap_mode="r").shape
+
+    @property
+    def dtype(self):
+        return np.load(self.counts_file, mmap_mode="r").dtype
+
+    def read_lines(self, file):
+        with open(os.path.join(self.path, file)) as f:
+            return f.read().splitlines()
+
+    def write_lines(self, file, lines):
+        with open(os.path.join(self.path, f"{file}.tmp"), "w") as f:
+            f.writelines(f"{l}\n" for l in lines)
+
+        os.replace(
+            os.path.join(self.path, f"{file}.tmp"), os.path.join(self.path, file)
+        )
+
+    @classmethod
+    def write_header(cls, f, shape, dtype):
+        header = repr(
+            dict(
+                descr=np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                fortran_order=True,
+                shape=tuple(shape),
+            )
+        )
+
+        # Magic string (8 bytes), header length (2 bytes) and space padded header
+        assert len(header) < cls.HEADER_SIZE - 11, "Count store shape exceeds header"
+        header = header.ljust(cls.HEADER_SIZE - 11) + "\n"
+
+        f.seek(0)
+        f.write(np.lib.format.magic(1, 0))
+        f.write(struct.pack("<H", len(header)))
+        f.write(header.encode("latin1"))
+
+    @staticmethod
+    def to_values(counts, dtype):
+        assert counts.notna().all().all(), "Missing read counts not supported"
+        assert (counts.values >= 0).all(), "Negative read counts not supported"
+        assert (
+            not np.issubdtype(np.dtype(dtype), np.integer)
+            or (counts.values == np.round(counts.values)).all()
+        ), f"Non-integer read counts not supported with dtype {np.dtype(dtype)}"
+
+        return np.asfortranarray(counts.values.astype(dtype))
+
+    @classmethod
+    def create(cls, path, counts, dtype=np.uint32):
+        """
+        Write a new store, replacing any existing store in path
+
+        :param path: str
+            Store directory
+
+        :param counts: pandas.DataFrame
+            Read counts, sgRNAs (rows) x samples (columns)
+
+        :param dtype: numpy.dtype
+            Integer dtype of the stored counts
+
+        :return: CountStore
+        """
+        values = cls.to_values(counts, dtype)
+
+        os.makedirs(path, exist_ok=True)
+
+        with open(os.path.join(path, cls.COUNTS_FILE), "wb") as f:
+            cls.write_header(f, values.shape, dtype)
+            f.write(values.tobytes(order="F"))
+
+        store = cls.__new__(cls)
+        store.path = path
+        store.write_lines(cls.GUIDES_FILE, counts.index.astype(str))
+        store.write_lines(cls.SAMPLES_FILE, counts.columns.astype(str))
+
+        LOG.info(
+            f"Count store {path}: #(sgRNAs)={values.shape[0]}, #(samples)={values.shape[1]}"
+        )
+
+        return cls(path)
+
+    def append(self, counts):
+        """
+        Append samples to the store without rewriting the existing ones. sgRNAs are aligned to the
+        store sgRNAs and all of them must be present.
+
+        :param counts: pandas.DataFrame
+            Read counts of the new samples, sgRNAs (rows) x samples (columns)
+
+        :return: CountStore
+        """
+        duplicated = self.samples.intersection(counts.columns.astype(str))
+        assert len(duplicated) == 0, f"Samples already in store: {list(duplicated)}"
+
+        missing = self.guides.difference(counts.index.astype(str))
+        assert len(missing) == 0, f"#(sgRNAs)={len(missing)} of the store missing"
+
+        counts = counts.set_axis(counts.index.astype(str), axis=0).reindex(self.guides)
+        values = self.to_values(counts, self.dtype)
+
+        shape = (self.shape[0], self.shape[1] + values.shape[1])
+
+        with open(self.counts_file, "r+b") as f:
+            f.seek(
+                self.HEADER_SIZE + self.shape[0] * self.shape[1] * self.dtype.itemsize
+            )
+            f.write(values.tobytes(order="F"))
+            f.truncate()
+
+            self.write_lines(
+                self.SAMPLES_FILE, list(self.samples) + list(counts.columns.astype(str))
+            )
+
+            self.write_header(f, shape, self.dtype)
+
+        self.samples = pd.Index(self.read_lines(self.SAMPLES_FILE))
+
+        LOG.info(f"Count store {self.path}: #(samples)={values.shape[1]} appended")
+
+        return self
+
+    def open(self, samples=None):
+        """
+        Memory-mapped read counts. With all samples the data-frame is a zero-copy view of the
+        store, a subset of samples only reads the selected samples from disk.
+
+        :param samples: list, optional
+            Samples to open, all if None
+
+        :return: pandas.DataFrame
+        """
+        values = np.load(self.counts_file, mmap_mode="r")
+
+        if samples is None:
+            samples = self.samples
+
+        else:
+            idx = self.samples.get_indexer(samples)
+            assert (
+                idx != -1
+            ).all(), f"Samples not in store: {set(samples) - set(self.samples)}"
+
+            # Consecutive samples are a view of the store, otherwise only they are copied
+            if len(idx) > 0 and (np.diff(idx) == 1).all():
+                values = values[:, idx[0] : idx[-1] + 1]
+
+            else:
+                values = values[:, idx]
+
+        return pd.DataFrame(values, index=self.guides, columns=samples, copy=False)
@@ -90,7 +90,7 @@ class CrispyPlot:
         zip(
             *(
                 natsorted(
-                    list(Sample().samplesheet["cancer_type"].value_counts().index)
+                    list(Sample.shared().samplesheet["cancer_type"].value_counts().index)
                 ),
                 sns.color_palette("tab20c").as_hex()
                 + sns.color_palette("tab20b").as_hex()
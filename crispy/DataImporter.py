@@ -2,11 +2,14 @@
 # Copyright (C) 2019 Emanuel Goncalves
 
 import logging
+import inspect
+import threading
 import numpy as np
 import pandas as pd
 import pkg_resources
 import itertools as it
-from crispy.Utils import Utils
+from crispy.Utils import Utils, GeneSetScaler
+from crispy.Cache import TABLE_CACHE
 from scipy.stats import shapiro, iqr
 from sklearn.mixture import GaussianMixture
 from sklearn.preprocessing import quantile_transform
@@ -21,8 +24,13 @@ class Sample:
     """
     Import module that handles the sample list (i.e. list of cell lines) and their descriptive information.
 
+    Importers share a single process-wide instance, see Sample.shared.
+
     """
 
+    _SHARED = {}
+    _SHARED_LOCK = threading.Lock()
+
     def __init__(
         self,
         index="model_id",
@@ -35,13 +43,13 @@ class Sample:
 
         # Import samplesheet
         self.samplesheet = (
-            pd.read_csv(f"{DPATH}/{samplesheet_file}")
+            TABLE_CACHE.read_csv(f"{DPATH}/{samplesheet_file}")
             .dropna(subset=[self.index])
             .set_index(self.index)
         )
 
         # Growth rates
-        self.growth = pd.read_csv(f"{DPATH}/{growth_file}")
+        self.growth = TABLE_CACHE.read_csv(f"{DPATH}/{growth_file}")
         self.samplesheet["growth"] = (
             self.growth.groupby(self.index)["GROWTH_RATE"]
             .mean()
@@ -51,7 +59,7 @@ class Sample:
 
         # CRISPR institute
         self.samplesheet["institute"] = (
-            pd.read_csv(f"{DPATH}/{institute_file}", index_col=0, header=None)
+            TABLE_CACHE.read_csv(f"{DPATH}/{institute_file}", index_col=0, header=None)
             .iloc[:, 0]
             .reindex(self.samplesheet.index)
             .values
@@ -64,10 +72,38 @@ class Sample:
         ]
 
         # Screen medium
-        self.media = pd.read_excel(f"{DPATH}/{medium_file}")
+        self.media = TABLE_CACHE.read_excel(f"{DPATH}/{medium_file}")
         self.media = self.media.groupby("SIDM")["Screen Media"].first()
         self.samplesheet["media"] = self.media.reindex(self.samplesheet.index)
 
+    @classmethod
+    def shared(cls, **kwargs):
+        """
+        Process-wide Sample instance, built on first use and reused by subsequent calls with the
+        same arguments (thread-safe). The returned samplesheet is shared, treat it as read-only.
+
+        :param kwargs: Sample arguments
+
+        :return: Sample
+        """
+        args = inspect.signature(cls).bind(**kwargs)
+        args.apply_defaults()
+        key = tuple(args.arguments.items())
+
+        with cls._SHARED_LOCK:
+            if key not in cls._SHARED:
+                cls._SHARED[key] = cls(**kwargs)
+
+            return cls._SHARED[key]
+
+    @classmethod
+    def clear_shared(cls):
+        """
+        Drop shared instances, e.g. after updating the samplesheet files
+        """
+        with cls._SHARED_LOCK:
+            cls._SHARED.clear()
+
     def get_covariates(self, culture_conditions=True, cancer_type=True):
         covariates = []
 
@@ -91,7 +127,7 @@ class Sample:
 
 class WES:
     def __init__(self, wes_file="WES_variants.csv.gz"):
-        self.wes = pd.read_csv(f"{DPATH}/wes/{wes_file}")
+        self.wes = TABLE_CACHE.read_csv(f"{DPATH}/wes/{wes_file}")
 
     def get_data(self, as_matrix=True, mutation_class=None, recurrence=False):
         df = self.wes.copy()
@@ -157,11 +193,11 @@ class GeneExpression:
         voom_file="gexp/rnaseq_voom.csv.gz",
         read_count="gexp/rnaseq_20191101/rnaseq_read_count_20191101.csv",
     ):
-        self.voom = pd.read_csv(f"{DPATH}/{voom_file}", index_col=0)
-        self.readcount = pd.read_csv(f"{DPATH}/{read_count}", index_col=1).drop(
-            columns=["model_id"]
-        )
-        self.discrete = pd.read_csv(
+        self.voom = TABLE_CACHE.read_csv(f"{DPATH}/{voom_file}", index_col=0)
+        self.readcount = TABLE_CACHE.read_csv(
+            f"{DPATH}/{read_count}", index_col=1
+        ).drop(columns=["model_id"])
+        self.discrete = TABLE_CACHE.read_csv(
             f"{DPATH}/GDSC_discretised_table.csv.gz", index_col=0
         )
 
@@ -213,7 +249,7 @@ class GeneExpression:
 
         if lift_gene_ids:
             gmap = (
-                pd.read_csv(f"{DPATH}/gexp/hgnc-symbol-check.csv")
+                TABLE_CACHE.read_csv(f"{DPATH}/gexp/hgnc-symbol-check.csv")
                 .groupby("Input")["Approved symbol"]
                 .first()
             )
@@ -241,7 +277,7 @@ class DrugResponse:
         drugresponse_file="drugresponse/DrugResponse_PANCANCER_GDSC1_GDSC2_20200602.csv.gz",
     ):
         # Import and Merge drug response matrix (IC50)
-        self.drugresponse = pd.read_csv(f"{DPATH}/{drugresponse_file}")
+        self.drugresponse = TABLE_CACHE.read_csv(f"{DPATH}/{drugresponse_file}")
         self.drugresponse = self.drugresponse[
             ~self.drugresponse["cell_line_name"].isin(["LS-1034"])
         ]
@@ -253,13 +289,13 @@ class DrugResponse:
 
     @staticmethod
     def assemble():
-        gdsc1 = pd.read_csv(
+        gdsc1 = TABLE_CACHE.read_csv(
             f"{DPATH}/drugresponse/fitted_data_screen_96_384_v1.6.0_02Jun20.csv"
         )
         gdsc1 = gdsc1.assign(dataset="GDSC1").query("(RMSE < 0.3)")
         gdsc1 = gdsc1.query("use_in_publications == 'Y'")
 
-        gdsc2 = pd.read_csv(
+        gdsc2 = TABLE_CACHE.read_csv(
             f"{DPATH}/drugresponse/fitted_data_rapid_screen_1536_v1.6.3_02Jun20.csv"
         )
         gdsc2 = gdsc2.assign(dataset="GDSC2").query("(RMSE < 0.3)")
@@ -343,7 +379,7 @@ class BioGRID:
         )
 
         # Import
-        self.biogrid = pd.read_csv(f"{self.ddir}/{biogrid_file}", sep="\t")
+        self.biogrid = TABLE_CACHE.read_csv(f"{self.ddir}/{biogrid_file}", sep="\t")
 
         # Filter by organism
         self.biogrid = self.biogrid[
@@ -475,7 +511,7 @@ class PPI:
         import igraph
 
         # ENSP map to gene symbol
-        gmap = pd.read_csv(f"{self.ddir}/{self.string_alias_file}", sep="\t")
+        gmap = TABLE_CACHE.read_csv(f"{self.ddir}/{self.string_alias_file}", sep="\t")
         gmap = gmap[["BioMart_HUGO" in i.split(" ") for i in gmap["source"]]]
         gmap = (
             gmap.groupby("string_protein_id")["alias"].agg(lambda x: set(x)).to_dict()
@@ -484,7 +520,7 @@ class PPI:
         logging.getLogger("DTrace").info(f"ENSP gene map: {len(gmap)}")
 
         # Load String network
-        net = pd.read_csv(f"{self.ddir}/{self.string_file}", sep=" ")
+        net = TABLE_CACHE.read_csv(f"{self.ddir}/{self.string_file}", sep=" ")
 
         # Filter by moderate confidence
         net = net[net["combined_score"] > score_thres]
@@ -604,7 +640,7 @@ class CORUM:
         self.protein_subset = protein_subset
 
         # Load CORUM DB
-        self.db = pd.read_csv(f"{self.ddir}/{corum_file}", sep="\t")
+        self.db = TABLE_CACHE.read_csv(f"{self.ddir}/{corum_file}", sep="\t")
         self.db = self.db.query(f"Organism == '{organism}'")
         self.db_name = self.db.groupby("ComplexID")["ComplexName"].first()
 
@@ -642,7 +678,9 @@ class CORUM:
         return db_melt
 
     def map_gene_name(self, index_col="Entry"):
-        idmap = pd.read_csv(f"{self.ddir}/uniprot_human_idmap.tab.gz", sep="\t")
+        idmap = TABLE_CACHE.read_csv(
+            f"{self.ddir}/uniprot_human_idmap.tab.gz", sep="\t"
+        )
 
         if index_col is not None:
             idmap = idmap.dropna(subset=[index_col]).set_index(index_col)
@@ -658,15 +696,17 @@ class HuRI:
     def __init__(self, ppi_file="HuRI.tsv", idmap_file="HuRI_biomart_idmap.tsv", ddir=None):
         self.ddir = DPATH if ddir is None else ddir
 
-        self.huri = pd.read_csv(f"{self.ddir}/{ppi_file}", sep="\t", header=None)
+        self.huri = TABLE_CACHE.read_csv(
+            f"{self.ddir}/{ppi_file}", sep="\t", header=None
+        )
 
         # Convert to a set of pairs {(p1, p2), ...}
         self.huri = {(p1, p2) for p1, p2 in self.huri.values}
 
         # Map ids
-        idmap = pd.read_csv(f"{self.ddir}/{idmap_file}", sep="\t", index_col=0)[
-            "Gene name"
-        ].to_dict()
+        idmap = TABLE_CACHE.read_csv(
+            f"{self.ddir}/{idmap_file}", sep="\t", index_col=0
+        )["Gene name"].to_dict()
         self.huri = {
             (idmap[p1], idmap[p2])
             for p1, p2 in self.huri
@@ -684,11 +724,11 @@ class HuRI:
 
 class Metabolomics:
     def __init__(self, metab_file="metabolomics/CCLE_metabolomics_20190502.csv"):
-        m_ss = Sample().samplesheet
+        m_ss = Sample.shared().samplesheet
         m_ss = m_ss.reset_index().dropna(subset=["BROAD_ID"]).set_index("BROAD_ID")
 
         # Import
-        self.metab = pd.read_csv(f"{DPATH}/{metab_file}")
+        self.metab = TABLE_CACHE.read_csv(f"{DPATH}/{metab_file}")
         self.metab["model_id"] = self.metab["DepMap_ID"].replace(m_ss["model_id"])
         self.metab = self.metab.groupby("model_id").mean().T
 
@@ -727,30 +767,36 @@ class Proteomics:
         hgsc_prot="proteomics/hgsc_cell_lines_proteomics.csv",
         brca_prot="proteomics/brca_cell_lines_proteomics_preprocessed.csv",
     ):
-        self.ss = pd.read_csv(f"{DPATH}/{samplesheet}", index_col=0)
+        self.ss = TABLE_CACHE.read_csv(f"{DPATH}/{samplesheet}", index_col=0)
 
         deprecated_ids = self.map_deprecated()
 
         # Import manifest
-        self.manifest = pd.read_csv(f"{DPATH}/{manifest}", index_col=0, sep="\t")
+        self.manifest = TABLE_CACHE.read_csv(
+            f"{DPATH}/{manifest}", index_col=0, sep="\t"
+        )
 
         # Remove excluded samples
         self.exclude_man = self.manifest[~self.manifest["SIDM"].isin(self.ss.index)]
         self.manifest = self.manifest[~self.manifest.index.isin(self.exclude_man.index)]
 
         # Replicate correlation
-        self.reps = pd.read_csv(f"{DPATH}/{protein_rep_corr}", index_col=0).iloc[:, 0]
+        self.reps = TABLE_CACHE.read_csv(
+            f"{DPATH}/{protein_rep_corr}", index_col=0
+        ).iloc[:, 0]
 
         # Import mean protein abundance
-        self.protein_raw = pd.read_csv(
+        self.protein_raw = TABLE_CACHE.read_csv(
             f"{DPATH}/{protein_raw_matrix}", sep="\t", index_col=0
         )
-        self.peptide_raw_mean = pd.read_csv(
+        self.peptide_raw_mean = TABLE_CACHE.read_csv(
             f"{DPATH}/{protein_mean_raw}", sep="\t", index_col=0
         ).iloc[:, 0]
 
         # Import imputed protein levels
-        self.protein = pd.read_csv(f"{DPATH}/{protein_matrix}", sep="\t", index_col=0).T
+        self.protein = TABLE_CACHE.read_csv(
+            f"{DPATH}/{protein_matrix}", sep="\t", index_col=0
+        ).T
 
         self.protein["Protein"] = (
             self.protein.reset_index()["index"]
@@ -770,7 +816,7 @@ class Proteomics:
         self.protein = self.protein.drop(columns=exclude_controls)
 
         # Import Broad TMT data-set
-        self.broad = pd.read_csv(f"{DPATH}/{broad_tmt}", compression="gzip")
+        self.broad = TABLE_CACHE.read_csv(f"{DPATH}/{broad_tmt}", compression="gzip")
         self.broad = (
             self.broad.dropna(subset=["Gene_Symbol"])
             .groupby("Gene_Symbol")
@@ -778,7 +824,7 @@ class Proteomics:
         )
 
         # Import CRC COREAD TMT
-        self.coread = pd.read_csv(f"{DPATH}/{coread_tmt}", index_col=0)
+        self.coread = TABLE_CACHE.read_csv(f"{DPATH}/{coread_tmt}", index_col=0)
         self.coread = self.coread.loc[
             :, self.coread.columns.isin(self.ss["model_name"])
         ]
@@ -789,7 +835,7 @@ class Proteomics:
 
         # Import HGSC proteomics
         self.hgsc = (
-            pd.read_csv(f"{DPATH}/{hgsc_prot}")
+            TABLE_CACHE.read_csv(f"{DPATH}/{hgsc_prot}")
             .dropna(subset=["Gene names"])
             .drop(columns=["Majority protein IDs"])
         )
@@ -801,7 +847,7 @@ class Proteomics:
         self.hgsc = self.hgsc.rename(columns=hgsc_ss["model_id"])
 
         # Import BRCA proteomics
-        self.brca = pd.read_csv(f"{DPATH}/{brca_prot}", index_col=0)
+        self.brca = TABLE_CACHE.read_csv(f"{DPATH}/{brca_prot}", index_col=0)
         self.brca = self.brca.loc[:, self.brca.columns.isin(self.ss["model_name"])]
 
         brca_ss = self.ss[self.ss["model_name"].isin(self.brca.columns)]
@@ -875,13 +921,13 @@ class Proteomics:
 
     @staticmethod
     def map_deprecated():
-        return pd.read_csv(
+        return TABLE_CACHE.read_csv(
             f"{DPATH}/uniprot_human_idmap_deprecated.tab", sep="\t", index_col=0
         )
 
     @staticmethod
     def map_gene_name(index_col="Entry name"):
-        idmap = pd.read_csv(f"{DPATH}/uniprot_human_idmap.tab.gz", sep="\t")
+        idmap = TABLE_CACHE.read_csv(f"{DPATH}/uniprot_human_idmap.tab.gz", sep="\t")
 
         if index_col is not None:
             idmap = idmap.dropna(subset=[index_col]).set_index(index_col)
@@ -895,7 +941,7 @@ class Proteomics:
     def calculate_mean_protein_intensities(
         self, peptide_matrix_raw="proteomics/E0022_P06_Peptide_Matrix_Raw.tsv.gz"
     ):
-        peptide_raw = pd.read_csv(
+        peptide_raw = TABLE_CACHE.read_csv(
             f"{DPATH}/{peptide_matrix_raw}", sep="\t", index_col=0
         ).T
 
@@ -921,7 +967,7 @@ class Proteomics:
     def replicates_correlation(
         self, reps_file="proteomics/E0022_P06_Protein_Matrix_Replicate_ProNorM.tsv.gz"
     ):
-        reps = pd.read_csv(f"{DPATH}/{reps_file}", sep="\t", index_col=0).T
+        reps = TABLE_CACHE.read_csv(f"{DPATH}/{reps_file}", sep="\t", index_col=0).T
 
         reps_corr = {}
 
@@ -949,20 +995,22 @@ class CRISPR:
         institute_file="crispr/CRISPR_Institute_Origin_20191108.csv.gz",
         merged_file="crispr/CRISPRcleanR_FC.txt.gz",
     ):
-        self.crispr = pd.read_csv(f"{DPATH}/{fc_file}", index_col=0)
-        self.institute = pd.read_csv(
+        self.crispr = TABLE_CACHE.read_csv(f"{DPATH}/{fc_file}", index_col=0)
+        self.institute = TABLE_CACHE.read_csv(
             f"{DPATH}/{institute_file}", index_col=0, header=None
         ).iloc[:, 0]
 
         sid = (
-            Sample()
+            Sample.shared()
             .samplesheet.reset_index()
             .dropna(subset=["BROAD_ID"])
             .groupby("BROAD_ID")["model_id"]
             .first()
         )
 
-        self.merged = pd.read_csv(f"{DPATH}/{merged_file}", index_col=0, sep="\t")
+        self.merged = TABLE_CACHE.read_csv(
+            f"{DPATH}/{merged_file}", index_col=0, sep="\t"
+        )
         self.merged_institute = pd.Series(
             {c: "Broad" if c.startswith("ACH-") else "Sanger" for c in self.merged}
         )
@@ -1026,28 +1074,9 @@ class CRISPR:
 
     @staticmethod
     def scale(df, essential=None, non_essential=None, metric=np.median):
-        if essential is None:
-            essential = Utils.get_essential_genes(return_series=False)
-
-        if non_essential is None:
-            non_essential = Utils.get_non_essential_genes(return_series=False)
-
-        assert (
-            len(essential.intersection(df.index)) != 0
-        ), "DataFrame has no index overlapping with essential list"
-
-        assert (
-            len(non_essential.intersection(df.index)) != 0
-        ), "DataFrame has no index overlapping with non essential list"
-
-        essential_metric = metric(df.reindex(essential).dropna(), axis=0)
-        non_essential_metric = metric(df.reindex(non_essential).dropna(), axis=0)
-
-        df = df.subtract(non_essential_metric).divide(
-            non_essential_metric - essential_metric
-        )
-
-        return df
+        return GeneSetScaler(
+            df.index, essential=essential, non_essential=non_essential, metric=metric
+        ).transform(df)
 
 
 class Mobem:
@@ -1060,7 +1089,7 @@ class Mobem:
     def __init__(
         self, mobem_file="mobem/PANCAN_mobem.csv.gz", drop_factors=True, add_msi=True
     ):
-        self.sample = Sample()
+        self.sample = Sample.shared()
 
         idmap = (
             self.sample.samplesheet.reset_index()
@@ -1068,7 +1097,7 @@ class Mobem:
             .set_index("COSMIC_ID")["model_id"]
         )
 
-        mobem = pd.read_csv(f"{DPATH}/{mobem_file}", index_col=0)
+        mobem = TABLE_CACHE.read_csv(f"{DPATH}/{mobem_file}", index_col=0)
         mobem = mobem[mobem.index.astype(str).isin(idmap.index)]
         mobem = mobem.set_index(idmap[mobem.index.astype(str)].values)
 
@@ -1142,15 +1171,15 @@ class CopyNumber:
         calculate_deletions=False,
         calculate_amplifications=False,
     ):
-        self.ss_obj = Sample()
+        self.ss_obj = Sample.shared()
 
-        self.copynumber = pd.read_csv(f"{DPATH}/{cnv_file}", index_col=0)
+        self.copynumber = TABLE_CACHE.read_csv(f"{DPATH}/{cnv_file}", index_col=0)
 
-        self.ploidy = self.ss_obj.samplesheet["ploidy"]
+        self.ploidy = self.ss_obj.samplesheet["ploidy"].copy()
 
-        self.copynumber_seg = pd.read_csv(f"{DPATH}/{segmentation_file}")
+        self.copynumber_seg = TABLE_CACHE.read_csv(f"{DPATH}/{segmentation_file}")
 
-        self.gistic = pd.read_csv(
+        self.gistic = TABLE_CACHE.read_csv(
             f"{DPATH}/{gistic_file}", index_col="gene_symbol"
         ).drop(columns=["gene_id"])
 
@@ -1203,49 +1232,83 @@ class CopyNumber:
     def ploidy_from_segments(
         self, seg_file="copy_number/Summary_segmentation_data_994_lines_picnic.csv.gz"
     ):
-        return pd.Series(
-            {
-                s: self.calculate_ploidy(df)[1]
-                for s, df in self.copynumber_seg.groupby("model_id")
-            }
-        )
+        return self.segments_summary(self.copynumber_seg)[0]
 
     @classmethod
     def genomic_instability(
         cls, seg_file="copy_number/Summary_segmentation_data_994_lines_picnic.csv.gz"
     ):
         # Import segments
-        cn_seg = pd.read_csv(f"{DPATH}/{seg_file}")
+        cn_seg = TABLE_CACHE.read_csv(f"{DPATH}/{seg_file}")
+
+        return cls.segments_summary(cn_seg)[2]
+
+    @classmethod
+    def segments_summary(
+        cls,
+        cn_seg,
+        sample_col="model_id",
+        chr_col="chr",
+        exclude_chrs=("chrX", "chrY", 23, 24),
+    ):
+        """
+        Ploidy, chromosome copies and genomic instability of all samples of a copy-number
+        segmentation table, computed in one pass with grouped NumPy reductions.
+
+        Ploidy is the segment length weighted median copy-number, chromosome copies the length
+        weighted mean copy-number, and genomic instability the mean, across chromosomes, of the
+        fraction of the chromosome with copy-number different from the (rounded) ploidy.
 
+        :param cn_seg: pandas.DataFrame
+            Segments with sample_col, chr_col, "start", "end" and "copy_number" columns
+
+        :param exclude_chrs: list
+            Chromosomes excluded, by default the sex chromosomes
+
+        :return: (pandas.Series, pandas.DataFrame, pandas.Series)
+            Ploidy, chromosome copies (samples x chromosomes) and genomic instability
+        """
         # Use only autosomal chromosomes
-        cn_seg = cn_seg[~cn_seg["chr"].isin(["chrX", "chrY"])]
-        cn_seg = cn_seg[~cn_seg["chr"].isin([23, 24])]
+        cn_seg = cn_seg[~cn_seg[chr_col].isin(exclude_chrs)]
 
-        # Segment length
-        cn_seg = cn_seg.assign(length=cn_seg.eval("end - start"))
+        cn = cn_seg["copy_number"].values.astype(float)
+        length = (cn_seg["end"] - cn_seg["start"]).values.astype(float)
 
-        # Calculate genomic instability
-        s_instability = {}
-        for s, df in cn_seg.groupby("model_id"):
-            s_ploidy = np.round(cls.calculate_ploidy(df), 0)
+        s_codes, samples = pd.factorize(cn_seg[sample_col], sort=True)
+        c_codes, chrs = pd.factorize(cn_seg[chr_col], sort=True)
 
-            s_chr = []
-            # c, c_df = list(df.groupby("chr"))[0]
-            for c, c_df in df.groupby("chr"):
-                c_gain = (
-                    c_df[c_df["copy_number"] > s_ploidy]["length"].sum()
-                    / c_df["length"].sum()
-                )
-                c_loss = (
-                    c_df[c_df["copy_number"] < s_ploidy]["length"].sum()
-                    / c_df["length"].sum()
-                )
-                s_chr.append(c_gain + c_loss)
+        # Ploidy
+        ploidy = cls.grouped_weighted_median(cn, length, s_codes, len(samples))
+
+        # Chromosome copies
+        sc_codes = s_codes * len(chrs) + c_codes
+        sc_shape = (len(samples), len(chrs))
+
+        chr_length = np.bincount(
+            sc_codes, weights=length, minlength=np.prod(sc_shape)
+        ).reshape(sc_shape)
 
-            s_instability[s] = np.mean(s_chr)
+        chr_cn = np.bincount(
+            sc_codes, weights=length * cn, minlength=np.prod(sc_shape)
+        ).reshape(sc_shape)
 
-        s_instability = pd.Series(s_instability)
-        return s_instability
+        # Fraction of chromosomes with gains or losses
+        s_ploidy = np.round(ploidy, 0)[s_codes]
+        altered = length * ((cn > s_ploidy) | (cn < s_ploidy))
+
+        chr_altered = np.bincount(
+            sc_codes, weights=altered, minlength=np.prod(sc_shape)
+        ).reshape(sc_shape)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            chr_cn = np.where(chr_length > 0, chr_cn / chr_length, np.nan)
+            chr_altered = np.where(chr_length > 0, chr_altered / chr_length, np.nan)
+
+        ploidy = pd.Series(ploidy, index=samples)
+        chr_cn = pd.DataFrame(chr_cn, index=samples, columns=chrs)
+        instability = pd.Series(np.nanmean(chr_altered, axis=1), index=samples)
+
+        return ploidy, chr_cn, instability
 
     @classmethod
     def calculate_ploidy(cls, cn_seg):
@@ -1257,39 +1320,64 @@ class CopyNumber:
 
         return ploidy
 
-        # cn_seg = cn_seg.assign(length=cn_seg["end"] - cn_seg["start"])
-        # cn_seg = cn_seg.assign(
-        #     cn_by_length=cn_seg["length"] * (cn_seg["copy_number"] + 1)
-        # )
-        #
-        # chrm = (
-        #     cn_seg.groupby("chr")["cn_by_length"]
-        #     .sum()
-        #     .divide(cn_seg.groupby("chr")["length"].sum())
-        #     - 1
-        # )
-        #
-        # ploidy = (cn_seg["cn_by_length"].sum() / cn_seg["length"].sum()) - 1
-        #
-        # return chrm, ploidy
+    @classmethod
+    def weighted_median(cls, data, weights):
+        # Origingal code: https://gist.github.com/tinybike/d9ff1dad515b66cc0d87
+        data, weights = np.array(data).reshape(-1), np.array(weights).reshape(-1)
+        return cls.grouped_weighted_median(data, weights, np.zeros(len(data), int), 1)[
+            0
+        ]
 
     @staticmethod
-    def weighted_median(data, weights):
-        # Origingal code: https://gist.github.com/tinybike/d9ff1dad515b66cc0d87
-        data, weights = np.array(data).squeeze(), np.array(weights).squeeze()
-        s_data, s_weights = map(np.array, zip(*sorted(zip(data, weights))))
-        midpoint = 0.5 * sum(s_weights)
+    def grouped_weighted_median(data, weights, groups, n_groups):
+        """
+        Weighted median of the values of each group, see weighted_median.
 
-        if any(weights > midpoint):
-            w_median = (data[weights == np.max(weights)])[0]
+        :param data: numpy.ndarray
 
-        else:
-            cs_weights = np.cumsum(s_weights)
-            idx = np.where(cs_weights <= midpoint)[0][-1]
-            if cs_weights[idx] == midpoint:
-                w_median = np.mean(s_data[idx : idx + 2])
-            else:
-                w_median = s_data[idx + 1]
+        :param weights: numpy.ndarray
+
+        :param groups: numpy.ndarray
+            Group code, from 0 to n_groups - 1, of each value. All groups must have values
+
+        :param n_groups: int
+
+        :return: numpy.ndarray
+        """
+        # Sort by group, value and weight
+        order = np.lexsort((weights, data, groups))
+        s_groups, s_data, s_weights = groups[order], data[order], weights[order]
+
+        g_starts = np.searchsorted(s_groups, np.arange(n_groups), side="left")
+        g_ends = np.searchsorted(s_groups, np.arange(n_groups), side="right")
+
+        # Cumulative weights within each group
+        cs_weights = np.cumsum(s_weights)
+        cs_weights -= np.r_[0, cs_weights][g_starts][s_groups]
+
+        midpoint = 0.5 * cs_weights[g_ends - 1]
+
+        # Value of the weight larger than half of the total (first of the maximum weights)
+        max_weights = np.maximum.reduceat(s_weights, g_starts)
+
+        is_max = weights == max_weights[groups]
+        first_max = np.full(n_groups, len(data))
+        np.minimum.at(first_max, groups[is_max], np.flatnonzero(is_max))
+
+        # Otherwise, value where the cumulative weight crosses the midpoint
+        idx = g_starts + np.add.reduceat(cs_weights <= midpoint[s_groups], g_starts) - 1
+        idx = np.maximum(idx, g_starts)
+        idx_next = np.minimum(idx + 1, g_ends - 1)
+
+        w_median = np.where(
+            cs_weights[idx] == midpoint,
+            (s_data[idx] + s_data[idx_next]) / 2,
+            s_data[idx_next],
+        )
+
+        w_median = np.where(
+            max_weights > midpoint, data[np.minimum(first_max, len(data) - 1)], w_median
+        )
 
         return w_median
 
@@ -1326,7 +1414,9 @@ class Methylation:
     def __init__(
         self, methy_gene_promoter="methylation/methy_beta_gene_promoter.csv.gz"
     ):
-        self.methy_promoter = pd.read_csv(f"{DPATH}/{methy_gene_promoter}", index_col=0)
+        self.methy_promoter = TABLE_CACHE.read_csv(
+            f"{DPATH}/{methy_gene_promoter}", index_col=0
+        )
 
     def get_data(self):
         return self.methy_promoter.copy()
@@ -1354,7 +1444,7 @@ class CopyNumberSegmentation:
     def __init__(
         self, cnv_file="copy_number/Summary_segmentation_data_994_lines_picnic.csv.gz"
     ):
-        self.copynumber = pd.read_csv(f"{DPATH}/{cnv_file}")
+        self.copynumber = TABLE_CACHE.read_csv(f"{DPATH}/{cnv_file}")
 
     def get_data(self):
         return self.copynumber.copy()
@@ -1399,17 +1489,17 @@ class PipelineResults:
 
     def import_bagel_results(self):
         # Bayesian factors
-        bf = pd.read_csv(
+        bf = TABLE_CACHE.read_csv(
             f"{self.results_dir}/_BayesianFactors.tsv", sep="\t", index_col=0
         )
 
         # Quantile normalised bayesian factors
-        bf_q = pd.read_csv(
+        bf_q = TABLE_CACHE.read_csv(
             f"{self.results_dir}/_scaledBayesianFactors.tsv", sep="\t", index_col=0
         )
 
         # Binarised bayesian factors
-        bf_b = pd.read_csv(
+        bf_b = TABLE_CACHE.read_csv(
             f"{self.results_dir}/_binaryDepScores.tsv", sep="\t", index_col=0
         )
 
@@ -1417,15 +1507,17 @@ class PipelineResults:
 
     def import_fc_results(self):
         # Fold-changes
-        fc = pd.read_csv(f"{self.results_dir}/_logFCs.tsv", sep="\t", index_col=0)
+        fc = TABLE_CACHE.read_csv(
+            f"{self.results_dir}/_logFCs.tsv", sep="\t", index_col=0
+        )
 
         # Copy-number corrected fold-changes
-        fc_c = pd.read_csv(
+        fc_c = TABLE_CACHE.read_csv(
             f"{self.results_dir}/_corrected_logFCs.tsv", sep="\t", index_col=0
         )
 
         # Quantile normalised copy-number corrected fold-changes
-        fc_cq = pd.read_csv(
+        fc_cq = TABLE_CACHE.read_csv(
             f"{self.results_dir}/_qnorm_corrected_logFCs.tsv", sep="\t", index_col=0
         )
 
@@ -1439,7 +1531,7 @@ class PipelineResults:
 
     def import_mageck_results(self):
         # Dependencies FDR
-        mdep_fdr = pd.read_csv(
+        mdep_fdr = TABLE_CACHE.read_csv(
             f"{self.results_dir}/_MageckFDRs.tsv", sep="\t", index_col=0
         )
         mdep_bin = (mdep_fdr < self.mageck_fdr_thres).astype(int)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# Copyright (C) 2019 Emanuel Goncalves
+
+import numpy as np
+
+
+class IntervalIndex:
+    """
+    Sorted per-chromosome index of genomic intervals (e.g. sgRNAs of a CRISPR library) supporting
+    vectorised overlap queries with NumPy binary searches, as a replacement of bedtools intersect.
+
+    Intervals follow the BED convention (0-based, half-open), i.e. two intervals overlap if
+    start_a < end_b and end_a > start_b.
+
+    """
+
+    # Offset used to build a monotonically increasing (chromosome, start) key
+    CHR_OFFSET = 2 ** 40
+
+    def __init__(self, chrm, start, end, ids=None):
+        """
+        :param chrm: array-like
+            Chromosome of each interval
+
+        :param start: array-like
+            Start position of each interval
+
+        :param end: array-like
+            End position of each interval
+
+        :param ids: array-like, optional
+            Identifier of each interval (e.g. sgRNA IDs), kept in the original order
+
+        """
+        chrm = np.asarray(chrm).astype(str)
+        start = np.asarray(start, dtype=np.int64)
+        end = np.asarray(end, dtype=np.int64)
+
+        # Sort intervals by chromosome, start and end
+        self.chromosomes, chr_codes = np.unique(chrm, return_inverse=True)
+        self.rows = np.lexsort((end, start, chr_codes))
+
+        self.starts = start[self.rows]
+        self.ends = end[self.rows]
+        self.offsets = np.searchsorted(
+            chr_codes[self.rows], np.arange(len(self.chromosomes) + 1)
+        )
+
+        self.keys = chr_codes[self.rows] * self.CHR_OFFSET + self.starts
+        self.max_len = int((self.ends - self.starts).max()) if len(self.rows) else 0
+
+        self.ids = None if ids is None else np.asarray(ids)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @classmethod
+    def from_frame(cls, df, chr_col="Chr", start_col="Start", end_col="End"):
+        """
+        Build index from a data-frame of intervals (e.g. a CRISPR library), intervals with missing
+        coordinates are discarded and the data-frame index is used as identifiers.
+
+        :param df: pandas.DataFrame
+
+        :return: IntervalIndex
+        """
+        df = df[[chr_col, start_col, end_col]].dropna()
+        return cls(df[chr_col], df[start_col], df[end_col], ids=df.index)
+
+    def save(self, path):
+        """
+        Store index in a NumPy .npz file.
+
+        :param path: str
+        """
+        ids = self.ids
+
+        if ids is not None and ids.dtype == object:
+            ids = ids.astype(str)
+
+        arrays = dict(
+            chromosomes=self.chromosomes,
+            rows=self.rows,
+            starts=self.starts,
+            ends=self.ends,
+            offsets=self.offsets,
+        )
+
+        if ids is not None:
+            arrays["ids"] = ids
+
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load index stored with save.
+
+        :param path: str
+
+        :return: IntervalIndex
+        """
+        with np.load(path, allow_pickle=False) as npz:
+            index = cls.__new__(cls)
+
+            index.chromosomes = npz["chromosomes"]
+            index.rows = npz["rows"]
+            index.starts = npz["starts"]
+            index.ends = npz["ends"]
+            index.offsets = npz["offsets"]
+            index.ids = npz["ids"] if "ids" in npz else None
+
+        chr_codes = np.repeat(np.arange(len(index.chromosomes)), np.diff(index.offsets))
+
+        index.keys = chr_codes * cls.CHR_OFFSET + index.starts
+        index.max_len = int((index.ends - index.starts).max()) if len(index.rows) else 0
+
+        return index
+
+    def chromosome_codes(self, chrm):
+        """
+        Map chromosome names to the position in the index, -1 if not indexed.
+
+        :param chrm: array-like
+
+        :return: numpy.ndarray
+        """
+        chrm = np.asarray(chrm).astype(str)
+
+        if len(self.chromosomes) == 0:
+            return np.full(len(chrm), -1)
+
+        codes = np.searchsorted(self.chromosomes, chrm)
+        codes = np.clip(codes, 0, len(self.chromosomes) - 1)
+
+        return np.where(self.chromosomes[codes] == chrm, codes, -1)
+
+    def chromosome_at(self, pos):
+        """
+        Chromosome names of sorted positions in the index.
+
+        :param pos: numpy.ndarray
+            Sorted positions, as returned by query_positions
+
+        :return: numpy.ndarray
+        """
+        return self.chromosomes[np.searchsorted(self.offsets, pos, side="right") - 1]
+
+    def query(self, chrm, start, end):
+        """
+        Find all indexed intervals overlapping the query intervals.
+
+        :param chrm: array-like
+            Chromosome of each query interval
+
+        :param start: array-like
+            Start position of each query interval
+
+        :param end: array-like
+            End position of each query interval
+
+        :return: (numpy.ndarray, numpy.ndarray)
+            Pairs of overlapping (query position, indexed row position). Pairs are ordered by query
+            and then by the start position of the indexed intervals.
+        """
+        q_idx, pos = self.query_positions(chrm, start, end)
+        return q_idx, self.rows[pos]
+
+    def query_positions(self, chrm, start, end):
+        """
+        Same as query, but returns the sorted positions in the index (see starts, ends and
+        chromosome_at) instead of the original row positions.
+
+        :param chrm: array-like
+            Chromosome of each query interval
+
+        :param start: array-like
+            Start position of each query interval
+
+        :param end: array-like
+            End position of each query interval
+
+        :return: (numpy.ndarray, numpy.ndarray)
+        """
+        start = np.asarray(start, dtype=np.int64)
+        end = np.asarray(end, dtype=np.int64)
+
+        codes = self.chromosome_codes(chrm)
+        found = codes >= 0
+
+        # Candidate intervals start after (start - max_len) and before end
+        lo = np.searchsorted(
+            self.keys,
+            codes * self.CHR_OFFSET + np.maximum(start - self.max_len, -1),
+            side="right",
+        )
+        hi = np.searchsorted(self.keys, codes * self.CHR_OFFSET + end, side="left")
+
+        counts = np.where(found, np.maximum(hi - lo, 0), 0)
+
+        # Expand candidate ranges into (query, position) pairs
+        q_idx = np.repeat(np.arange(len(counts)), counts)
+        pos = (
+            np.arange(counts.sum())
+            - np.repeat(np.cumsum(counts) - counts, counts)
+            + np.repeat(lo, counts)
+        )
+
+        # Keep candidates ending after the query start
+        overlap = self.ends[pos] > start[q_idx]
+
+        return q_idx[overlap], pos[overlap]
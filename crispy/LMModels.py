@@ -1,19 +1,211 @@
 #!/usr/bin/env python
 # Copyright (C) 2019 Emanuel Goncalves
 
+import os
 import logging
 import numpy as np
 import pandas as pd
+import multiprocessing as mp
 from scipy.stats import chi2
 from sklearn.preprocessing import StandardScaler
 from sklearn.linear_model import LinearRegression
 from statsmodels.stats.multitest import multipletests
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 LOG = logging.getLogger("Crispy")
 
+GROUPED_METHODS = ["fdr_bh", "bonferroni", "holm"]
+
+
+def multipletests_grouped(pvals, groups=None, method="fdr_bh"):
+    """
+    Multiple testing correction of the p-values within each group, equal to statsmodels
+    multipletests applied per group. For the methods in GROUPED_METHODS all groups are corrected
+    together with a single sort (by group and p-value) and a segmented cumulative minimum
+    (Benjamini-Hochberg) or maximum (Holm) pass. Segments are kept apart by replacing the
+    corrected values with their integer ranks offset by the group, hence without loss of
+    precision. Other statsmodels methods are applied per group. Missing p-values are not
+    counted as tests and are returned as NaN.
+
+    :param pvals: numpy.ndarray
+    :param groups: numpy.ndarray, optional
+        Integer group of each p-value (e.g. pandas.DataFrame.groupby(...).ngroup()), one group
+        if None
+    :param method: str
+    :return: numpy.ndarray
+        Adjusted p-values
+    """
+    pvals = np.asarray(pvals, dtype=np.float64)
+    groups = np.zeros(len(pvals), dtype=np.int64) if groups is None else groups
+    groups = pd.factorize(np.asarray(groups))[0]
+
+    valid = ~np.isnan(pvals)
+    adjusted = np.full(len(pvals), np.nan)
+
+    if not valid.any():
+        return adjusted
+
+    p, g = pvals[valid], groups[valid]
+
+    if method not in GROUPED_METHODS:
+        adjusted[valid] = (
+            pd.Series(p)
+            .groupby(g)
+            .transform(lambda v: multipletests(v.values, method=method)[1])
+            .values
+        )
+        return adjusted
+
+    # Sort by group and p-value
+    order = np.lexsort((p, g))
+    p, g = p[order], g[order]
+
+    counts = np.bincount(g)
+    n = counts[g]
+    rank = np.arange(len(p)) - (np.cumsum(counts) - counts)[g] + 1
+
+    if method == "bonferroni":
+        corrected = p * n
+
+    elif method == "holm":
+        corrected = segmented_accumulate(np.maximum, p * (n - rank + 1), g)
+
+    else:
+        corrected = segmented_accumulate(np.minimum, p / (rank / n), g, reverse=True)
+
+    adjusted_valid = np.empty(len(p))
+    adjusted_valid[order] = np.minimum(corrected, 1)
+
+    adjusted[valid] = adjusted_valid
+
+    return adjusted
+
+
+def segmented_accumulate(ufunc, values, groups, reverse=False):
+    """
+    Cumulative minimum or maximum (ufunc) of values within consecutive groups, restarting at
+    each group. Values are replaced by their integer ranks, offset so that the ranks of a group
+    are beyond all the ranks of the previous groups in the accumulation direction.
+
+    :param ufunc: numpy.minimum or numpy.maximum
+    :param values: numpy.ndarray
+    :param groups: numpy.ndarray
+        Non-decreasing integer groups
+    :param reverse: bool
+        Accumulate from the end of the groups
+    :return: numpy.ndarray
+    """
+    unique, codes = np.unique(values, return_inverse=True)
+
+    # Accumulated groups ranks are kept beyond (after minimum, below maximum) the next groups
+    sign = 1 if (ufunc is np.minimum) == reverse else -1
+    offset = sign * groups.astype(np.int64) * len(unique)
+
+    keys = codes.reshape(-1) + offset
+
+    if reverse:
+        keys = ufunc.accumulate(keys[::-1])[::-1]
+
+    else:
+        keys = ufunc.accumulate(keys)
+
+    return unique[keys - offset]
+
+
+class NaNBuckets:
+    """
+    Planner grouping the variables (columns) of a matrix by their pattern of missing values, so
+    that the work depending only on the observed samples (e.g. covariates factorisation, kinship
+    eigendecomposition) is done once per bucket and its variables processed as one batch.
+    Buckets are visited by decreasing number of variables, and progress is logged per bucket.
+
+    """
+
+    def __init__(self, values, label="Bucket", verbose=1):
+        """
+        :param values: numpy.ndarray
+            Samples (rows) x variables (columns), missing values as NaN
+
+        :param label: str
+            Name of the buckets in the log messages
+
+        :param verbose: int
+            Log progress of each bucket if > 0
+        """
+        observed = ~np.isnan(values)
+
+        _, inverse, counts = np.unique(
+            np.packbits(observed, axis=0).T,
+            axis=0,
+            return_inverse=True,
+            return_counts=True,
+        )
+        inverse = inverse.reshape(-1)
+
+        # Variables of each bucket, in their original order
+        columns = np.split(np.argsort(inverse, kind="stable"), np.cumsum(counts)[:-1])
+        columns = sorted(columns, key=len, reverse=True)
+
+        self.masks = [observed[:, c[0]] for c in columns]
+        self.columns = columns
+
+        self.label = label
+        self.verbose = verbose
+
+        self.n_variables = values.shape[1]
+        self.done = 0
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __iter__(self):
+        self.done = 0
+
+        for i, (mask, columns) in enumerate(zip(self.masks, self.columns)):
+            if self.verbose > 0:
+                LOG.info(
+                    f"{self.label} {i + 1}/{len(self)}: #(variables)={len(columns)}, "
+                    f"#(samples)={mask.sum()} ({self.progress:.1%} done)"
+                )
+
+            yield mask, columns
+
+            self.done += len(columns)
+
+    @property
+    def progress(self):
+        """
+        Fraction of the variables already processed
+        """
+        return self.done / self.n_variables if self.n_variables else 1.0
+
+    def stats(self):
+        """
+        Number of variables and observed samples of each bucket
+
+        :return: pandas.DataFrame
+        """
+        return pd.DataFrame(
+            dict(
+                variables=[len(c) for c in self.columns],
+                samples=[m.sum() for m in self.masks],
+            )
+        ).rename_axis("bucket")
+
+    def log_stats(self):
+        stats = self.stats()
+
+        LOG.info(
+            f"{self.label}s: #(variables)={self.n_variables}, #(buckets)={len(self)}, "
+            f"largest={stats['variables'].max() if len(self) else 0}, "
+            f"singletons={(stats['variables'] == 1).sum()}"
+        )
+
 
 class LModel:
+    ENGINES = ["qr", "sklearn"]
+
     def __init__(
         self,
         Y,
@@ -25,7 +217,28 @@ class LModel:
         copy_X=True,
         n_jobs=4,
         verbose=1,
+        engine="qr",
+        jitter=1e-4,
     ):
+        """
+        Linear regression likelihood-ratio tests of each X feature against every Y variable,
+        with covariates M (and M2, the covariate of each X feature).
+
+        :param engine: str
+            One of ENGINES. "qr" groups the X features by missing values (see NaNBuckets),
+            factorises the covariates once per bucket (pivoted QR decomposition, which handles
+            linearly dependent covariates) and computes betas, residual sums of squares and
+            likelihood-ratios of all X features and Y variables of the bucket with matrix
+            products. "sklearn" fits two LinearRegression models per X feature.
+
+        :param jitter: float
+            Standard deviation of the noise added to the covariates of each X feature by the
+            "sklearn" engine, to avoid singular covariates. The "qr" engine does not need it and
+            matches the least-squares fits of the "sklearn" engine with jitter=0.
+
+        """
+        assert engine in self.ENGINES, f"Engine {engine} not supported: {self.ENGINES}"
+
         self.samples = set.intersection(
             set(Y.index),
             set(X.index),
@@ -33,21 +246,23 @@ class LModel:
             set(Y.index) if M2 is None else set(M2.index),
         )
 
-        self.X = X.loc[self.samples]
+        self.X = X.loc[list(self.samples)]
         self.X = self.X.loc[:, self.X.count() > (M.shape[1] + (1 if M2 is None else 2))]
         self.X_ma = np.ma.masked_invalid(self.X.values)
 
-        self.Y = Y.loc[self.samples]
+        self.Y = Y.loc[list(self.samples)]
         self.Y = self.Y.loc[:, self.Y.std() > 0]
 
-        self.M = M.loc[self.samples]
+        self.M = M.loc[list(self.samples)]
 
-        self.M2 = M2.loc[self.samples, self.X.columns] if M2 is not None else M2
+        self.M2 = M2.loc[list(self.samples), self.X.columns] if M2 is not None else M2
 
         self.normalize = normalize
         self.fit_intercept = fit_intercept
         self.copy_X = copy_X
         self.n_jobs = n_jobs
+        self.engine = engine
+        self.jitter = jitter
 
         self.verbose = verbose
         self.log = logging.getLogger("Crispy")
@@ -76,75 +291,245 @@ class LModel:
     def multipletests_per(
         associations, method="fdr_bh", field="pval", fdr_field="fdr", index_cols=None
     ):
+        """
+        Multiple testing correction of the field p-values within each group of index_cols, see
+        multipletests_grouped.
+
+        :return: pandas.DataFrame
+            Associations with the adjusted p-values in fdr_field
+        """
         index_cols = ["y_id"] if index_cols is None else index_cols
 
-        d_unique = {tuple(i) for i in associations[index_cols].values}
+        groups = associations.groupby(index_cols, sort=False, dropna=False).ngroup()
 
-        df = associations.set_index(index_cols)
+        return associations.assign(
+            **{
+                fdr_field: multipletests_grouped(
+                    associations[field].values, groups.values, method=method
+                )
+            }
+        )
 
-        df = pd.concat(
-            [
-                df.loc[i]
-                .assign(fdr=multipletests(df.loc[i, field], method=method)[1])
-                .rename(columns={"fdr": fdr_field})
-                for i in d_unique
-            ]
-        ).reset_index()
+    def lr_sklearn(self, m, x, y):
+        """
+        Likelihood-ratio test of the covariates model against covariates + feature, fitting two
+        LinearRegression models
 
-        return df
+        :return: (numpy.ndarray, numpy.ndarray)
+            Betas of the feature and likelihood-ratios of each Y variable
+        """
+        # Fit covariate model
+        lm_small = self.model_regressor().fit(m, y)
+        lm_small_ll = self.loglike(y, lm_small.predict(m))
 
-    def fit_matrix(self):
-        lms = []
+        # Fit full model: covariates + feature
+        lm_full_x = np.concatenate([m, x], axis=1)
+        lm_full = self.model_regressor().fit(lm_full_x, y)
+        lm_full_ll = self.loglike(y, lm_full.predict(lm_full_x))
 
-        for x_idx, x_var in enumerate(self.X):
-            if self.verbose > 0:
-                self.log.info(f"LM={x_var} ({x_idx})")
-
-            # Mask NaNs
-            x_ma = np.ma.mask_rowcols(self.X_ma[:, [x_idx]], axis=0)
-
-            # Build matrices
-            x = self.X.iloc[~x_ma.mask.any(axis=1), [x_idx]]
-            y = self.Y.iloc[~x_ma.mask.any(axis=1), :]
-
-            # Covariate matrix (remove invariable features and add noise)
-            m = self.M.iloc[~x_ma.mask.any(axis=1), :]
-            if self.M2 is not None:
-                m2 = self.M2.iloc[~x_ma.mask.any(axis=1), [x_idx]]
-                m = pd.concat([m2, m], axis=1)
-            m = m.loc[:, m.std() > 0]
-            m += np.random.normal(0, 1e-4, m.shape)
-
-            # Fit covariate model
-            lm_small = self.model_regressor().fit(m, y)
-            lm_small_ll = self.loglike(y, lm_small.predict(m))
-
-            # Fit full model: covariates + feature
-            lm_full_x = np.concatenate([m, x], axis=1)
-            lm_full = self.model_regressor().fit(lm_full_x, y)
-            lm_full_ll = self.loglike(y, lm_full.predict(lm_full_x))
-
-            # Log-ratio test
-            lr = 2 * (lm_full_ll - lm_small_ll)
-            lr_pval = chi2(1).sf(lr)
-
-            # Assemble + append results
-            res = pd.DataFrame(
-                dict(
-                    y_id=y.columns,
-                    x_id=x_var,
-                    n=y.attrs["nan_mask"].loc[y.columns, x.index].sum(1) if "nan_mask" in y.attrs else len(x),
-                    beta=lm_full.coef_[:, -1],
-                    lr=lr.values,
-                    covs=m.shape[1],
-                    pval=lr_pval,
-                    fdr=multipletests(lr_pval, method="fdr_bh")[1],
-                )
+        return lm_full.coef_[:, -1], np.asarray(2 * (lm_full_ll - lm_small_ll))
+
+    @staticmethod
+    def covariates_basis(m, fit_intercept=True, rtol=1e-10):
+        """
+        Orthonormal basis of the covariates column space (and intercept), with a pivoted QR
+        decomposition discarding linearly dependent columns
+
+        :param m: numpy.ndarray
+
+        :return: numpy.ndarray
+        """
+        from scipy.linalg import qr
+
+        if fit_intercept:
+            m = np.concatenate([np.ones((m.shape[0], 1)), m], axis=1)
+
+        q, r, _ = qr(m, mode="economic", pivoting=True)
+
+        diag = np.abs(np.diag(r))
+        rank = (diag > rtol * diag[0]).sum() if len(diag) else 0
+
+        return q[:, :rank]
+
+    def lr_qr(self, m, x, y, m2=None):
+        """
+        Likelihood-ratio tests of the covariates model against covariates + feature, for every
+        feature and Y variable sharing the same samples, with closed form solutions. Y and the
+        features are projected onto the orthogonal complement of the covariates
+        (Frisch-Waugh-Lovell), a feature beta is the regression of the Y residuals on the feature
+        residuals and the residual sum of squares (RSS) of the full model decreases by
+        beta * (rx' ry), hence LR = 2 * (llf_full - llf_small) = -n * log(1 - beta * (rx' ry) / RSS).
+
+        The covariate of each feature (m2) is added to the covariates as a rank-one update of
+        the orthogonal complement.
+
+        :param m: numpy.ndarray
+            Covariates, samples x covariates
+
+        :param x: numpy.ndarray
+            Features, samples x features
+
+        :param y: numpy.ndarray
+            Y variables, samples x variables
+
+        :param m2: numpy.ndarray, optional
+            Covariate of each feature, samples x features
+
+        :return: (numpy.ndarray, numpy.ndarray)
+            Betas and likelihood-ratios, features x Y variables
+        """
+        q = self.covariates_basis(m, self.fit_intercept)
+
+        # Residuals and residual sum of squares of the covariates model
+        ry = y - q @ (q.T @ y)
+        rss = np.einsum("ij,ij->j", ry, ry)[None, :]
+
+        # Features residuals and cross-products with the Y residuals
+        rx = x - q @ (q.T @ x)
+        rxx = np.einsum("ij,ij->j", rx, rx)
+        rxy = rx.T @ ry
+
+        if m2 is not None:
+            # Unit residuals of each feature covariate, zero if explained by the covariates
+            r2 = m2 - q @ (q.T @ m2)
+            r2_norm = np.sqrt(np.einsum("ij,ij->j", r2, r2))
+
+            valid = (np.std(m2, axis=0) > 0) & (
+                r2_norm > 1e-10 * np.sqrt(np.einsum("ij,ij->j", m2, m2))
+            )
+            e = np.where(valid, r2 / np.where(valid, r2_norm, 1), 0)
+
+            ey = e.T @ ry
+            ex = np.einsum("ij,ij->j", e, rx)
+
+            rss = rss - ey ** 2
+            rxy = rxy - ex[:, None] * ey
+            rxx = rxx - ex ** 2
+
+        # Features in the covariates space, i.e. no additional variance explained
+        collinear = rxx <= 1e-20 * np.einsum("ij,ij->j", x, x)
+
+        beta = rxy / np.where(collinear, 1, rxx)[:, None]
+        beta[collinear] = 0
+
+        lr = -y.shape[0] * np.log1p(-np.minimum(beta * rxy / rss, 1))
+
+        return beta, lr
+
+    def lr_results(self, y_columns, x_var, n, beta, lr, covs):
+        # Log-ratio test
+        lr_pval = chi2(1).sf(lr)
+
+        return pd.DataFrame(
+            dict(
+                y_id=y_columns,
+                x_id=x_var,
+                n=n,
+                beta=beta,
+                lr=lr,
+                covs=covs,
+                pval=lr_pval,
+                fdr=multipletests(lr_pval, method="fdr_bh")[1],
+            )
+        )
+
+    def fit_feature(self, x_idx, x_var):
+        """
+        Fit X feature with the "sklearn" engine
+
+        :return: pandas.DataFrame
+        """
+        if self.verbose > 0:
+            self.log.info(f"LM={x_var} ({x_idx})")
+
+        # Mask NaNs
+        x_ma = np.ma.mask_rowcols(self.X_ma[:, [x_idx]], axis=0)
+
+        # Build matrices
+        x = self.X.iloc[~x_ma.mask.any(axis=1), [x_idx]]
+        y = self.Y.iloc[~x_ma.mask.any(axis=1), :]
+
+        # Covariate matrix (remove invariable features and add noise)
+        m = self.M.iloc[~x_ma.mask.any(axis=1), :]
+        if self.M2 is not None:
+            m2 = self.M2.iloc[~x_ma.mask.any(axis=1), [x_idx]]
+            m = pd.concat([m2, m], axis=1)
+        m = m.loc[:, m.std() > 0]
+        m += np.random.normal(0, self.jitter, m.shape)
+
+        beta, lr = self.lr_sklearn(m, x, y)
+
+        return self.lr_results(
+            y.columns,
+            x_var,
+            y.attrs["nan_mask"].loc[y.columns, x.index].sum(1)
+            if "nan_mask" in y.attrs
+            else len(x),
+            beta,
+            lr,
+            m.shape[1],
+        )
+
+    def fit_bucket(self, rows, x_idxs):
+        """
+        Fit X features observed in the same samples with the "qr" engine
+
+        :param rows: numpy.ndarray
+            Observed samples (boolean mask)
+
+        :param x_idxs: numpy.ndarray
+            Positions of the X features
+
+        :return: dict
+            Results of each X feature position
+        """
+        x = self.X.values[rows][:, x_idxs].astype(np.float64)
+        y = self.Y.values[rows].astype(np.float64)
+
+        # Covariates (remove invariable features)
+        m = self.M.values[rows].astype(np.float64)
+        m = m[:, np.std(m, axis=0) > 0]
+
+        m2 = None
+
+        if self.M2 is not None:
+            m2 = self.M2.values[rows][:, x_idxs].astype(np.float64)
+
+        beta, lr = self.lr_qr(m, x, y, m2)
+
+        covs = m.shape[1] + (0 if m2 is None else (np.std(m2, axis=0) > 0).astype(int))
+        covs = np.broadcast_to(covs, len(x_idxs))
+
+        n = (
+            self.Y.attrs["nan_mask"].loc[self.Y.columns, self.X.index[rows]].sum(1)
+            if "nan_mask" in self.Y.attrs
+            else rows.sum()
+        )
+
+        return {
+            x_idx: self.lr_results(
+                self.Y.columns, self.X.columns[x_idx], n, beta[i], lr[i], covs[i]
             )
+            for i, x_idx in enumerate(x_idxs)
+        }
+
+    def fit_matrix(self):
+        lms = dict()
+
+        if self.engine == "qr":
+            buckets = NaNBuckets(self.X.values, label="LM bucket", verbose=self.verbose)
+            buckets.log_stats()
 
-            lms.append(res)
+            for rows, x_idxs in buckets:
+                lms.update(self.fit_bucket(rows, x_idxs))
 
-        lms = pd.concat(lms, ignore_index=True).sort_values("pval")
+        else:
+            for x_idx, x_var in enumerate(self.X):
+                lms[x_idx] = self.fit_feature(x_idx, x_var)
+
+        lms = pd.concat(
+            [lms[i] for i in range(self.X.shape[1])], ignore_index=True
+        ).sort_values("pval")
 
         return lms
 
@@ -177,8 +562,15 @@ class LModel:
 class LMModels:
     """"
     Class to perform the linear regression models
+
+    Linear mixed models are fitted with limix.qtl.scan (engine="limix") or with the native scan
+    (engine="native", see lmm_native), which eigendecomposes the random effects matrix once per
+    subset of samples and supports only the normal likelihood. By default (engine=None) limix
+    is used if installed, see default_engine.
     """ ""
 
+    ENGINES = ["native", "limix"]
+
     RES_ORDER = [
         "y_id",
         "x_id",
@@ -207,9 +599,20 @@ class LMModels:
         x_min_events=None,
         institute=True,
         verbose=1,
+        engine=None,
     ):
+        engine = self.default_engine(lik) if engine is None else engine
+
+        assert engine in self.ENGINES, f"Engine {engine} not supported: {self.ENGINES}"
+        assert (
+            engine != "native" or lik == "normal"
+        ), f"Likelihood {lik} not supported by the native engine, use engine='limix'"
+
+        LOG.info(f"LMM engine: {engine}")
+
         # Misc
         self.verbose = verbose
+        self.engine = engine
         self.x_feature_type = x_feature_type
         self.m2_feature_type = m2_feature_type
         self.add_intercept = add_intercept
@@ -228,7 +631,7 @@ class LMModels:
         self.m = self.define_covariates(institute=institute) if m is None else m.copy()
 
         # Samples overlap
-        self.samples = list(
+        self.samples = sorted(
             set.intersection(
                 set(y.index),
                 set(x.index),
@@ -264,6 +667,20 @@ class LMModels:
         else:
             self.m2, self.m2_columns = None, None
 
+    @staticmethod
+    def default_engine(lik="normal"):
+        """
+        limix if installed (or required by the likelihood), native otherwise
+
+        :return: str
+        """
+        import importlib.util
+
+        if lik != "normal" or importlib.util.find_spec("limix") is not None:
+            return "limix"
+
+        return "native"
+
     def __build_y(self, y):
         """
         Method to build the y matrix.
@@ -298,55 +715,120 @@ class LMModels:
 
         return x_.values, np.array(list(x_.columns))
 
-    def __prepare_inputs__(self, y_var):
-        # Define samples with NaNs
-        y_idx = list(self.y_columns).index(y_var)
-        y_nans_idx = np.isnan(self.y[:, y_idx])
+    def __bucket_inputs__(self, y_nans_idx):
+        """
+        Inputs shared by the Y variables with the same missing values (see NaNBuckets): X and
+        covariates of the observed samples and the random effects matrix subset.
 
-        if self.verbose > 0:
-            LOG.info(f"y_id: {y_var} ({y_idx}); N samples: {sum(1 - y_nans_idx)}")
+        :param y_nans_idx: numpy.ndarray
+            Boolean mask of the samples missing in Y
+        :return: dict
+        """
+        x_ = self.x[y_nans_idx == 0]
 
-        # Remove NaNs from y
-        y_ = self.y[y_nans_idx == 0][:, [y_idx]]
+        m_ = self.m[y_nans_idx == 0]
+        m_ = m_[:, np.std(m_, axis=0) > 0]
 
-        # Subset X
-        x_ = self.x[y_nans_idx == 0]
+        return dict(
+            y_nans_idx=y_nans_idx,
+            x_=x_,
+            x_std=np.std(x_, axis=0) > 0,
+            m_=m_,
+            m2_=None if self.m2 is None else self.m2[y_nans_idx == 0],
+            k_=self.k[:, y_nans_idx == 0][y_nans_idx == 0, :],
+        )
+
+    def __x_mask__(self, y_var, bucket):
+        """
+        X features tested against y_var, according to x_feature_type.
+
+        :return: numpy.ndarray
+            Boolean mask of the X columns
+        """
+        y_idx = list(self.y_columns).index(y_var)
 
         if self.x_feature_type == "drop_y":
             if y_var not in self.x_columns:
                 LOG.warning(f"[x_feature_type=drop_y] Y feature {y_idx} not in X")
 
-            x_ = x_[:, self.x_columns != y_var]
-            x_vars = self.x_columns[self.x_columns != y_var]
+            return self.x_columns != y_var
 
         elif self.x_feature_type == "same_y":
             if y_var not in self.x_columns:
                 LOG.error(f"[x_feature_type=same_y] Y feature {y_idx} not in X")
 
-            x_ = x_[:, self.x_columns == y_var]
-            x_vars = self.x_columns[self.x_columns == y_var]
+            return self.x_columns == y_var
 
         else:
-            x_vars = self.x_columns[np.std(x_, axis=0) > 0]
-            x_ = x_[:, np.std(x_, axis=0) > 0]
+            return bucket["x_std"]
+
+    def __bucket_eigh__(self, bucket):
+        """
+        Eigendecomposition of the bucket random effects matrix and X rotated into its
+        eigenbasis, computed once and stored in the bucket.
+
+        :return: (numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray)
+            Eigenvalues, eigenvectors, rotated X and its squares
+        """
+        if "k_eigh" not in bucket:
+            from scipy.linalg import eigh
+
+            s, u = eigh(bucket["k_"])
+            bucket["k_eigh"] = np.clip(s, 0, None), u
+            bucket["xt_"] = u.T @ bucket["x_"]
+            bucket["xt2_"] = bucket["xt_"] ** 2
+
+        return bucket["k_eigh"] + (bucket["xt_"], bucket["xt2_"])
+
+    def __prepare_inputs__(self, y_var, bucket=None):
+        # Define samples with NaNs
+        y_idx = list(self.y_columns).index(y_var)
+
+        if bucket is None:
+            bucket = self.__bucket_inputs__(np.isnan(self.y[:, y_idx]))
+
+        y_nans_idx = bucket["y_nans_idx"]
+
+        if self.verbose > 0:
+            LOG.info(f"y_id: {y_var} ({y_idx}); N samples: {sum(1 - y_nans_idx)}")
+
+        # Remove NaNs from y
+        y_ = self.y[y_nans_idx == 0][:, [y_idx]]
+
+        # Subset X
+        x_mask = self.__x_mask__(y_var, bucket)
+        x_, x_vars = bucket["x_"], self.x_columns[x_mask]
+
+        if not x_mask.all():
+            x_ = x_[:, x_mask]
 
         # Subset m
-        m_ = self.m[y_nans_idx == 0]
-        m_ = m_[:, np.std(m_, axis=0) > 0]
+        m_ = bucket["m_"]
 
         if (self.m2 is not None) and (self.m2_feature_type == "same_y"):
-            m_ = np.append(
-                m_, self.m2[y_nans_idx == 0][:, self.m2_columns == y_var], axis=1
-            )
+            m_ = np.append(m_, bucket["m2_"][:, self.m2_columns == y_var], axis=1)
 
         if self.add_intercept:
             m_ = np.insert(m_, m_.shape[1], values=1, axis=1)
 
         # Subset random effects matrix
-        k_ = self.k[:, y_nans_idx == 0][y_nans_idx == 0, :]
+        k_ = bucket["k_"]
 
         return y_, y_nans_idx, x_, x_vars, m_, k_
 
+    def y_buckets(self):
+        """
+        Y variables grouped by missing values, see NaNBuckets
+
+        :return: generator of (dict, list)
+            Inputs shared by the bucket (see __bucket_inputs__) and its Y variables
+        """
+        buckets = NaNBuckets(self.y, label="Y bucket", verbose=self.verbose)
+        buckets.log_stats()
+
+        for mask, columns in buckets:
+            yield self.__bucket_inputs__(~mask), list(self.y_columns[columns])
+
     @staticmethod
     def log_likelihood(y_true, y_pred):
         n = len(y_true)
@@ -360,16 +842,171 @@ class LMModels:
 
         return float(ln_l)
 
-    def lmm(self, y_var):
+    @staticmethod
+    def lmm_weights(s, delta):
+        """
+        Inverse square root of the covariance eigenvalues, up to the total variance scale, i.e.
+        covariance = scale * ((1 - delta) * K + delta * I) = scale * U diag(d) U'.
+
+        :param s: numpy.ndarray
+            Eigenvalues of the random effects matrix K
+
+        :param delta: float
+            Fraction of the variance not explained by K
+
+        :return: (numpy.ndarray, numpy.ndarray)
+            Weights and eigenvalues d
         """
-        Linear regression method, using measurements of the y matrix for the variable specified by y_var.
+        d = (1 - delta) * s + delta
+        return 1 / np.sqrt(d), d
+
+    @classmethod
+    def lmm_null(cls, yt, mt, s, bounds=(1e-6, 1.0)):
+        """
+        Maximum likelihood variance ratio (delta) of the null model, y = M b + e, with
+        e ~ N(0, scale * ((1 - delta) * K + delta * I)). Y and M are rotated into the K eigenbasis,
+        hence for a given delta the covariance is diagonal and b and scale have closed form
+        solutions (weighted least squares), leaving a 1-D optimisation of delta.
+
+        :param yt: numpy.ndarray
+            Rotated y, U' y
+
+        :param mt: numpy.ndarray
+            Rotated covariates, U' M
+
+        :param s: numpy.ndarray
+            Eigenvalues of K
+
+        :return: float
+        """
+        from scipy.optimize import minimize_scalar
+
+        n = yt.shape[0]
+
+        def neg_lml(delta):
+            w, d = cls.lmm_weights(s, delta)
+
+            q = LModel.covariates_basis(mt * w[:, None], fit_intercept=False)
+            ry = yt * w - q @ (q.T @ (yt * w))
+
+            return 0.5 * (n * np.log(ry @ ry / n) + np.log(d).sum())
+
+        return minimize_scalar(neg_lml, bounds=bounds, method="bounded").x
+
+    @classmethod
+    def lmm_scan(cls, yt, mt, xt, s, delta, xt2=None):
+        """
+        Likelihood-ratio tests of the null model (see lmm_null) against null + feature, for
+        every feature with the variance ratio delta fixed, as in limix fast scanner. With the
+        weighted Y, M and X, features are tested with the closed form solutions of
+        LModel.lr_qr, the scale being re-estimated for each feature. The cross-products of the
+        weighted features residuals are computed from the rotated features, without weighted
+        copies of X: rx' ry = xw' ry and rx' rx = xw' xw - (q' xw)' (q' xw).
+
+        :param xt2: numpy.ndarray, optional
+            Squared rotated features, xt ** 2, if shared by multiple scans
+
+        :return: (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+            Betas, betas standard errors and likelihood-ratios of the features
+        """
+        n = yt.shape[0]
+        w, _ = cls.lmm_weights(s, delta)
+
+        q = LModel.covariates_basis(mt * w[:, None], fit_intercept=False)
+
+        ry = yt * w - q @ (q.T @ (yt * w))
+        rss = ry @ ry
+
+        qx = (q * w[:, None]).T @ xt
+        xx = (w ** 2) @ (xt ** 2 if xt2 is None else xt2)
+
+        rxx = xx - np.einsum("ij,ij->j", qx, qx)
+        rxy = (ry * w) @ xt
+
+        # Features in the covariates space
+        collinear = rxx <= 1e-10 * xx
+        rxx = np.where(collinear, np.inf, rxx)
+
+        beta = rxy / rxx
+        rss_full = rss - beta * rxy
+
+        beta_se = np.sqrt(rss_full / n / rxx)
+        lr = -n * np.log1p(-np.minimum(beta * rxy / rss, 1))
+
+        return beta, beta_se, lr
+
+    def lmm(self, y_var, bucket=None):
+        """
+        Linear mixed model associations of the y matrix variable specified by y_var, with the
+        engine of the class (see ENGINES).
 
         :param y_var: String y variable name
+        :param bucket: dict, optional
+            Inputs shared with the Y variables with the same missing values, see y_buckets
+        :return: pandas.DataFrame of the associations
+        """
+        if self.engine == "native":
+            return self.lmm_native(y_var, bucket)
+
+        return self.lmm_limix(y_var, bucket)
+
+    def lmm_native(self, y_var, bucket=None):
+        """
+        Native linear mixed model scan, see lmm_null and lmm_scan. The random effects matrix
+        eigendecomposition and rotated X are computed once per bucket of Y variables with the
+        same samples.
+
+        :param y_var: String y variable name
+        :param bucket: dict, optional
+            Inputs shared with the Y variables with the same missing values, see y_buckets
+        :return: pandas.DataFrame of the associations
+        """
+        if bucket is None:
+            y_idx = list(self.y_columns).index(y_var)
+            bucket = self.__bucket_inputs__(np.isnan(self.y[:, y_idx]))
+
+        y_, y_nans_idx, x_, x_vars, m_, k_ = self.__prepare_inputs__(y_var, bucket)
+
+        # Rotate into the random effects eigenbasis
+        s, u, xt, xt2 = self.__bucket_eigh__(bucket)
+
+        if len(x_vars) < len(self.x_columns):
+            x_mask = np.isin(self.x_columns, x_vars)
+            xt, xt2 = xt[:, x_mask], xt2[:, x_mask]
+
+        yt, mt = u.T @ y_[:, 0], u.T @ m_
+
+        # Fit null model and scan
+        delta = self.lmm_null(yt, mt, s)
+        beta, beta_se, lr = self.lmm_scan(yt, mt, xt, s, delta, xt2)
+
+        # Build results
+        lmm = pd.DataFrame(
+            dict(
+                y_id=y_var,
+                x_id=x_vars,
+                beta=beta.round(5),
+                beta_se=beta_se.round(5),
+                pval=chi2(1).sf(lr),
+                nsamples=sum(1 - y_nans_idx),
+                ncovariates=m_.shape[1],
+            )
+        )
+
+        return lmm
+
+    def lmm_limix(self, y_var, bucket=None):
+        """
+        Linear mixed model associations of the y matrix variable specified by y_var, using limix.
+
+        :param y_var: String y variable name
+        :param bucket: dict, optional
+            Inputs shared with the Y variables with the same missing values, see y_buckets
         :return: pandas.DataFrame of the associations
         """
         import limix
 
-        y_, y_nans_idx, x_, x_vars, m_, k_ = self.__prepare_inputs__(y_var)
+        y_, y_nans_idx, x_, x_vars, m_, k_ = self.__prepare_inputs__(y_var, bucket)
 
         # Linear Mixed Model
         lmm = limix.qtl.scan(G=x_, Y=y_, K=k_, M=m_, lik=self.lik, verbose=False)
@@ -390,14 +1027,158 @@ class LMModels:
 
         return lmm
 
-    def matrix_lmm(self, pval_adj="fdr_bh", pval_adj_overall=False):
-        # Iterate through Y variables
-        res = []
+    def lmm_chunks(self, chunk_size=100, exclude=None):
+        """
+        Y variables split in chunks of at most chunk_size variables with the same missing values
+        (see NaNBuckets).
+
+        :param exclude: set, optional
+            Y variables left out of the chunks, e.g. already written
+        :return: list of (numpy.ndarray, list)
+            Boolean mask of the samples missing in Y and Y variables of each chunk
+        """
+        exclude = set() if exclude is None else exclude
+
+        chunks = []
+
+        buckets = NaNBuckets(self.y, label="Y bucket", verbose=self.verbose)
+        buckets.log_stats()
+
+        for mask, columns in buckets:
+            y_vars = [y for y in self.y_columns[columns] if y not in exclude]
+
+            for i in range(0, len(y_vars), chunk_size):
+                chunks.append((~mask, y_vars[i : i + chunk_size]))
+
+        return chunks
+
+    def run_lmm(self, output_folder=None, n_jobs=1, chunk_size=100):
+        """
+        Associations of all Y variables, computed in chunks (see lmm_chunks) by a pool of
+        n_jobs worker processes sharing read-only copies of the class matrices (forked). The
+        associations of each Y variable are yielded as their chunk finishes and, if
+        output_folder is defined, written to {output_folder}/{y_var}.csv.gz. Y variables with
+        a file are read instead of computed, hence an interrupted run resumes from the written
+        Y variables. Files are not checked against the inputs, use a new output_folder if these
+        change.
+
+        :param output_folder: str, optional
+        :param n_jobs: int
+            Number of worker processes, -1 uses all CPUs
+        :param chunk_size: int
+            Maximum number of Y variables per chunk
+        :return: generator of pandas.DataFrame
+        """
+        done = []
+
+        if output_folder is not None:
+            os.makedirs(output_folder, exist_ok=True)
+
+            done = [
+                y
+                for y in self.y_columns
+                if os.path.exists(self.lmm_file(output_folder, y))
+            ]
+
+            for y_var in done:
+                yield self.read_lmm(self.lmm_file(output_folder, y_var))
+
+        pending = self.lmm_chunks(chunk_size, exclude=set(done))
+
+        if output_folder is not None:
+            LOG.info(
+                f"LMM Y variables: #(done)={len(done)}, "
+                f"#(pending)={len(self.y_columns) - len(done)}"
+            )
+
+        n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+
+        if n_jobs == 1 or len(pending) <= 1:
+            _init_lmm_worker(self)
+            results = (_lmm_chunk(*c) for c in pending)
+            executor, futures = None, []
+
+        else:
+            ctx = mp.get_context(
+                "fork" if "fork" in mp.get_all_start_methods() else None
+            )
+
+            executor = ProcessPoolExecutor(
+                max_workers=n_jobs,
+                mp_context=ctx,
+                initializer=_init_lmm_worker,
+                initargs=(self,),
+            )
+
+            futures = [executor.submit(_lmm_chunk, *c) for c in pending]
+            results = (f.result() for f in as_completed(futures))
+
+        try:
+            for chunk in results:
+                for y_var, res in chunk:
+                    if output_folder is not None:
+                        self.write_lmm_file(self.lmm_file(output_folder, y_var), res)
+
+                    yield res
+
+        finally:
+            if executor is not None:
+                for f in futures:
+                    f.cancel()
+
+                executor.shutdown(wait=True)
+
+            _LMM_STATE.clear()
+
+    @staticmethod
+    def lmm_file(output_folder, y_var):
+        return os.path.join(output_folder, f"{y_var}.csv.gz")
+
+    @staticmethod
+    def write_lmm_file(file, res):
+        res.to_csv(
+            f"{file}.{os.getpid()}.tmp",
+            index=False,
+            compression=dict(method="gzip", compresslevel=1),
+        )
+        os.replace(f"{file}.{os.getpid()}.tmp", file)
+
+    def read_lmm(self, file):
+        """
+        Associations of a Y variable written by write_lmm, with the Y and X ids types of the
+        class.
+
+        :return: pandas.DataFrame
+        """
+        ids = dict(y_id=self.y_columns, x_id=self.x_columns)
+        ids = {c: str if v.dtype.kind in "OUS" else v.dtype for c, v in ids.items()}
 
-        for y_var in self.y_columns:
-            res.append(self.lmm(y_var=y_var))
+        return pd.read_csv(file, dtype=ids)
 
-        res = pd.concat(res, ignore_index=True)
+    def matrix_lmm(
+        self,
+        pval_adj="fdr_bh",
+        pval_adj_overall=False,
+        n_jobs=1,
+        chunk_size=100,
+        output_folder=None,
+    ):
+        """
+        Associations of all Y variables with multiple testing correction, see run_lmm.
+
+        :param output_folder: str, optional
+            Folder of the Y variables associations, see write_lmm, to resume interrupted runs
+        :return: pandas.DataFrame
+        """
+        res = pd.concat(
+            list(self.run_lmm(output_folder, n_jobs, chunk_size)), ignore_index=True
+        )
+
+        # Keep Y variables order
+        y_order = pd.Series(np.arange(len(self.y_columns)), index=self.y_columns)
+        res = res.iloc[
+            np.argsort(y_order.reindex(res["y_id"]).values, kind="stable")
+        ].reset_index(drop=True)
 
         # Multiple p-value correction
         if pval_adj_overall:
@@ -408,11 +1189,13 @@ class LMModels:
 
         return res.sort_values("fdr")[self.RES_ORDER]
 
-    def write_lmm(self, output_folder):
-        for i in self.y_columns:
-            self.lmm(y_var=i).to_csv(
-                f"{output_folder}/{i}.csv.gz", index=False, compression="gzip"
-            )
+    def write_lmm(self, output_folder, n_jobs=1, chunk_size=100):
+        """
+        Write the associations of each Y variable to {output_folder}/{y_var}.csv.gz, skipping
+        the Y variables already written, see run_lmm.
+        """
+        for _ in self.run_lmm(output_folder, n_jobs, chunk_size):
+            pass
 
     @staticmethod
     def multipletests(
@@ -420,15 +1203,9 @@ class LMModels:
     ):
         idx_cols = ["y_id"] if idx_cols is None else idx_cols
 
-        parsed_results_adj = []
-
-        for idx, df in parsed_results.groupby(idx_cols):
-            df = df.assign(fdr=multipletests(df[field], method=pval_method)[1])
-            parsed_results_adj.append(df)
-
-        parsed_results_adj = pd.concat(parsed_results_adj, ignore_index=True)
-
-        return parsed_results_adj
+        return LModel.multipletests_per(
+            parsed_results, method=pval_method, field=field, index_cols=idx_cols
+        )
 
     @staticmethod
     def transform_matrix(matrix, t_type="scale", add_nan_mask=True, fillna_func=np.mean):
@@ -475,7 +1252,7 @@ class LMModels:
         from crispy.DataImporter import Sample
 
         # Imports
-        samplesheet = Sample().samplesheet
+        samplesheet = Sample.shared().samplesheet
 
         # Covariates
         covariates = []
@@ -535,3 +1312,25 @@ class LMModels:
             K /= K.values.diagonal().mean()
 
         return K.round(decimal_places)
+
+
+# Per-process state of LMModels.run_lmm workers
+_LMM_STATE = dict()
+
+
+def _init_lmm_worker(lmm):
+    _LMM_STATE["lmm"] = lmm
+
+
+def _lmm_chunk(y_nans_idx, y_vars):
+    lmm = _LMM_STATE["lmm"]
+
+    # Chunks of a bucket are consecutive, reuse its inputs (and random effects
+    # eigendecomposition) while the chunks share the same samples
+    if _LMM_STATE.get("bucket_key") != y_nans_idx.tobytes():
+        _LMM_STATE["bucket"] = lmm.__bucket_inputs__(y_nans_idx)
+        _LMM_STATE["bucket_key"] = y_nans_idx.tobytes()
+
+    bucket = _LMM_STATE["bucket"]
+
+    return [(y_var, lmm.lmm(y_var, bucket)) for y_var in y_vars]
@@ -0,0 +1,552 @@
+#!/usr/bin/env python
+# Copyright (C) 2019 Emanuel Goncalves
+
+import os
+import glob
+import pickle
+import logging
+import hashlib
+import numpy as np
+import pandas as pd
+from urllib.parse import quote, unquote
+from crispy.Utils import GeneSetScaler
+from crispy.CRISPRData import ReadCounts, GuideGeneMap
+
+
+LOG = logging.getLogger("Crispy")
+
+
+class IncrementalPipeline:
+    """
+    Incremental processing of a cohort of CRISPR screens, from read counts to scaled gene
+    fold-changes, storing the result of each stage per sample (shards) so that adding new screens
+    to a cohort only processes the new (or changed) samples. Stages:
+
+        norm            reads per million of each sample, sgRNAs with low counts in the sample
+                        controls discarded (before normalisation)
+        foldchange      log2 fold-change against the sample controls
+        correction      Crispy copy-number corrected fold-changes and GP fitted kernel
+        genes           gene corrected fold-changes, mean of the gene sgRNAs. Samples without
+                        copy-number segments are aggregated from their uncorrected fold-changes
+        scale           gene corrected fold-changes scaled by essential (-1) and non-essential (0)
+                        genes medians
+
+    Each shard is keyed by a content hash of its inputs (the sample read counts, its controls,
+    copy-number segments, library and stage parameters) chained with the hash of the previous
+    stage, hence changes are propagated downstream. Shards are stored as:
+
+        path/stage/sample/key.pkl
+
+    and cohort matrices are reassembled from the shards with matrix.
+
+    """
+
+    STAGES = ["norm", "foldchange", "correction", "genes", "scale"]
+
+    GENE_STAGES = ["genes", "scale"]
+
+    def __init__(
+        self,
+        path,
+        counts,
+        plasmids,
+        library,
+        segments_by_sample=None,
+        sample_col="model_id",
+        gene_col="Approved_Symbol",
+        min_count=30,
+        guide_index=None,
+        correct_kws=None,
+        essential=None,
+        non_essential=None,
+    ):
+        """
+        :param path: str
+            Shards directory
+
+        :param counts: pandas.DataFrame
+            Read counts, sgRNAs (rows) x samples and controls (columns), e.g. CRISPRDataSet.counts
+
+        :param plasmids: list or dict
+            Controls shared by all samples, or controls of each sample
+
+        :param library: pandas.DataFrame
+            CRISPR library indexed by sgRNA ID, with the Crispy CRISPR_LIB_COLUMNS and gene_col
+
+        :param segments_by_sample: dict or pandas.DataFrame, optional
+            Copy-number segments per sample (see Crispy.correct_matrix). Samples without segments
+            are not corrected, their genes and scale stages use the uncorrected fold-changes
+
+        :param min_count: int
+            Minimum mean read counts of the controls
+
+        :param correct_kws: dict, optional
+            Arguments passed to Crispy.correct_matrix, e.g. gp_approx, n_sgrna, kernel
+
+        :param essential: set, optional
+            See GeneSetScaler
+
+        :param non_essential: set, optional
+            See GeneSetScaler
+
+        """
+        if isinstance(segments_by_sample, pd.DataFrame):
+            segments_by_sample = dict(list(segments_by_sample.groupby(sample_col)))
+
+        self.path = path
+
+        self.counts = counts
+        self.plasmids = plasmids
+        self.library = library
+        self.segments_by_sample = (
+            dict() if segments_by_sample is None else segments_by_sample
+        )
+        self.gene_col = gene_col
+        self.min_count = min_count
+        self.guide_index = guide_index
+
+        self.correct_kws = dict() if correct_kws is None else correct_kws
+        assert (
+            "cohort" not in self.correct_kws
+        ), "Cohort modes not supported, use a fixed cohort kernel (correct_kws kernel)"
+
+        # Missing values are ignored per sample, hence each sample is scaled independently
+        self.scaler = GeneSetScaler(
+            essential=essential, non_essential=non_essential, dropna=False
+        )
+
+        if type(plasmids) is dict:
+            self.samples = [s for s in counts if s in plasmids]
+
+        else:
+            self.samples = [s for s in counts if s not in set(plasmids)]
+
+        self.controls = list(
+            dict.fromkeys(c for s in self.samples for c in self.get_controls(s))
+        )
+
+        self._keys = None
+
+    @classmethod
+    def from_dataset(cls, path, dataset, **kwargs):
+        """
+        :param dataset: crispy.CRISPRData.CRISPRDataSet
+
+        :return: IncrementalPipeline
+        """
+        return cls(path, dataset.counts, dataset.plasmids, dataset.lib, **kwargs)
+
+    def genes_source(self, sample):
+        """
+        Stage aggregated by the genes stage of sample, correction if the sample has copy-number
+        segments, foldchange otherwise
+        """
+        return "correction" if sample in self.segments_by_sample else "foldchange"
+
+    def get_controls(self, sample):
+        if type(self.plasmids) is dict:
+            return list(self.plasmids[sample])
+
+        return list(self.plasmids)
+
+    # - Content hashes
+    @staticmethod
+    def content_hash(*parts):
+        h = hashlib.sha1()
+
+        for p in parts:
+            if isinstance(p, (pd.DataFrame, pd.Series, pd.Index)):
+                p = pd.util.hash_pandas_object(p).values
+
+            if isinstance(p, np.ndarray):
+                h.update(str(p.dtype).encode())
+                p = np.ascontiguousarray(p).tobytes()
+
+            h.update(p if isinstance(p, bytes) else repr(p).encode())
+
+        return h.hexdigest()[:16]
+
+    @classmethod
+    def segments_hash(cls, segments):
+        """
+        Content hash of copy-number segments, independent of the row order and index (e.g. the
+        position of the sample rows in the segments file)
+        """
+        columns = [c for c in ["Chr", "Start", "End"] if c in segments]
+        columns += sorted((c for c in segments if c not in columns), key=str)
+
+        segments = segments[columns].sort_values(columns, kind="mergesort")
+
+        return cls.content_hash(
+            list(map(str, columns)),
+            pd.util.hash_pandas_object(segments, index=False).values,
+        )
+
+    def keys(self):
+        """
+        Content hash of each sample (rows) and stage (columns), the hash of a stage depends on
+        its inputs and on the hash of the previous stage.
+
+        :return: pandas.DataFrame
+        """
+        if self._keys is not None:
+            return self._keys
+
+        guides_key = self.content_hash(self.counts.index)
+
+        columns = set(self.samples).union(self.controls)
+
+        values = self.counts.values
+        counts_keys = {
+            s: self.content_hash(guides_key, values[:, i])
+            for i, s in enumerate(self.counts)
+            if s in columns
+        }
+
+        library_key = self.content_hash(
+            self.library.reindex(columns=["Chr", "Start", "End", self.gene_col])
+        )
+
+        genesets_key = self.content_hash(
+            sorted(map(str, self.scaler.essential)),
+            sorted(map(str, self.scaler.non_essential)),
+        )
+
+        correct_key = repr(sorted(self.correct_kws.items()))
+
+        keys = pd.DataFrame(index=self.samples, columns=self.STAGES, dtype=object)
+
+        for s in self.samples:
+            controls_keys = [counts_keys[c] for c in self.get_controls(s)]
+
+            keys.loc[s, "norm"] = self.content_hash(
+                "norm", counts_keys[s], controls_keys, self.min_count
+            )
+
+            keys.loc[s, "foldchange"] = self.content_hash(
+                "foldchange", keys.loc[s, "norm"], controls_keys
+            )
+
+            if s in self.segments_by_sample:
+                keys.loc[s, "correction"] = self.content_hash(
+                    "correction",
+                    keys.loc[s, "foldchange"],
+                    self.segments_hash(self.segments_by_sample[s]),
+                    library_key,
+                    correct_key,
+                )
+
+            keys.loc[s, "genes"] = self.content_hash(
+                "genes", keys.loc[s, self.genes_source(s)], library_key
+            )
+
+            keys.loc[s, "scale"] = self.content_hash(
+                "scale", keys.loc[s, "genes"], genesets_key
+            )
+
+        self._keys = keys
+
+        return self._keys
+
+    # - Shards
+    def shard_file(self, stage, sample, key):
+        return os.path.join(self.path, stage, quote(str(sample), safe=""), f"{key}.pkl")
+
+    def has_shard(self, stage, sample):
+        key = self.keys().loc[sample, stage]
+        return isinstance(key, str) and os.path.exists(
+            self.shard_file(stage, sample, key)
+        )
+
+    def read_shard(self, stage, sample):
+        with open(
+            self.shard_file(stage, sample, self.keys().loc[sample, stage]), "rb"
+        ) as f:
+            return pickle.load(f)
+
+    def write_shard(self, stage, sample, shard):
+        entry = self.shard_file(stage, sample, self.keys().loc[sample, stage])
+
+        # Remove shards of previous versions of the sample
+        for f in glob.glob(os.path.join(os.path.dirname(entry), "*.pkl")):
+            os.remove(f)
+
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+
+        with open(f"{entry}.{os.getpid()}.tmp", "wb") as f:
+            pickle.dump(shard, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(f"{entry}.{os.getpid()}.tmp", entry)
+
+    def status(self):
+        """
+        Samples (rows) x stages (columns) with an up-to-date shard, NaN if the stage does not
+        apply to the sample (e.g. controls or samples without copy-number)
+
+        :return: pandas.DataFrame
+        """
+        keys = self.keys()
+
+        return pd.DataFrame(
+            {
+                stage: [
+                    (
+                        self.has_shard(stage, s)
+                        if isinstance(keys.loc[s, stage], str)
+                        else np.nan
+                    )
+                    for s in keys.index
+                ]
+                for stage in self.STAGES
+            },
+            index=keys.index,
+        )
+
+    def pending(self, stage):
+        """
+        Samples without an up-to-date shard of stage
+
+        :return: list
+        """
+        keys = self.keys()[stage].dropna()
+        return [s for s in keys.index if not self.has_shard(stage, s)]
+
+    def prune(self):
+        """
+        Remove shards of samples no longer in the cohort
+        """
+        keys = self.keys()
+
+        for stage in self.STAGES:
+            for d in glob.glob(os.path.join(self.path, stage, "*")):
+                sample = unquote(os.path.basename(d))
+
+                if sample not in keys.index or not isinstance(
+                    keys.loc[sample, stage], str
+                ):
+                    for f in glob.glob(os.path.join(d, "*.pkl")):
+                        os.remove(f)
+
+                    os.rmdir(d)
+
+    # - Stages
+    def run(self, stages=None, n_jobs=1, batch_size=None):
+        """
+        Compute the shards of new or changed samples
+
+        :param stages: list, optional
+            Stages to run (and their upstream stages), all if None
+
+        :param n_jobs: int
+            Number of worker processes of the correction stage (see Crispy.correct_matrix)
+
+        :param batch_size: int, optional
+            Samples corrected per call of Crispy.correct_matrix, shards are written after each
+            batch. Defaults to 4 * n_jobs
+
+        :return: dict
+            Samples processed in each stage
+        """
+        stages = self.STAGES if stages is None else stages
+        last = max(self.STAGES.index(s) for s in stages)
+
+        processed = dict()
+
+        for stage in self.STAGES[: last + 1]:
+            samples = self.pending(stage)
+
+            LOG.info(f"Pipeline {stage}: #(samples)={len(samples)} pending")
+
+            if len(samples) > 0:
+                if stage == "correction":
+                    self.run_correction(samples, n_jobs, batch_size)
+
+                else:
+                    getattr(self, f"run_{stage}")(samples)
+
+            processed[stage] = samples
+
+        return processed
+
+    def low_counts_mask(self, controls):
+        """
+        sgRNAs with mean read counts of the controls above min_count
+
+        :return: pandas.Series
+        """
+        if self.min_count is None:
+            return pd.Series(True, index=self.counts.index)
+
+        return self.counts[controls].mean(1) >= self.min_count
+
+    def control_groups(self, samples):
+        """
+        Samples grouped by their controls
+
+        :return: dict
+            Tuple of controls to list of samples
+        """
+        groups = dict()
+
+        for s in samples:
+            groups.setdefault(tuple(self.get_controls(s)), []).append(s)
+
+        return groups
+
+    def run_norm(self, samples):
+        # Low counts are removed before normalisation, as remove_low_counts().norm_rpm()
+        for controls, group in self.control_groups(samples).items():
+            mask = self.low_counts_mask(list(controls))
+            norm = ReadCounts(self.counts.loc[mask, group]).norm_rpm()
+
+            for s in group:
+                self.write_shard("norm", s, dict(data=norm[s]))
+
+    def run_foldchange(self, samples):
+        for controls, group in self.control_groups(samples).items():
+            controls = list(controls)
+
+            mask = self.low_counts_mask(controls)
+
+            norm = ReadCounts(
+                pd.concat(
+                    [self.read_shard("norm", s)["data"] for s in group]
+                    + [ReadCounts(self.counts.loc[mask, controls]).norm_rpm()],
+                    axis=1,
+                )
+            )
+
+            if type(self.plasmids) is dict:
+                fc = norm.foldchange({s: controls for s in group})
+
+            else:
+                fc = norm.foldchange(controls)
+
+            for s in group:
+                self.write_shard("foldchange", s, dict(data=fc[s]))
+
+    def run_correction(self, samples, n_jobs=1, batch_size=None):
+        from crispy.CopyNumberCorrection import Crispy
+
+        if self.guide_index is None:
+            self.guide_index = Crispy.build_guide_index(self.library)
+
+        batch_size = 4 * max(n_jobs, 1) if batch_size is None else batch_size
+
+        for i in range(0, len(samples), batch_size):
+            batch = samples[i : i + batch_size]
+
+            fc = self.matrix("foldchange", batch)
+
+            corrected = Crispy.correct_matrix(
+                fc,
+                {s: self.segments_by_sample[s] for s in batch},
+                self.library,
+                n_jobs=n_jobs,
+                guide_index=self.guide_index,
+                **self.correct_kws,
+            )
+
+            for s in batch:
+                self.write_shard(
+                    "correction",
+                    s,
+                    dict(
+                        data=corrected[s].dropna(),
+                        kernel=corrected.attrs["kernels"][s],
+                    ),
+                )
+
+    def run_genes(self, samples):
+        uncorrected = [s for s in samples if self.genes_source(s) == "foldchange"]
+
+        if len(uncorrected) > 0:
+            LOG.warning(
+                f"Pipeline genes: #(samples)={len(uncorrected)} without copy-number "
+                "segments aggregated from uncorrected fold-changes"
+            )
+
+        fc = pd.concat(
+            [
+                self.matrix("correction", [s for s in samples if s not in uncorrected]),
+                self.matrix("foldchange", uncorrected),
+            ],
+            axis=1,
+        )[samples]
+
+        genes = GuideGeneMap(self.library, gene_col=self.gene_col).aggregate(fc)
+
+        for s in samples:
+            self.write_shard("genes", s, dict(data=genes[s].dropna()))
+
+    def run_scale(self, samples):
+        genes = self.scaler.transform(self.matrix("genes", samples))
+
+        for s in samples:
+            self.write_shard("scale", s, dict(data=genes[s].dropna()))
+
+    # - Cohort matrices
+    def matrix(self, stage, samples=None):
+        """
+        Cohort matrix of stage reassembled from the samples shards
+
+        :param stage: str
+            One of STAGES
+
+        :param samples: list, optional
+            Samples to assemble, defaults to all samples with an up-to-date shard
+
+        :return: pandas.DataFrame
+        """
+        assert stage in self.STAGES, f"Stage {stage} not supported: {self.STAGES}"
+
+        if samples is None:
+            samples = [
+                s for s in self.keys()[stage].dropna().index if self.has_shard(stage, s)
+            ]
+
+        if len(samples) == 0:
+            df = pd.DataFrame(columns=[], dtype=np.float64)
+
+        else:
+            df = pd.concat(
+                {s: self.read_shard(stage, s)["data"] for s in samples}, axis=1
+            ).reindex(columns=samples)
+
+        if stage not in self.GENE_STAGES:
+            df = df.reindex(self.counts.index)
+
+        return df
+
+    def kernels(self, samples=None):
+        """
+        Fitted GP kernels of the corrected samples
+
+        :return: dict
+        """
+        if samples is None:
+            samples = [
+                s
+                for s in self.keys()["correction"].dropna().index
+                if self.has_shard("correction", s)
+            ]
+
+        return {s: self.read_shard("correction", s)["kernel"] for s in samples}
+
+    def hyperparameters(self, samples=None):
+        """
+        Fitted GP kernel hyperparameters of the corrected samples
+
+        :return: pandas.DataFrame
+        """
+        kernels = self.kernels(samples)
+
+        return pd.DataFrame(
+            {
+                s: pd.Series(
+                    np.exp(k.theta),
+                    index=[h.name for h in k.hyperparameters if not h.fixed],
+                )
+                for s, k in kernels.items()
+            }
+        ).T
@@ -1,15 +1,21 @@
 #!/usr/bin/env python
 # Copyright (C) 2019 Emanuel Goncalves
 
+import os
+import hashlib
+import functools
 import numpy as np
 import pandas as pd
 import pkg_resources
-from scipy.stats import gaussian_kde, rankdata, norm, spearmanr, pearsonr
 
 
 class Utils(object):
     DPATH = pkg_resources.resource_filename("crispy", "data/")
 
+    CACHE_DIR = os.environ.get(
+        "CRISPY_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "crispy")
+    )
+
     CHR_ORDER = [
         "1",
         "2",
@@ -184,8 +190,28 @@ class Utils(object):
 
         return value
 
+    @staticmethod
+    def file_hash(path, algorithm="sha1", chunk_size=2 ** 20):
+        """
+        Hash of the content of a file
+
+        :param path: str
+
+        :return: str
+            Hexadecimal digest
+        """
+        h = hashlib.new(algorithm)
+
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                h.update(chunk)
+
+        return h.hexdigest()
+
     @staticmethod
     def qnorm(x):
+        from scipy.stats import rankdata, norm
+
         y = rankdata(x)
         y = -norm.isf(y / (len(x) + 1))
         return y
@@ -198,11 +224,28 @@ class Utils(object):
         copynumber = pd.read_csv("{}/{}".format(cls.DPATH, "example_copynumber.csv"))
         return raw_counts, copynumber
 
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def read_gene_set(path, column, sep=","):
+        """
+        Memoized gene set loader, each gene set file is parsed once per process. The returned
+        frozenset is the cached object shared by all callers, convert it (e.g. set(...)) to get a
+        mutable copy.
+
+        :param path: str
+
+        :param column: str
+            Column with the gene symbols
+
+        :return: frozenset
+        """
+        return frozenset(pd.read_csv(path, sep=sep)[column])
+
     @classmethod
     def get_essential_genes(
         cls, dfile="gene_sets/EssentialGenes.csv", return_series=True
     ):
-        geneset = set(pd.read_csv(f"{cls.DPATH}/{dfile}", sep="\t")["gene"])
+        geneset = set(cls.read_gene_set(f"{cls.DPATH}/{dfile}", "gene", sep="\t"))
 
         if return_series:
             geneset = pd.Series(list(geneset)).rename("essential")
@@ -213,7 +256,7 @@ class Utils(object):
     def get_non_essential_genes(
         cls, dfile="gene_sets/NonessentialGenes.csv", return_series=True
     ):
-        geneset = set(pd.read_csv(f"{cls.DPATH}/{dfile}", sep="\t")["gene"])
+        geneset = set(cls.read_gene_set(f"{cls.DPATH}/{dfile}", "gene", sep="\t"))
 
         if return_series:
             geneset = pd.Series(list(geneset)).rename("non-essential")
@@ -246,7 +289,9 @@ class Utils(object):
     @classmethod
     def get_adam_core_essential(cls, dfile="gene_sets/pancan_core.csv"):
         return set(
-            pd.read_csv(f"{cls.DPATH}/{dfile}")["ADAM PanCancer Core-Fitness genes"]
+            cls.read_gene_set(
+                f"{cls.DPATH}/{dfile}", "ADAM PanCancer Core-Fitness genes"
+            )
         )
 
     @classmethod
@@ -309,6 +354,8 @@ class Utils(object):
 
     @staticmethod
     def gkn(values, bound=1e7):
+        from scipy.stats import gaussian_kde
+
         kernel = gaussian_kde(values)
         kernel = pd.Series(
             {
@@ -323,6 +370,8 @@ class Utils(object):
 
     @staticmethod
     def two_vars_correlation(var1, var2, idx_set=None, method="pearson", verbose=0):
+        from scipy.stats import spearmanr, pearsonr
+
         if verbose > 0:
             print(f"Var1={var1.name}; Var2={var2.name}")
 
@@ -344,6 +393,157 @@ class Utils(object):
         return dict(corr=r, pval=p, len=len(idx_set))
 
 
+class GeneSetScaler:
+    """
+    Scale gene-level fold-changes so that the median of non-essential genes is 0 and the median of
+    essential genes is -1 in every sample:
+
+        (x - median(non_essential)) / (median(non_essential) - median(essential))
+
+    Positions of the gene sets are resolved once against an index and reused by every transform
+    with the same index (e.g. over subsets of samples), and medians are computed with NumPy on the
+    gathered rows only.
+
+    """
+
+    def __init__(
+        self,
+        index=None,
+        essential=None,
+        non_essential=None,
+        metric=np.nanmedian,
+        dropna=True,
+    ):
+        """
+        :param index: pandas.Index, optional
+            Genes index of the data-frames to scale, resolved on first transform if None
+
+        :param essential: set, optional
+            Defaults to Utils.get_essential_genes
+
+        :param non_essential: set, optional
+            Defaults to Utils.get_non_essential_genes
+
+        :param metric: callable
+            Column-wise summary, called as metric(values, axis=0)
+
+        :param dropna: bool
+            Discard gene set rows with missing values in any sample, as DataFrame.dropna
+
+        """
+        if essential is None:
+            essential = Utils.get_essential_genes(return_series=False)
+
+        if non_essential is None:
+            non_essential = Utils.get_non_essential_genes(return_series=False)
+
+        self.essential = pd.Index(list(essential))
+        self.non_essential = pd.Index(list(non_essential))
+
+        self.metric = metric
+        self.dropna = dropna
+
+        self.index = None
+        self.essential_pos = None
+        self.non_essential_pos = None
+
+        if index is not None:
+            self.resolve(index)
+
+    def resolve(self, index):
+        """
+        Row positions of the essential and non-essential genes in index, cached until a different
+        index is resolved.
+
+        :param index: pandas.Index
+
+        :return: (numpy.ndarray, numpy.ndarray)
+        """
+        if self.index is None or not (index is self.index or index.equals(self.index)):
+            essential_pos = index.get_indexer(self.essential)
+            non_essential_pos = index.get_indexer(self.non_essential)
+
+            assert (
+                essential_pos != -1
+            ).any(), "DataFrame has no index overlapping with essential list"
+
+            assert (
+                non_essential_pos != -1
+            ).any(), "DataFrame has no index overlapping with non essential list"
+
+            self.index = index
+            self.essential_pos = np.sort(essential_pos[essential_pos != -1])
+            self.non_essential_pos = np.sort(non_essential_pos[non_essential_pos != -1])
+
+        return self.essential_pos, self.non_essential_pos
+
+    def summarise(self, values, pos):
+        values = values[pos]
+
+        missing = np.isnan(values)
+
+        if self.dropna:
+            values = values[~missing.any(axis=1)]
+
+        # np.nanmedian loops over columns, without missing values use the vectorised median
+        if self.metric is np.nanmedian and (self.dropna or not missing.any()):
+            return np.median(values, axis=0)
+
+        return self.metric(values, axis=0)
+
+    def medians(self, values):
+        """
+        Essential and non-essential medians of each column of values, rows aligned with the
+        resolved index.
+
+        :param values: numpy.ndarray
+
+        :return: (numpy.ndarray, numpy.ndarray)
+        """
+        assert self.index is not None, "Index not resolved"
+
+        return (
+            self.summarise(values, self.essential_pos),
+            self.summarise(values, self.non_essential_pos),
+        )
+
+    def transform(self, df, copy=True):
+        """
+        Scale data-frame (or array with rows aligned with the resolved index).
+
+        :param df: pandas.DataFrame or numpy.ndarray
+
+        :param copy: bool
+            If False, floating point data is scaled in place when it is backed by a single
+            writeable array
+
+        :return: pandas.DataFrame or numpy.ndarray
+        """
+        if isinstance(df, pd.DataFrame):
+            self.resolve(df.index)
+
+        values = np.asarray(df)
+
+        if not np.issubdtype(values.dtype, np.floating):
+            values = values.astype(np.float64)
+
+        elif copy or not values.flags.writeable:
+            values = values.copy()
+
+        essential, non_essential = self.medians(values)
+
+        values -= non_essential
+        values /= non_essential - essential
+
+        if not isinstance(df, pd.DataFrame):
+            return values
+
+        if np.shares_memory(values, df.values):
+            return df
+
+        return df._constructor(values, index=df.index, columns=df.columns)
+
+
 class DotDict(dict):
     __getattr__ = dict.get
     __setattr__ = dict.__setitem__
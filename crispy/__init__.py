@@ -2,26 +2,14 @@
 # Copyright (C) 2019 Emanuel Goncalves
 
 import sys
+import types
 import logging
-import seaborn as sns
+import importlib
 from crispy.Utils import Utils
-from crispy.QCPlot import QCplot
-from crispy.CrispyPlot import CrispyPlot
-from crispy.Enrichment import SSGSEA, GSEAplot
-from crispy.CopyNumberCorrection import Crispy, CrispyGaussian
 
 
 __version__ = "0.5.2"
 
-# - SET STYLE
-sns.set(
-    style="ticks",
-    context="paper",
-    font_scale=0.75,
-    font="sans-serif",
-    rc=CrispyPlot.SNS_RC,
-)
-
 # - Logging
 __name__ = "Crispy"
 
@@ -34,6 +22,72 @@ if not logger.handlers:
     logger.setLevel(logging.INFO)
     logger.propagate = False
 
+# - LAZY HANDLES
+# Plotting (seaborn, matplotlib) and Gaussian Process (sklearn) classes are only imported on first
+# access, e.g. cy.Crispy, so that processes using only the data modules start quickly
+_LAZY = {
+    "Crispy": "crispy.CopyNumberCorrection",
+    "CrispyGaussian": "crispy.CopyNumberCorrection",
+    "QCplot": "crispy.QCPlot",
+    "CrispyPlot": "crispy.CrispyPlot",
+    "SSGSEA": "crispy.Enrichment",
+    "GSEAplot": "crispy.Enrichment",
+}
+
+_PLOTTING = {"crispy.QCPlot", "crispy.CrispyPlot", "crispy.Enrichment"}
+
+_STYLE_SET = False
+
+
+def set_style():
+    """
+    Set seaborn style used across Crispy plots, applied when the plotting classes are first loaded.
+    """
+    global _STYLE_SET
+
+    import seaborn as sns
+    from crispy.CrispyPlot import CrispyPlot
+
+    sns.set(
+        style="ticks",
+        context="paper",
+        font_scale=0.75,
+        font="sans-serif",
+        rc=CrispyPlot.SNS_RC,
+    )
+
+    _STYLE_SET = True
+
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError(f"module 'crispy' has no attribute '{name}'")
+
+    value = getattr(importlib.import_module(_LAZY[name]), name)
+
+    if _LAZY[name] in _PLOTTING and not _STYLE_SET:
+        set_style()
+
+    globals()[name] = value
+
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()).union(_LAZY))
+
+
+class _CrispyModule(types.ModuleType):
+    def __setattr__(self, name, value):
+        # Importing crispy.CrispyPlot binds the submodule to the package, keep the class instead
+        if name in _LAZY and isinstance(value, types.ModuleType):
+            return
+
+        super().__setattr__(name, value)
+
+
+sys.modules[__spec__.name].__class__ = _CrispyModule
+
 # - HANDLES
 __all__ = [
     "Crispy",
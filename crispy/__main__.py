@@ -0,0 +1,8 @@
+#!/usr/bin/env python
+# Copyright (C) 2019 Emanuel Goncalves
+
+import sys
+from crispy.CLI import main
+
+
+sys.exit(main())
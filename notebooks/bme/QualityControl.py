@@ -26,7 +26,7 @@ import matplotlib.pyplot as plt
 from scipy.stats import spearmanr
 from scipy.interpolate import interpn
 from crispy import CrispyPlot, QCplot, Utils
-from crispy.CRISPRData import CRISPRDataSet, ReadCounts
+from crispy.CRISPRData import CRISPRDataSet, ReadCounts, GuideGeneMap
 
 
 if __name__ == "__main__":
@@ -67,7 +67,7 @@ if __name__ == "__main__":
         .foldchange(counts.plasmids)
     )
 
-    fc_gene = fc.groupby(counts.lib.reindex(fc.index)["Gene"]).mean()
+    fc_gene = GuideGeneMap(counts.lib).aggregate(fc)
 
     fc_gene_scaled = ReadCounts(fc_gene).scale()
 
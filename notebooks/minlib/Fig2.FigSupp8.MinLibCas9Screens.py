@@ -32,7 +32,7 @@ from crispy.QCPlot import QCplot
 from scipy.stats import spearmanr
 from sklearn.metrics import mean_squared_error
 from notebooks.minlib.Utils import project_score_sample_map
-from crispy.CRISPRData import CRISPRDataSet, Library
+from crispy.CRISPRData import CRISPRDataSet, Library, GuideGeneMap
 
 
 LOG = logging.getLogger("Crispy")
@@ -93,7 +93,7 @@ ky_smap = ky_smap[[i.startswith("HT29") for i in ky_smap.index]]
 
 ky_counts = ky.counts.remove_low_counts(ky.plasmids)
 ky_fc_sgrna = ky_counts.norm_rpm().foldchange(ky.plasmids)[ky_smap.index]
-ky_fc_gene = ky_fc_sgrna.groupby(ky.lib["Gene"]).mean()
+ky_fc_gene = GuideGeneMap(ky.lib).aggregate(ky_fc_sgrna)
 
 
 # Gene fold-change
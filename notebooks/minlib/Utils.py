@@ -10,7 +10,7 @@ from crispy.QCPlot import QCplot
 from scipy.stats import ks_2samp
 from scipy.interpolate import interpn
 from scipy.stats import gaussian_kde
-from crispy.CRISPRData import ReadCounts
+from crispy.CRISPRData import ReadCounts, GuideGeneMap
 
 
 LOG = logging.getLogger("Crispy")
@@ -32,6 +32,7 @@ def downsample_sgrnas(
     glib = (
         lib[lib.index.isin(counts.index)].reset_index()[["sgRNA_ID", gene_col]].dropna()
     )
+    gmap = GuideGeneMap(glib.set_index("sgRNA_ID"), gene_col=gene_col)
     glib = glib.groupby(gene_col)
 
     scores = []
@@ -48,7 +49,7 @@ def downsample_sgrnas(
             sgrnas_fc = counts.loc[sgrnas.index].norm_rpm().foldchange(plasmids)
 
             # genes fold-change
-            genes_fc = sgrnas_fc.groupby(sgrnas[gene_col]).mean()
+            genes_fc = gmap.aggregate(sgrnas_fc)
             genes_fc = genes_fc.groupby(manifest["model_id"], axis=1).mean()
 
             # AROC
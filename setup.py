@@ -82,6 +82,8 @@ setuptools.setup(
     include_package_data=True,
     package_data=included_files,
     install_requires=requirements,
+    extras_require={"bedtools": ["pybedtools>=0.7.10"]},
+    entry_points={"console_scripts": ["crispy=crispy.CLI:main"]},
     classifiers=(
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: BSD License",
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# Copyright (C) 2019 Emanuel Goncalves
+
+import pytest
+import numpy as np
+import pandas as pd
+from crispy.CountStore import CountStore
+
+
+def simulate(samples, n_sgrna=500, seed=0):
+    rng = np.random.RandomState(seed)
+
+    return pd.DataFrame(
+        rng.poisson(200, (n_sgrna, len(samples))),
+        index=[f"sg{i}" for i in range(n_sgrna)],
+        columns=samples,
+    )
+
+
+def test_create_append_open(tmp_path):
+    path = str(tmp_path / "store")
+
+    counts = simulate(["S0", "S1", "S2"])
+    new = simulate(["S3", "S4"], seed=1)
+
+    CountStore.create(path, counts)
+
+    # sgRNAs of appended samples are aligned to the store
+    CountStore(path).append(new.iloc[::-1])
+
+    store = CountStore(path)
+    expected = pd.concat([counts, new], axis=1)
+
+    assert store.dtype == np.uint32
+    assert list(store.samples) == list(expected.columns)
+    pd.testing.assert_frame_equal(store.open(), expected, check_dtype=False)
+
+    # Consecutive and non-consecutive subsets of samples
+    for samples in [["S1", "S2", "S3"], ["S4", "S0"]]:
+        pd.testing.assert_frame_equal(
+            store.open(samples), expected[samples], check_dtype=False
+        )
+
+
+def test_invalid_counts(tmp_path):
+    path = str(tmp_path / "store")
+
+    counts = simulate(["S0", "S1"])
+    store = CountStore.create(path, counts)
+
+    with pytest.raises(AssertionError):
+        store.append(counts[["S1"]])
+
+    with pytest.raises(AssertionError):
+        store.append(counts[["S1"]].rename(columns={"S1": "S2"}).iloc[1:])
+
+    with pytest.raises(AssertionError):
+        store.append(counts[["S1"]].rename(columns={"S1": "S2"}) + 0.5)
+
+    # Failed appends leave the store unchanged
+    pd.testing.assert_frame_equal(CountStore(path).open(), counts, check_dtype=False)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# Copyright (C) 2019 Emanuel Goncalves
+
+import pytest
+import numpy as np
+import pandas as pd
+import crispy as cy
+
+
+def simulate(n_segments, seed=0):
+    """
+    Segments with a copy-number ratio effect on fold-changes, 10 sgRNAs per segment
+    """
+    rng = np.random.RandomState(seed)
+
+    ratio = np.round(rng.gamma(4, 0.25, n_segments), 2)
+    fold_change = -0.45 * np.log2(1 + np.maximum(ratio - 1, 0)) + rng.normal(
+        0, 0.15, n_segments
+    )
+
+    bed_df = pd.DataFrame(
+        dict(
+            Chr="1",
+            Start=np.arange(n_segments),
+            End=np.arange(n_segments) + 1,
+            fold_change=fold_change,
+            copy_number=ratio * 2,
+            ratio=ratio,
+            chr_copy=2.0,
+            ploidy=2.0,
+            len=1.0,
+            len_log2=0.0,
+            sgRNA_ID="sgRNA",
+        )
+    )
+
+    return pd.concat([bed_df] * 10, ignore_index=True)
+
+
+@pytest.mark.parametrize("n_segments", [250, 500])
+def test_binned_approximation(n_segments):
+    bed_df = simulate(n_segments)
+
+    # Predicted mean of the binned approximation against the exact fit
+    fits = {}
+    for approx in [None, "binned"]:
+        gpr = cy.CrispyGaussian(bed_df, approx=approx, random_state=0)
+        gpr.fit(x=["ratio"], y="fold_change")
+        fits[approx] = gpr.predict()
+
+    rmse = np.sqrt(np.mean((fits[None] - fits["binned"]) ** 2))
+
+    assert rmse < 0.02
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# Copyright (C) 2019 Emanuel Goncalves
+
+import pytest
+import numpy as np
+import pandas as pd
+from crispy.CRISPRData import GuideGeneMap
+
+
+def simulate(n_sgrna=400, n_genes=80, seed=0):
+    rng = np.random.RandomState(seed)
+
+    guides = [f"sg{i}" for i in range(n_sgrna)]
+
+    library = pd.DataFrame(
+        dict(Gene=rng.choice([f"G{i}" for i in range(n_genes)], n_sgrna)),
+        index=guides,
+    )
+    library.loc[guides[:10], "Gene"] = np.nan
+
+    # sgRNAs targeting two genes
+    library = pd.concat(
+        [library, library.iloc[10:30].assign(Gene=f"G{n_genes}")]
+    ).sort_index()
+
+    # Data with missing values, sgRNAs not in the library and library sgRNAs not measured
+    data = pd.DataFrame(
+        rng.normal(size=(n_sgrna, 4)),
+        index=guides,
+        columns=[f"S{i}" for i in range(4)],
+    )
+    data = data.mask(rng.rand(*data.shape) < 0.2)
+    data.iloc[40:44] = np.nan
+    data = pd.concat(
+        [data.iloc[20:], pd.DataFrame(0.0, index=["sgX", "sgY"], columns=data.columns)]
+    )
+
+    return library, data
+
+
+@pytest.mark.parametrize("agg", GuideGeneMap.AGG_FUNCTIONS)
+def test_aggregate(agg):
+    library, data = simulate()
+
+    genes = library.loc[library.index.isin(data.index), "Gene"]
+    ref = data.loc[genes.index].groupby(genes.values).agg(agg)
+
+    res = GuideGeneMap(library).aggregate(data, agg=agg)
+
+    pd.testing.assert_frame_equal(res, ref, check_names=False)
+    pd.testing.assert_series_equal(
+        GuideGeneMap(library).aggregate(data["S0"], agg=agg),
+        ref["S0"],
+        check_names=False,
+    )
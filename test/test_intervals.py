@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# Copyright (C) 2019 Emanuel Goncalves
+
+import pytest
+import numpy as np
+import pandas as pd
+from crispy.Intervals import IntervalIndex
+from crispy.CopyNumberCorrection import Crispy
+
+
+def simulate(n_sgrna=300, n_segments=40, seed=0):
+    rng = np.random.RandomState(seed)
+
+    start = rng.randint(0, 10000, n_sgrna)
+    library = pd.DataFrame(
+        dict(
+            Chr=rng.choice(["1", "2", "10", "X"], n_sgrna),
+            Start=start,
+            End=start + rng.randint(1, 50, n_sgrna),
+        ),
+        index=[f"sg{i}" for i in range(n_sgrna)],
+    )
+
+    seg_start = rng.randint(0, 10000, n_segments)
+    segments = pd.DataFrame(
+        dict(
+            Chr=rng.choice(["1", "2", "10", "X", "Y"], n_segments),
+            Start=seg_start,
+            End=seg_start + rng.randint(1, 2000, n_segments),
+        )
+    )
+
+    # Segments touching (not overlapping) and matching sgRNAs ends
+    edges = library.iloc[:10]
+    segments = pd.concat(
+        [
+            segments,
+            edges.assign(Start=edges["End"], End=edges["End"] + 100),
+            edges.assign(Start=edges["Start"] - 100, End=edges["Start"]),
+            edges,
+        ],
+        ignore_index=True,
+    )
+    segments["copy_number"] = rng.randint(1, 6, len(segments)).astype(float)
+
+    return library, segments
+
+
+def brute_force(library, segments):
+    pairs = [
+        (i, j)
+        for i, (c, s, e) in enumerate(segments[["Chr", "Start", "End"]].values)
+        for j, (c_, s_, e_) in enumerate(library[["Chr", "Start", "End"]].values)
+        if c == c_ and s < e_ and e > s_
+    ]
+
+    return set(pairs)
+
+
+def test_query():
+    library, segments = simulate()
+
+    index = IntervalIndex.from_frame(library)
+    q_idx, rows = index.query(segments["Chr"], segments["Start"], segments["End"])
+
+    assert set(zip(q_idx, rows)) == brute_force(library, segments)
+    assert len(q_idx) == len(set(zip(q_idx, rows)))
+
+    # sgRNAs overlap their matching segments, not the segments touching their ends
+    pairs = set(zip(q_idx, rows))
+    n = len(segments)
+
+    for i in range(10):
+        assert (n - 10 + i, i) in pairs
+        assert (n - 20 + i, i) not in pairs
+        assert (n - 30 + i, i) not in pairs
+
+
+def test_save_load(tmp_path):
+    library, segments = simulate()
+
+    index = IntervalIndex.from_frame(library)
+    index.save(str(tmp_path / "index.npz"))
+    loaded = IntervalIndex.load(str(tmp_path / "index.npz"))
+
+    for q, q_loaded in zip(
+        index.query(segments["Chr"], segments["Start"], segments["End"]),
+        loaded.query(segments["Chr"], segments["Start"], segments["End"]),
+    ):
+        np.testing.assert_array_equal(q, q_loaded)
+
+    np.testing.assert_array_equal(index.ids, loaded.ids)
+
+
+def test_intersect_bedtools():
+    pytest.importorskip("pybedtools")
+
+    library, segments = simulate()
+    fc = pd.Series(np.random.RandomState(1).normal(size=len(library)), library.index)
+
+    beds = [
+        Crispy(fc, library, segments, intersect_engine=engine)
+        .intersect_sgrna_copynumber()
+        .astype(dict(Chr=str, sgRNA_Chr=str, sgRNA_ID=str))
+        .sort_values(["Chr", "Start", "sgRNA_Start", "sgRNA_ID"])
+        .reset_index(drop=True)
+        for engine in ["numpy", "bedtools"]
+    ]
+
+    # bedtools fold-changes are parsed from their text representation
+    pd.testing.assert_frame_equal(*beds, check_dtype=False, atol=1e-5)
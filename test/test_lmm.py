@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# Copyright (C) 2019 Emanuel Goncalves
+
+import pytest
+import numpy as np
+import pandas as pd
+from scipy.stats import chi2
+from statsmodels.stats.multitest import multipletests
+from crispy.LMModels import LMModels, LModel, multipletests_grouped
+
+
+def simulate(n_samples=80, n_x=30, n_y=4, seed=0):
+    rng = np.random.RandomState(seed)
+
+    samples = [f"S{i}" for i in range(n_samples)]
+
+    g = rng.normal(size=(n_samples, 200))
+    k = pd.DataFrame(g @ g.T / 200, index=samples, columns=samples)
+
+    x = pd.DataFrame(
+        rng.normal(size=(n_samples, n_x)),
+        index=samples,
+        columns=[f"X{i}" for i in range(n_x)],
+    )
+
+    m = pd.DataFrame(
+        rng.randint(0, 2, (n_samples, 3)).astype(float),
+        index=samples,
+        columns=["M0", "M1", "M2"],
+    )
+
+    # Random effect, noise and an effect of the first X features
+    u = np.linalg.cholesky(k.values + 1e-6 * np.eye(n_samples))
+    y = pd.DataFrame(
+        1.5 * u @ rng.normal(size=(n_samples, n_y))
+        + rng.normal(size=(n_samples, n_y))
+        + 0.5 * x.values[:, :n_y],
+        index=samples,
+        columns=[f"Y{i}" for i in range(n_y)],
+    )
+
+    return y, x, k, m
+
+
+def gls_scan(y, x, m, k):
+    """
+    Brute-force reference: variance ratio fitted on a grid, likelihoods of the explicit
+    covariance generalised least squares fits
+    """
+
+    def gls(design, v):
+        vi = np.linalg.inv(v)
+        a = design.T @ vi @ design
+        b = np.linalg.solve(a, design.T @ vi @ y)
+        r = y - design @ b
+        scale = r @ vi @ r / len(y)
+        lml = -0.5 * (
+            len(y) * np.log(2 * np.pi * scale) + np.linalg.slogdet(v)[1] + len(y)
+        )
+        return b, scale, lml, a
+
+    eye = np.eye(len(y))
+    grid = np.linspace(1e-6, 1, 2001)
+    lmls = [gls(m, (1 - d) * k + d * eye)[2] for d in grid]
+
+    v = (1 - grid[np.argmax(lmls)]) * k + grid[np.argmax(lmls)] * eye
+
+    res = []
+    for j in range(x.shape[1]):
+        b, scale, lml, a = gls(np.c_[m, x[:, j]], v)
+        res.append(
+            (
+                b[-1],
+                np.sqrt(scale * np.linalg.inv(a)[-1, -1]),
+                chi2(1).sf(2 * (lml - max(lmls))),
+            )
+        )
+
+    return np.array(res)
+
+
+def test_native_gls_reference():
+    y, x, k, m = simulate()
+
+    lmm = LMModels(y, x, k=k, m=m, engine="native", verbose=0)
+
+    for y_var in ["Y0", "Y3"]:
+        y_, _, x_, x_vars, m_, k_ = lmm.__prepare_inputs__(y_var)
+
+        res = lmm.lmm(y_var).set_index("x_id").loc[x_vars]
+        ref = gls_scan(y_[:, 0], x_, m_, k_)
+
+        np.testing.assert_allclose(res["beta"], ref[:, 0], atol=1e-4)
+        np.testing.assert_allclose(res["beta_se"], ref[:, 1], atol=1e-4)
+        np.testing.assert_allclose(res["pval"], ref[:, 2], rtol=1e-3, atol=1e-6)
+
+
+def test_native_limix():
+    pytest.importorskip("limix")
+
+    y, x, k, m = simulate()
+
+    res = {
+        engine: LMModels(y, x, k=k, m=m, engine=engine, verbose=0)
+        .matrix_lmm()
+        .set_index(["y_id", "x_id"])
+        .sort_index()
+        for engine in LMModels.ENGINES
+    }
+
+    native, limix = res["native"], res["limix"]
+
+    np.testing.assert_allclose(native["beta"], limix["beta"], atol=1e-3)
+    np.testing.assert_allclose(native["beta_se"], limix["beta_se"], atol=1e-3)
+    np.testing.assert_allclose(
+        -np.log10(native["pval"]), -np.log10(limix["pval"]), atol=1e-2
+    )
+    assert (native["nsamples"] == limix["nsamples"]).all()
+    assert (native["ncovariates"] == limix["ncovariates"]).all()
+
+
+def test_native_likelihood():
+    y, x, k, m = simulate()
+
+    with pytest.raises(AssertionError):
+        LMModels(y, x, k=k, m=m, lik="bernoulli", engine="native", verbose=0)
+
+
+def test_native_buckets(monkeypatch):
+    import scipy.linalg
+
+    y, x, k, m = simulate(n_y=6)
+
+    calls = []
+
+    def eigh(a):
+        calls.append(a.shape)
+        return np.linalg.eigh(a)
+
+    monkeypatch.setattr(scipy.linalg, "eigh", eigh)
+
+    lmm = LMModels(y, x, k=k, m=m, engine="native", verbose=0)
+
+    # Missing values in half of the Y variables (imputed by the Y transformation otherwise)
+    lmm.y[:5, 3:] = np.nan
+
+    res = pd.concat(lmm.run_lmm(chunk_size=2)).set_index(["y_id", "x_id"])
+
+    # One eigendecomposition per bucket of Y variables with the same samples
+    assert sorted(calls) == [(75, 75), (80, 80)]
+
+    ref = pd.concat([lmm.lmm(y_var) for y_var in y]).set_index(["y_id", "x_id"])
+    pd.testing.assert_frame_equal(res.loc[ref.index], ref)
+
+    par = pd.concat(lmm.run_lmm(n_jobs=2, chunk_size=2)).set_index(["y_id", "x_id"])
+    pd.testing.assert_frame_equal(par.loc[ref.index], ref)
+
+
+@pytest.mark.parametrize("method", ["fdr_bh", "holm", "bonferroni"])
+def test_multipletests_grouped(method):
+    rng = np.random.RandomState(0)
+
+    # Groups of different sizes with missing and tied p-values
+    groups = rng.randint(0, 8, 2000)
+    pvals = rng.uniform(size=2000) ** 3
+    pvals[rng.rand(2000) < 0.1] = np.nan
+    pvals[:50] = pvals[50:100]
+    pvals[groups == 7] = np.nan
+
+    ref = np.full(len(pvals), np.nan)
+    for g in np.unique(groups):
+        idx = np.flatnonzero((groups == g) & ~np.isnan(pvals))
+        if len(idx) > 0:
+            ref[idx] = multipletests(pvals[idx], method=method)[1]
+
+    np.testing.assert_array_equal(
+        multipletests_grouped(pvals, groups, method=method), ref
+    )
+
+    # Groups keyed by columns with missing values
+    assoc = pd.DataFrame(dict(y_id=groups.astype(float), pval=pvals))
+    assoc.loc[assoc["y_id"] == 3, "y_id"] = np.nan
+
+    np.testing.assert_array_equal(
+        LModel.multipletests_per(assoc, method=method)["fdr"].values, ref
+    )
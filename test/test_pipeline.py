@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# Copyright (C) 2019 Emanuel Goncalves
+
+import numpy as np
+import pandas as pd
+from crispy.Utils import Utils
+from crispy.Pipeline import IncrementalPipeline
+
+
+CORRECT_KWS = dict(gp_approx="binned", n_restarts_optimizer=0)
+
+
+def simulate(n_genes=200, n_sgrna=4, seed=0):
+    rng = np.random.RandomState(seed)
+
+    essential = sorted(Utils.get_essential_genes(return_series=False))[:50]
+    non_essential = sorted(Utils.get_non_essential_genes(return_series=False))[:50]
+    genes = essential + non_essential + [f"G{i}" for i in range(n_genes)]
+
+    n = len(genes) * n_sgrna
+    library = pd.DataFrame(
+        {
+            "Chr": np.repeat(rng.randint(1, 4, len(genes)).astype(str), n_sgrna),
+            "Start": np.arange(n) * 1000 + 10,
+            "Approved_Symbol": np.repeat(genes, n_sgrna),
+        },
+        index=[f"sg{i}" for i in range(n)],
+    )
+    library["End"] = library["Start"] + 23
+
+    samples = [f"S{i}" for i in range(4)]
+    counts = pd.DataFrame(
+        rng.poisson(200, (n, len(samples) + 1)),
+        index=library.index,
+        columns=["P1"] + samples,
+    )
+
+    segments = []
+    for s in samples:
+        for c in ["1", "2", "3"]:
+            bps = np.r_[0, np.sort(rng.randint(0, n * 1000, 4)), n * 1000 + 100]
+            segments += [
+                (s, c, a, b, float(rng.randint(1, 6))) for a, b in zip(bps, bps[1:])
+            ]
+
+    segments = pd.DataFrame(
+        segments, columns=["model_id", "Chr", "Start", "End", "copy_number"]
+    )
+
+    return counts, library, segments
+
+
+def test_segments_order(tmp_path):
+    counts, library, segments = simulate()
+
+    pipeline = IncrementalPipeline(
+        str(tmp_path), counts, ["P1"], library, segments, correct_kws=CORRECT_KWS
+    )
+    assert pipeline.run(["correction"])["correction"] == ["S0", "S1", "S2", "S3"]
+
+    # Same segments in a different order of the segments file
+    shuffled = segments.sample(frac=1, random_state=1)
+
+    pipeline = IncrementalPipeline(
+        str(tmp_path), counts, ["P1"], library, shuffled, correct_kws=CORRECT_KWS
+    )
+    assert pipeline.run(["correction"])["correction"] == []
+
+    # Changed segments of a single sample
+    changed = shuffled.copy()
+    changed.loc[changed["model_id"] == "S2", "copy_number"] += 1
+
+    pipeline = IncrementalPipeline(
+        str(tmp_path), counts, ["P1"], library, changed, correct_kws=CORRECT_KWS
+    )
+    assert pipeline.run(["correction"])["correction"] == ["S2"]